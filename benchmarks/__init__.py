@@ -0,0 +1,5 @@
+"""
+Offline benchmarks for py-bitbucket, run against a local stub of the BitBucket API.
+
+  python -m benchmarks.run --output results.json
+"""
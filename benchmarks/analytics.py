@@ -0,0 +1,83 @@
+""" Benchmark of the changeset analytics pipeline on a synthetic history served by the local stub.
+    Measures how fast the history is ingested (paged through `iter_all`) on its own and with the
+    pipeline aggregating it, and how fast already ingested batches are aggregated in the calling
+    process and on the process pool.
+
+    python -m benchmarks.analytics [--changesets N] [--page-size N] [--batch-size N]
+                                   [--processes N]
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+
+from timeit import default_timer
+
+from bitbucket import BitBucket
+from bitbucket.analytics import AnalyticsPipeline, iter_batches, numpy
+
+from benchmarks.stub_server import StubBitBucketServer
+
+
+def _rate(count, function):
+  """ Returns the number of items per second processed by the function, along with its result. """
+  started = default_timer()
+  result = function()
+  return (count / (default_timer() - started), result)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmarks the changeset analytics pipeline.')
+  parser.add_argument('--changesets', type=int, default=1000000,
+                      help='Length of the synthetic history')
+  parser.add_argument('--page-size', type=int, default=1000, help='Changesets per request')
+  parser.add_argument('--batch-size', type=int, default=10000, help='Changesets per batch')
+  parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                      help='Number of aggregation processes')
+  args = parser.parse_args(argv)
+
+  with StubBitBucketServer(changeset_count=args.changesets,
+                           max_page_size=args.page_size) as server:
+    bb = BitBucket('consumer-key', 'consumer-secret', 'http://localhost/')
+    changesets = bb.get_authorized_client('token', 'secret').for_namespace('stub') \
+        .repositories().get('repository').changesets()
+
+    (ingest_rate, _) = _rate(args.changesets, lambda: sum(
+        1 for _ in changesets.iter_all(page_size=args.page_size)))
+
+    (pipeline_rate, (result, stats, error)) = _rate(args.changesets, lambda: changesets.analyze(
+        page_size=args.page_size, batch_size=args.batch_size, processes=args.processes))
+    if not result:
+      raise Exception(error)
+
+    # The already ingested history, kept as columnar batches.
+    batches = list(iter_batches((server._changeset(index) for index in range(args.changesets)),
+                                args.batch_size))
+
+  (inline_rate, inline_stats) = _rate(args.changesets, lambda: AnalyticsPipeline(
+      batch_size=args.batch_size, processes=0).run_batches(batches))
+  (pool_rate, pool_stats) = _rate(args.changesets, lambda: AnalyticsPipeline(
+      batch_size=args.batch_size, processes=args.processes).run_batches(batches))
+
+  if not (stats.to_dict() == inline_stats.to_dict() == pool_stats.to_dict()):
+    raise Exception('Aggregations differ')
+
+  results = {
+    'changesets': args.changesets,
+    'page_size': args.page_size,
+    'batch_size': args.batch_size,
+    'processes': args.processes,
+    'numpy': numpy is not None,
+    'authors': len(stats.authors),
+    'activity_days': len(stats.activity),
+    'ingest_changesets_per_second': ingest_rate,
+    'pipeline_changesets_per_second': pipeline_rate,
+    'aggregate_inline_changesets_per_second': inline_rate,
+    'aggregate_pool_changesets_per_second': pool_rate,
+  }
+  sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,110 @@
+""" Micro-benchmark of the time and memory spent creating resource clients, as done when walking
+    many repositories: for each repository a repository client is created and each of its
+    sub-client accessors is called a few times. The slotted clients sharing a context are
+    compared with clients laid out as they were before: each with a `__dict__` holding its own
+    copy of the dispatcher, credentials, namespace and repository, and a new one allocated by
+    every accessor call. No network access is performed.
+
+    python -m benchmarks.clients [--repositories N] [--accesses N]
+"""
+
+import argparse
+import json
+import sys
+import tracemalloc
+
+from timeit import default_timer
+
+from bitbucket import BitBucket
+
+
+class _UnslottedClient(object):
+  """ A resource client laid out as before the clients shared a slotted context. """
+  def __init__(self, dispatcher, access_token, access_token_secret, namespace,
+               repository_name=None):
+    self._dispatcher = dispatcher
+    self._access_token = access_token
+    self._access_token_secret = access_token_secret
+    self._namespace = namespace
+    self._repository_name = repository_name
+
+  def _sub_client(self, repository_name=None):
+    return _UnslottedClient(self._dispatcher, self._access_token, self._access_token_secret,
+                            self._namespace, repository_name or self._repository_name)
+
+  def repositories(self):
+    return self._sub_client()
+
+  def get(self, repository_name):
+    return self._sub_client(repository_name)
+
+  changesets = webhooks = services = links = deploykeys = _sub_client
+
+
+class _UnslottedRootClient(object):
+  """ The root client handing out `_UnslottedClient`s. """
+  def __init__(self, dispatcher, access_token, access_token_secret):
+    self._dispatcher = dispatcher
+    self._access_token = access_token
+    self._access_token_secret = access_token_secret
+
+  def for_namespace(self, namespace):
+    return _UnslottedClient(self._dispatcher, self._access_token, self._access_token_secret,
+                            namespace)
+
+
+def _walk(client, repositories, accesses):
+  """ Creates the clients for the given number of repositories, returning them all. """
+  repositories_client = client.for_namespace('namespace').repositories()
+  kept = []
+  for index in range(repositories):
+    repository = repositories_client.get('repository-%d' % index)
+    for _ in range(accesses):
+      kept.append((repository.changesets(), repository.webhooks(), repository.services(),
+                   repository.links(), repository.deploykeys()))
+    kept.append(repository)
+  return kept
+
+
+def _measure(client, repositories, accesses):
+  """ Returns the seconds spent and the bytes kept per repository walked with the client. """
+  started = default_timer()
+  _walk(client, repositories, accesses)
+  elapsed = default_timer() - started
+
+  tracemalloc.start()
+  kept = _walk(client, repositories, accesses)
+  (current, _) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del kept
+
+  return (elapsed / repositories, float(current) / repositories)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmarks resource client allocation.')
+  parser.add_argument('--repositories', type=int, default=100000,
+                      help='Number of repository clients created')
+  parser.add_argument('--accesses', type=int, default=3,
+                      help='Number of times each sub-client accessor is called per repository')
+  args = parser.parse_args(argv)
+
+  dispatcher = BitBucket('consumer-key', 'consumer-secret', 'http://localhost/')
+  clients = {
+    'before': _UnslottedRootClient(dispatcher, 'access-token', 'access-token-secret'),
+    'after': dispatcher.get_authorized_client('access-token', 'access-token-secret'),
+  }
+
+  results = {
+    'repositories': args.repositories,
+    'accesses': args.accesses,
+  }
+  for (name, client) in sorted(clients.items()):
+    (seconds, bytes_used) = _measure(client, args.repositories, args.accesses)
+    results[name + '_seconds_per_repository'] = seconds
+    results[name + '_bytes_per_repository'] = bytes_used
+  sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,214 @@
+""" Runs the benchmark flows against a local stub server and reports the results as JSON.
+
+    python -m benchmarks.run [--latency SECONDS] [--payload-size BYTES] [--output FILE] ...
+"""
+
+import argparse
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from timeit import default_timer
+
+from bitbucket import BitBucket
+from bitbucket.instrumentation import Instrumentation
+from bitbucket.ratelimit import RateLimiter
+
+from benchmarks.stub_server import StubBitBucketServer
+
+
+class _RequestRecorder(Instrumentation):
+  """ Records the total and client-side time of every dispatched request. """
+  def __init__(self):
+    self.totals = []
+    self.overheads = []
+
+  def after_request(self, info):
+    self.totals.append(info.total)
+    self.overheads.append(info.total - info.timings['connect'] - info.timings['send'] -
+                          info.timings['wait'])
+
+
+def _flow_changesets(repository, iterations):
+  for _ in range(iterations):
+    for _ in repository.changesets().iter_all():
+      pass
+
+def _flow_changeset_pages(repository, iterations):
+  for _ in range(iterations):
+    repository.changesets().list(None, limit=50)
+
+def _flow_raw_file(repository, iterations):
+  for index in range(iterations):
+    repository.get_raw_path_contents('src/file%d.py' % index)
+
+def _flow_raw_file_stream(repository, iterations):
+  for index in range(iterations):
+    repository.download_raw_path_contents('src/file%d.py' % index, io.BytesIO())
+
+def _flow_webhooks_crud(repository, iterations):
+  webhooks = repository.webhooks()
+  for index in range(iterations):
+    (result, hook, _) = webhooks.create('hook %d' % index, 'http://example.com/%d' % index,
+                                        ['repo:push'])
+    if not result:
+      # Creations are not retried when throttled.
+      continue
+
+    webhooks.get(hook['uuid'])
+    webhooks.update(hook['uuid'], 'hook %d' % index, 'http://example.com/', ['repo:push'])
+    webhooks.all()
+    webhooks.delete(hook['uuid'])
+
+def _flow_deploykeys_crud(repository, iterations):
+  deploykeys = repository.deploykeys()
+  for index in range(iterations):
+    (result, key, _) = deploykeys.create('key %d' % index, 'ssh-rsa AAAA%d' % index)
+    if not result:
+      continue
+
+    deploykeys.get(key['pk'])
+    deploykeys.all()
+    deploykeys.delete(key['pk'])
+
+FLOWS = {
+  'changesets': _flow_changesets,
+  'changeset_pages': _flow_changeset_pages,
+  'raw_file': _flow_raw_file,
+  'raw_file_stream': _flow_raw_file_stream,
+  'webhooks_crud': _flow_webhooks_crud,
+  'deploykeys_crud': _flow_deploykeys_crud,
+}
+
+
+def _percentile(values, percentile):
+  """ Returns the given percentile of the values, by nearest rank. """
+  if not values:
+    return None
+
+  ordered = sorted(values)
+  rank = max(0, int(round(percentile / 100.0 * len(ordered))) - 1)
+  return ordered[rank]
+
+
+def _make_repository(recorder, rate_limited):
+  """ Returns a repository client on a fresh dispatcher instrumented by the recorder. """
+  rate_limiter = RateLimiter(rate=1e6, burst=1e6, backoff_base=0) if rate_limited else None
+  bitbucket = BitBucket('consumer-key', 'consumer-secret', 'http://localhost/',
+                        instrumentation=recorder, rate_limiter=rate_limiter)
+  client = bitbucket.get_authorized_client('access-token', 'access-token-secret')
+  return (bitbucket, client.for_namespace('stub').repositories().get('repository'))
+
+
+def run_flow(name, iterations, rate_limited=False):
+  """ Runs the named flow and returns its measurements. """
+  flow = FLOWS[name]
+
+  # Warm up the connection pool before measuring.
+  recorder = _RequestRecorder()
+  (bitbucket, repository) = _make_repository(recorder, rate_limited)
+  repository.get_main_branch()
+  recorder.totals = []
+  recorder.overheads = []
+
+  started = default_timer()
+  flow(repository, iterations)
+  elapsed = default_timer() - started
+  bitbucket.close()
+
+  requests = len(recorder.totals)
+
+  # Measure allocations separately, as tracing slows everything down.
+  memory_recorder = _RequestRecorder()
+  (bitbucket, repository) = _make_repository(memory_recorder, rate_limited)
+  repository.get_main_branch()
+  memory_recorder.totals = []
+  tracemalloc.start()
+  flow(repository, max(1, iterations // 10))
+  (_, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  bitbucket.close()
+
+  return {
+    'iterations': iterations,
+    'requests': requests,
+    'seconds': elapsed,
+    'requests_per_second': requests / elapsed if elapsed else None,
+    'latency_p50': _percentile(recorder.totals, 50),
+    'latency_p99': _percentile(recorder.totals, 99),
+    'overhead_mean': (sum(recorder.overheads) / requests) if requests else None,
+    'peak_memory_per_request': peak / max(1, len(memory_recorder.totals)),
+  }
+
+
+def _git_revision():
+  """ Returns the git revision of the working tree, if available. """
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   stderr=subprocess.DEVNULL).decode('ascii').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmarks py-bitbucket against a local stub.')
+  parser.add_argument('--latency', type=float, default=0, help='Server latency in seconds')
+  parser.add_argument('--payload-size', type=int, default=16 * 1024,
+                      help='Size in bytes of raw file contents')
+  parser.add_argument('--changesets', type=int, default=1000,
+                      help='Number of changesets in the repository history')
+  parser.add_argument('--page-size', type=int, default=50,
+                      help='Largest page of changesets returned by the server')
+  parser.add_argument('--throttle-every', type=int, default=None,
+                      help='Answer every n-th request with a 429')
+  parser.add_argument('--iterations', type=int, default=200, help='Iterations of each flow')
+  parser.add_argument('--flows', default=','.join(sorted(FLOWS)),
+                      help='Comma separated flows to run')
+  parser.add_argument('--output', default=None, help='File to write the JSON results to')
+  args = parser.parse_args(argv)
+
+  config = {
+    'latency': args.latency,
+    'payload_size': args.payload_size,
+    'changesets': args.changesets,
+    'page_size': args.page_size,
+    'throttle_every': args.throttle_every,
+    'iterations': args.iterations,
+  }
+
+  results = {
+    'revision': _git_revision(),
+    'python': platform.python_version(),
+    'timestamp': time.time(),
+    'config': config,
+    'flows': {},
+  }
+
+  with StubBitBucketServer(latency=args.latency, payload_size=args.payload_size,
+                           changeset_count=args.changesets, max_page_size=args.page_size,
+                           throttle_every=args.throttle_every) as server:
+    for name in args.flows.split(','):
+      iterations = args.iterations
+      if name == 'changesets':
+        # Every iteration walks the whole history.
+        iterations = max(1, iterations // 100)
+
+      results['flows'][name] = run_flow(name, iterations,
+                                        rate_limited=bool(args.throttle_every))
+    results['server_requests'] = dict(('%s %s' % key, count)
+                                      for (key, count) in server.requests.items())
+
+  output = json.dumps(results, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      output_file.write(output + '\n')
+  else:
+    sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,59 @@
+""" Micro-benchmark of the CPU time spent building and applying OAuth signers per request,
+    comparing a new signer per request with the signers cached by `BitBucket`. No network access
+    is performed; requests are only prepared (and so signed).
+
+    python -m benchmarks.signers [--requests N] [--tokens N]
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from requests import Request
+from requests_oauthlib import OAuth1
+
+from bitbucket import BitBucket
+from bitbucket.urls import repository_changesets_url
+
+
+def _measure(make_signer, requests, tokens):
+  """ Returns the CPU seconds per request spent signing `requests` requests spread over `tokens`
+      distinct credentials.
+  """
+  url = repository_changesets_url('namespace', 'repository')
+  started = time.process_time()
+  for index in range(requests):
+    token = 'token-%d' % (index % tokens)
+    signer = make_signer(token, 'secret-' + token)
+    Request(method='GET', url=url, auth=signer, params={'limit': 50}).prepare()
+  return (time.process_time() - started) / requests
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmarks OAuth signer reuse.')
+  parser.add_argument('--requests', type=int, default=20000, help='Number of requests signed')
+  parser.add_argument('--tokens', type=int, default=10, help='Number of distinct credentials')
+  args = parser.parse_args(argv)
+
+  bitbucket = BitBucket('consumer-key', 'consumer-secret', 'http://localhost/')
+
+  def new_signer(token, secret):
+    return OAuth1('consumer-key', client_secret='consumer-secret', resource_owner_key=token,
+                  resource_owner_secret=secret)
+
+  uncached = _measure(new_signer, args.requests, args.tokens)
+  cached = _measure(bitbucket._get_signer, args.requests, args.tokens)
+
+  results = {
+    'requests': args.requests,
+    'tokens': args.tokens,
+    'uncached_cpu_per_request': uncached,
+    'cached_cpu_per_request': cached,
+    'saved_cpu_per_request': uncached - cached,
+  }
+  sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,404 @@
+""" A local HTTP server imitating the BitBucket V1 and V2 endpoints built in `bitbucket.urls`, for
+    benchmarking the clients offline. Python 3 only.
+
+      with StubBitBucketServer(latency=0.01, changeset_count=1000) as server:
+        bb = BitBucket('key', 'secret', 'http://localhost/')
+        ...
+
+    While running, the server redirects all URLs built by `bitbucket.urls` to itself.
+"""
+
+import json
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+from bitbucket.urls import set_base_urls, url_template, repository_webhooks_url
+
+# Changesets are made every ten minutes from 2015-01-01 00:00:00 UTC on.
+_FIRST_CHANGESET_TIME = 1420070400
+_CHANGESET_INTERVAL = 600
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+  """ Handles the requests made to the stub server. """
+  protocol_version = 'HTTP/1.1'
+
+  # Headers and body are written separately; without this, delayed ACKs add ~40ms per request.
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    pass
+
+  def _reply(self, status, body=b'', content_type='application/json', headers=None):
+    if not isinstance(body, bytes):
+      body = json.dumps(body).encode('utf-8')
+
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for (name, value) in (headers or {}).items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _handle(self, method):
+    stub = self.server.stub
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length) if length else b''
+
+    if stub.latency:
+      time.sleep(stub.latency)
+
+    if stub.should_throttle():
+      self._reply(429, {'error': 'throttled'}, headers={'Retry-After': str(stub.retry_after)})
+      return
+
+    parsed = urlparse(self.path)
+    template = url_template(stub.base_url + parsed.path)
+    if template is None:
+      self._reply(404, {'error': 'unknown endpoint'})
+      return
+
+    stub.record_request(method, template)
+    handler = stub.routes.get((method, template))
+    if handler is None:
+      self._reply(405, {'error': 'method not allowed'})
+      return
+
+    args = stub.path_arguments(template, parsed.path)
+    (status, response_body, content_type) = handler(args, parse_qs(parsed.query), body)
+    self._reply(status, response_body, content_type=content_type)
+
+  def do_GET(self):
+    self._handle('GET')
+
+  def do_POST(self):
+    self._handle('POST')
+
+  def do_PUT(self):
+    self._handle('PUT')
+
+  def do_DELETE(self):
+    self._handle('DELETE')
+
+
+class StubBitBucketServer(object):
+  """ A threaded stub of the BitBucket API listening on localhost.
+
+      `latency` is the delay (in seconds) added to every response, `payload_size` the size in
+      bytes of raw file contents, `changeset_count` the length of every repository's history,
+      and `max_page_size` the largest page of changesets returned. When `throttle_every` is set,
+      every n-th request is answered with a 429 and a `Retry-After` of `retry_after` seconds.
+      The source tree of every repository has `tree_fanout` subdirectories per directory down
+      to `tree_depth` levels, and 31 files in each directory; `.txt` files are served as text.
+      Webhooks are listed `webhook_page_size` per page. Accounts whose name starts with
+      `unknown` do not exist, and lookups of those whose name starts with `failing` fail with a
+      500. Deploy keys already added to the repository, or whose label starts with `invalid`,
+      are refused. `rewrite_history` simulates a force-push.
+  """
+  def __init__(self, latency=0, payload_size=1024, changeset_count=500, max_page_size=50,
+               throttle_every=None, retry_after=0, tree_depth=0, tree_fanout=4,
+               webhook_page_size=10):
+    self.latency = latency
+    self.payload_size = payload_size
+    self.changeset_count = changeset_count
+    self.max_page_size = max_page_size
+    self.throttle_every = throttle_every
+    self.retry_after = retry_after
+    self.tree_depth = tree_depth
+    self.tree_fanout = tree_fanout
+    self.webhook_page_size = webhook_page_size
+
+    self._rewritten_from = None
+    self.base_url = None
+    self.requests = {}
+    self._request_count = 0
+    self._lock = threading.Lock()
+    self._server = None
+    self._thread = None
+    self._previous_base_urls = None
+
+    self._webhooks = {}
+    self._deploy_keys = {}
+    self._next_key_id = 1
+    self._payload = (b'0123456789abcdef' * (payload_size // 16 + 1))[:payload_size]
+
+    self.routes = {
+      ('GET', 'user'): self._get_user,
+      ('GET', 'user/repositories'): self._get_user_repositories,
+      ('GET', 'users/{account}'): self._get_account,
+      ('GET', 'repositories/{ns}/{repo}/main-branch'): self._get_main_branch,
+      ('GET', 'repositories/{ns}/{repo}/branches'): self._get_branches,
+      ('GET', 'repositories/{ns}/{repo}/tags'): self._get_tags,
+      ('GET', 'repositories/{ns}/{repo}/branches-tags'): self._get_branches_tags,
+      ('GET', 'repositories/{ns}/{repo}/refs/branches/{branch}'): self._get_branch,
+      ('GET', 'repositories/{ns}/{repo}/refs/tags/{tag}'): self._get_branch,
+      ('GET', 'repositories/{ns}/{repo}/changesets'): self._list_changesets,
+      ('GET', 'repositories/{ns}/{repo}/changesets/{node}'): self._get_changeset,
+      ('GET', 'repositories/{ns}/{repo}/manifest/{revision}'): self._get_manifest,
+      ('GET', 'repositories/{ns}/{repo}/src/{revision}/{path}'): self._get_src,
+      ('GET', 'repositories/{ns}/{repo}/raw/{revision}/{path}'): self._get_raw,
+      ('GET', 'repositories/{ns}/{repo}/hooks'): self._list_webhooks,
+      ('POST', 'repositories/{ns}/{repo}/hooks'): self._create_webhook,
+      ('GET', 'repositories/{ns}/{repo}/hooks/{uuid}'): self._get_webhook,
+      ('PUT', 'repositories/{ns}/{repo}/hooks/{uuid}'): self._update_webhook,
+      ('DELETE', 'repositories/{ns}/{repo}/hooks/{uuid}'): self._delete_webhook,
+      ('GET', 'repositories/{ns}/{repo}/deploy-keys'): self._list_deploy_keys,
+      ('POST', 'repositories/{ns}/{repo}/deploy-keys'): self._create_deploy_key,
+      ('GET', 'repositories/{ns}/{repo}/deploy-keys/{key_id}'): self._get_deploy_key,
+      ('DELETE', 'repositories/{ns}/{repo}/deploy-keys/{key_id}'): self._delete_deploy_key,
+      ('GET', 'repositories/{ns}/{repo}/links'): self._list_empty,
+      ('GET', 'repositories/{ns}/{repo}/services'): self._list_empty,
+    }
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
+
+  def start(self):
+    """ Starts serving on a free local port and points `bitbucket.urls` at the server. """
+    self._server = ThreadingHTTPServer(('127.0.0.1', 0), _StubRequestHandler)
+    self._server.daemon_threads = True
+    self._server.stub = self
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+
+    self.base_url = 'http://127.0.0.1:%s' % self._server.server_port
+    self._previous_base_urls = set_base_urls(self.base_url + '/1.0/', self.base_url + '/2.0/')
+
+  def stop(self):
+    """ Stops the server and restores the previous base URLs. """
+    set_base_urls(*self._previous_base_urls)
+    self._server.shutdown()
+    self._server.server_close()
+    self._thread.join()
+
+  def should_throttle(self):
+    """ Returns whether the current request must be answered with a 429. """
+    with self._lock:
+      self._request_count += 1
+      return bool(self.throttle_every) and self._request_count % self.throttle_every == 0
+
+  def record_request(self, method, template):
+    """ Counts a request made to the given endpoint. """
+    with self._lock:
+      key = (method, template)
+      self.requests[key] = self.requests.get(key, 0) + 1
+
+  def path_arguments(self, template, path):
+    """ Returns the (unquoted) values of the template placeholders found in the request path. """
+    version_prefix = '/2.0/' if path.startswith('/2.0/') else '/1.0/'
+    relative = path[len(version_prefix):]
+    template_parts = template.split('/')
+    path_parts = relative.split('/')
+    args = {}
+    for (index, part) in enumerate(template_parts):
+      if part == '{path}':
+        args['path'] = unquote('/'.join(path_parts[index:]))
+        break
+      if part.startswith('{'):
+        args[part[1:-1]] = unquote(path_parts[index])
+    return args
+
+  def rewrite_history(self, from_index):
+    """ Rewrites the history from the changeset at the given position on, as a force-push would:
+        those changesets get new raw nodes.
+    """
+    self._rewritten_from = from_index
+
+  def node(self, index):
+    """ Returns the raw node of the changeset at the given position in history. Its first twelve
+        characters (the short node) encode the position.
+    """
+    rewritten = self._rewritten_from is not None and index >= self._rewritten_from
+    return '%012x%s' % (index + 1, ('f' if rewritten else '0') * 28)
+
+  @staticmethod
+  def node_index(node):
+    """ Returns the position in history of the changeset with the given (short or raw) node. """
+    return int(node[:12], 16) - 1
+
+  def _changeset(self, index):
+    raw_node = self.node(index)
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.gmtime(_FIRST_CHANGESET_TIME + index * _CHANGESET_INTERVAL))
+    return {
+      'node': raw_node[:12],
+      'raw_node': raw_node,
+      'author': 'author%d' % (index % 17),
+      'raw_author': 'Author %d <author%d@example.com>' % (index % 17, index % 17),
+      'timestamp': timestamp,
+      'utctimestamp': timestamp + '+00:00',
+      'branch': 'master',
+      'message': 'Commit number %d' % index,
+      'revision': index,
+      'size': -1,
+      'parents': [self.node(index - 1)[:12]] if index else [],
+      'files': [{'type': 'modified', 'file': 'src/file%d.py' % ((index + offset) % 31)}
+                for offset in range(1 + index % 4)],
+    }
+
+  def _get_user(self, args, query, body):
+    return (200, {'user': {'username': 'stub', 'display_name': 'Stub User'}}, 'application/json')
+
+  def _get_user_repositories(self, args, query, body):
+    repositories = [{'owner': 'stub', 'slug': 'repo%d' % index, 'name': 'repo%d' % index}
+                    for index in range(10)]
+    return (200, repositories, 'application/json')
+
+  def _get_account(self, args, query, body):
+    if args['account'].startswith('unknown'):
+      return (404, {'error': 'not found'}, 'application/json')
+    if args['account'].startswith('failing'):
+      return (500, {'error': 'internal error'}, 'application/json')
+    return (200, {'user': {'username': args['account']}}, 'application/json')
+
+  def _get_main_branch(self, args, query, body):
+    return (200, {'name': 'master'}, 'application/json')
+
+  def _get_branches(self, args, query, body):
+    return (200, {'master': {'node': self.node(self.changeset_count - 1)[:12]}},
+            'application/json')
+
+  def _get_tags(self, args, query, body):
+    return (200, {'v1.0': {'node': self.node(0)[:12]}}, 'application/json')
+
+  def _get_branches_tags(self, args, query, body):
+    return (200, {'branches': [{'name': 'master', 'changeset': self.node(self.changeset_count - 1)}],
+                  'tags': [{'name': 'v1.0', 'changeset': self.node(0)}]}, 'application/json')
+
+  def _get_branch(self, args, query, body):
+    return (200, {'name': args.get('branch') or args.get('tag'),
+                  'target': {'hash': self.node(self.changeset_count - 1)}}, 'application/json')
+
+  def _list_changesets(self, args, query, body):
+    limit = min(int(query.get('limit', ['15'])[0]), self.max_page_size)
+    start = query.get('start', [None])[0]
+    end = self.changeset_count
+    if start is not None:
+      end = self.node_index(start) + 1
+
+    changesets = [self._changeset(index) for index in range(max(0, end - limit), end)]
+    return (200, {'count': self.changeset_count, 'start': start, 'limit': limit,
+                  'changesets': changesets}, 'application/json')
+
+  def _get_changeset(self, args, query, body):
+    index = self.node_index(args['node'])
+    if not 0 <= index < self.changeset_count:
+      return (404, {'error': 'not found'}, 'application/json')
+    return (200, self._changeset(index), 'application/json')
+
+  def _get_manifest(self, args, query, body):
+    return (200, dict(('src/file%d.py' % index, self.node(index)) for index in range(31)),
+            'application/json')
+
+  def _get_src(self, args, query, body):
+    directory = args['path']
+    if directory.endswith('/') or not directory:
+      subdirectories = []
+      if directory.count('/') < self.tree_depth:
+        subdirectories = ['dir%d' % index for index in range(self.tree_fanout)]
+      return (200, {'node': args['revision'][:12], 'path': directory,
+                    'directories': subdirectories,
+                    'files': [{'path': '%sfile%d.py' % (directory, index),
+                               'size': self.payload_size, 'revision': self.node(index)[:12]}
+                              for index in range(31)]}, 'application/json')
+
+    if directory.endswith('.txt'):
+      # Served as text without a charset, which HTTP clients would otherwise guess.
+      return (200, u'h\u00e9llo\n'.encode('utf-8'), 'text/plain')
+
+    return (200, {'node': args['revision'], 'path': args['path'],
+                  'data': self._payload.decode('ascii'), 'size': self.payload_size},
+            'application/json')
+
+  def _get_raw(self, args, query, body):
+    return (200, self._payload, 'application/octet-stream')
+
+  def _list_webhooks(self, args, query, body):
+    with self._lock:
+      hooks = [hook for (key, hook) in self._webhooks.items() if key[:2] == (args['ns'],
+                                                                            args['repo'])]
+
+    page = int(query.get('page', ['1'])[0])
+    start = (page - 1) * self.webhook_page_size
+    response = {'values': hooks[start:start + self.webhook_page_size], 'page': page,
+                'pagelen': self.webhook_page_size, 'size': len(hooks)}
+    if start + self.webhook_page_size < len(hooks):
+      response['next'] = '%s?page=%s' % (repository_webhooks_url(args['ns'], args['repo']),
+                                         page + 1)
+    return (200, response, 'application/json')
+
+  def _create_webhook(self, args, query, body):
+    hook = json.loads(body.decode('utf-8'))
+    hook['uuid'] = '{%s}' % uuid.uuid4()
+    with self._lock:
+      self._webhooks[(args['ns'], args['repo'], hook['uuid'])] = hook
+    return (201, hook, 'application/json')
+
+  def _get_webhook(self, args, query, body):
+    with self._lock:
+      hook = self._webhooks.get((args['ns'], args['repo'], args['uuid']))
+    if hook is None:
+      return (404, {'error': 'not found'}, 'application/json')
+    return (200, hook, 'application/json')
+
+  def _update_webhook(self, args, query, body):
+    key = (args['ns'], args['repo'], args['uuid'])
+    with self._lock:
+      if key not in self._webhooks:
+        return (404, {'error': 'not found'}, 'application/json')
+      hook = json.loads(body.decode('utf-8'))
+      hook['uuid'] = args['uuid']
+      self._webhooks[key] = hook
+    return (200, hook, 'application/json')
+
+  def _delete_webhook(self, args, query, body):
+    with self._lock:
+      hook = self._webhooks.pop((args['ns'], args['repo'], args['uuid']), None)
+    return (204 if hook is not None else 404, b'', 'application/json')
+
+  def _list_deploy_keys(self, args, query, body):
+    with self._lock:
+      keys = [key for (lookup, key) in self._deploy_keys.items() if lookup[:2] == (args['ns'],
+                                                                                  args['repo'])]
+    return (200, keys, 'application/json')
+
+  def _create_deploy_key(self, args, query, body):
+    form = parse_qs(body.decode('utf-8'))
+    label = form.get('label', [''])[0]
+    material = form.get('key', [''])[0]
+    with self._lock:
+      taken = any(lookup[:2] == (args['ns'], args['repo']) and key['key'] == material
+                  for (lookup, key) in self._deploy_keys.items())
+      if taken or label.startswith('invalid'):
+        return (400, {'error': 'invalid deploy key'}, 'application/json')
+
+      key_id = self._next_key_id
+      self._next_key_id += 1
+      key = {'pk': key_id, 'label': label, 'key': material}
+      self._deploy_keys[(args['ns'], args['repo'], str(key_id))] = key
+    return (200, key, 'application/json')
+
+  def _get_deploy_key(self, args, query, body):
+    with self._lock:
+      key = self._deploy_keys.get((args['ns'], args['repo'], args['key_id']))
+    if key is None:
+      return (404, {'error': 'not found'}, 'application/json')
+    return (200, key, 'application/json')
+
+  def _delete_deploy_key(self, args, query, body):
+    with self._lock:
+      key = self._deploy_keys.pop((args['ns'], args['repo'], args['key_id']), None)
+    return (204 if key is not None else 404, b'', 'application/json')
+
+  def _list_empty(self, args, query, body):
+    return (200, [], 'application/json')
@@ -0,0 +1,87 @@
+""" Micro-benchmark of the CPU time spent building file URLs, as done when crawling a repository.
+    Compares the route table of `bitbucket.urls` with plain `%` formatting, both without any
+    quoting (the previous, incorrect behaviour) and with every component quoted. Also measures
+    the reverse lookup of the built URLs.
+
+    python -m benchmarks.urls [--paths N] [--unicode-ratio R]
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from urllib.parse import quote
+
+from bitbucket.urls import repository_path_contents_url, url_template
+
+_BASE_URL_V1 = 'https://bitbucket.org/!api/1.0/%s'
+
+
+def _unquoted_url(namespace, repository, revision, path):
+  """ Builds a URL the way `bitbucket.urls` used to, with nested formatting and no quoting. """
+  return _BASE_URL_V1 % ('repositories/%s/%s/src/%s/%s' % (namespace, repository, revision, path))
+
+
+def _quoted_url(namespace, repository, revision, path):
+  """ Builds a URL with nested formatting, quoting every component. """
+  return _BASE_URL_V1 % ('repositories/%s/%s/src/%s/%s' % (quote(namespace, safe=''),
+                                                           quote(repository, safe=''),
+                                                           quote(revision, safe=''),
+                                                           quote(path, safe='/')))
+
+
+def _make_paths(count, unicode_ratio):
+  """ Returns `count` file paths, a `unicode_ratio` fraction of which need quoting. """
+  unicode_every = int(1 / unicode_ratio) if unicode_ratio else 0
+  paths = []
+  for index in range(count):
+    if unicode_every and index % unicode_every == 0:
+      paths.append(u'src/módulo %d/fichier été %d.py' % (index // 1000, index))
+    else:
+      paths.append('src/module%d/file%d.py' % (index // 1000, index))
+  return paths
+
+
+def _measure(build, paths):
+  """ Returns the CPU seconds per URL spent building the URLs of all the paths. """
+  revision = '0123456789abcdef0123456789abcdef01234567'
+  started = time.process_time()
+  for path in paths:
+    build('namespace', 'repository', revision, path)
+  return (time.process_time() - started) / len(paths)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmarks building file URLs.')
+  parser.add_argument('--paths', type=int, default=1000000, help='Number of file paths')
+  parser.add_argument('--unicode-ratio', type=float, default=0.1,
+                      help='Fraction of the paths containing spaces and non-ASCII characters')
+  args = parser.parse_args(argv)
+
+  paths = _make_paths(args.paths, args.unicode_ratio)
+
+  unquoted = _measure(_unquoted_url, paths)
+  quoted = _measure(_quoted_url, paths)
+  routes = _measure(repository_path_contents_url, paths)
+
+  lookups = [repository_path_contents_url('namespace', 'repository', 'default', path)
+             for path in paths[:min(len(paths), 100000)]]
+  started = time.process_time()
+  for url in lookups:
+    url_template(url)
+  lookup = (time.process_time() - started) / len(lookups)
+
+  results = {
+    'paths': args.paths,
+    'unicode_ratio': args.unicode_ratio,
+    'unquoted_format_cpu_per_url': unquoted,
+    'quoted_format_cpu_per_url': quoted,
+    'route_table_cpu_per_url': routes,
+    'reverse_lookup_cpu_per_url': lookup,
+  }
+  sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+  main()
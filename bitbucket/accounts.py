@@ -1,18 +1,28 @@
 """ Defines a client class for working with the accounts API. """
 
+from bitbucket.profiles import ProfileResolver
 from bitbucket.urls import account_profile_url
+from bitbucket.context import BitBucketContext, ContextClient
 
-class BitBucketAccountsClient(object):
+class BitBucketAccountsClient(ContextClient):
   """ A client for talking to the BitBucket accounts API. """
+  __slots__ = ()
+
   def __init__(self, dispatcher, access_token, access_token_secret):
-    self._dispatcher = dispatcher
-    self._access_token = access_token
-    self._access_token_secret = access_token_secret
+    self._attach(BitBucketContext(dispatcher, access_token, access_token_secret))
 
   def get_profile(self, accountname_or_email):
     """ Returns profile information for the account matching the given account name or email
         address.
     """
     url = account_profile_url(accountname_or_email)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    return self._context.dispatch(url)
+
+  def resolver(self, ttl=3600, negative_ttl=300, max_entries=10000, store=None, max_workers=8):
+    """ Returns a `ProfileResolver` caching the profiles fetched through this client, for
+        `ttl` seconds (or `negative_ttl` seconds for accounts which do not exist). Only usable
+        with the blocking `BitBucket` dispatcher.
+    """
+    self._context.require_blocking('resolver')
+    return ProfileResolver(self, ttl=ttl, negative_ttl=negative_ttl, max_entries=max_entries,
+                           store=store, max_workers=max_workers)
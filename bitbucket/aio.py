@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+""" Defines an asyncio based dispatcher for the BitBucket API, along with an ASGI adapter for the
+    webhook receiver. Requires aiohttp (Python 3 only).
+
+    The resource clients only ever return the result of their dispatcher's `dispatch` method, so
+    when they are created from an `AsyncBitBucket` every resource method returns an awaitable
+    that resolves to the usual `(ok, data, error)` tuple:
+
+      async with AsyncBitBucket(key, secret, callback_url) as bb:
+        client = bb.get_authorized_client(token, token_secret)
+        (result, data, error_msg) = await client.get_current_user()
+
+    Helpers which make several requests or rely on threads (`iter_all`, `bulk`, `batch`,
+    `snapshot`, `download_raw_path_contents`, `analyze`, `resolver`, `reconcile`, `mirror`)
+    raise a BitBucketError when used with an `AsyncBitBucket`.
+"""
+
+import asyncio
+import contextlib
+import json
+
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlencode
+
+import aiohttp
+
+from oauthlib.oauth1 import Client as OAuth1Client
+
+from bitbucket.coalesce import SingleFlightCounters, coalescing_key
+from bitbucket.errors import BitBucketError, ResponseError
+from bitbucket.receiver import STATUS_METHOD_NOT_ALLOWED, STATUS_TOO_LARGE
+from bitbucket.urls import request_token_url, authenticate_url, access_token_url
+from bitbucket.client import BitBucketClient
+from bitbucket.toplevel import STREAM_CHUNK_SIZE
+
+
+async def _iter_response_chunks(response):
+  """ Yields the body of a streamed response in chunks, releasing the response once done. """
+  try:
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+      yield chunk
+  except aiohttp.ClientError as cex:
+    raise BitBucketError('Exception when reading from BitBucket: %s' % cex)
+  finally:
+    response.release()
+
+
+class AsyncSingleFlight(SingleFlightCounters):
+  """ asyncio counterpart of `bitbucket.coalesce.SingleFlight`: while a coroutine is in flight
+      under a key, callers awaiting an identical one share its result. The shared coroutine runs
+      as a task of its own, so cancelling one of its callers does not cancel it for the others.
+  """
+  def __init__(self):
+    super(AsyncSingleFlight, self).__init__()
+    self._calls = {}
+
+  async def do(self, key, function, *args):
+    """ Returns the result of awaiting `function(*args)`, or of the identical call in flight
+        under `key`, if any.
+    """
+    self.calls += 1
+    task = self._calls.get(key)
+    if task is None:
+      task = asyncio.ensure_future(function(*args))
+      self._calls[key] = task
+      task.add_done_callback(lambda _: self._calls.pop(key, None))
+      self.executed += 1
+    else:
+      self.coalesced += 1
+
+    return await asyncio.shield(task)
+
+
+class AsyncBitBucket(object):
+  """ asyncio counterpart of `BitBucket`. All clients created from an instance share a single
+      aiohttp connection pool of `pool_maxsize` connections (at most `pool_maxsize_per_host` to
+      any one host), and at most `max_concurrency` requests are in flight for any given access
+      token at a time. Duplicate in-flight GETs are coalesced when a `single_flight` (see
+      `AsyncSingleFlight`) is given. As with `BitBucket`, the OAuth signers of the last
+      `max_signers` credentials used are reused.
+  """
+  # Results are only available once awaited, so the content cache is not supported.
+  content_cache = None
+  is_async = True
+
+  def __init__(self, consumer_key, consumer_secret, callback_url, timeout=None,
+               pool_maxsize=100, pool_maxsize_per_host=10, max_concurrency=10,
+               single_flight=None, max_signers=1024):
+    self._consumer_key = consumer_key
+    self._consumer_secret = consumer_secret
+    self._callback_url = callback_url
+    self._timeout = timeout
+    self._pool_maxsize = pool_maxsize
+    self._pool_maxsize_per_host = pool_maxsize_per_host
+    self._max_concurrency = max_concurrency
+    self._single_flight = single_flight
+    self._max_signers = max_signers
+
+    self._session = None
+    self._semaphores = {}
+    self._signers = OrderedDict()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+
+  async def close(self):
+    """ Closes the pooled HTTP session, if any. """
+    session = self._session
+    self._session = None
+    if session is not None:
+      await session.close()
+
+  def _get_session(self):
+    """ Returns the shared aiohttp session, creating it on first use. Must be called from within
+        the running event loop.
+    """
+    if self._session is None or self._session.closed:
+      connector = aiohttp.TCPConnector(limit=self._pool_maxsize,
+                                       limit_per_host=self._pool_maxsize_per_host)
+      self._session = aiohttp.ClientSession(connector=connector,
+                                            timeout=aiohttp.ClientTimeout(total=self._timeout),
+                                            cookie_jar=aiohttp.DummyCookieJar())
+    return self._session
+
+  def _get_signer(self, access_token, access_token_secret):
+    """ Returns the OAuth signer for the given access token and secret, creating it if needed.
+        Signers generate a fresh nonce and timestamp for every request they sign, so they can be
+        shared between requests. Only called from the event loop, so no lock is needed.
+    """
+    key = (access_token, access_token_secret)
+    signer = self._signers.pop(key, None)
+    if signer is None:
+      signer = OAuth1Client(self._consumer_key, client_secret=self._consumer_secret,
+                            resource_owner_key=access_token,
+                            resource_owner_secret=access_token_secret)
+
+    self._signers[key] = signer
+    if len(self._signers) > self._max_signers:
+      self._signers.popitem(last=False)
+
+    return signer
+
+  @contextlib.asynccontextmanager
+  async def _token_slot(self, access_token):
+    """ Holds one of the `max_concurrency` request slots of the token. The semaphore of a
+        token is only kept while it has requests in flight or waiting.
+    """
+    entry = self._semaphores.get(access_token)
+    if entry is None:
+      entry = self._semaphores[access_token] = [asyncio.Semaphore(self._max_concurrency), 0]
+
+    entry[1] += 1
+    try:
+      async with entry[0]:
+        yield
+    finally:
+      entry[1] -= 1
+      if not entry[1]:
+        del self._semaphores[access_token]
+
+  async def map_result(self, result, function):
+    """ Returns `function` applied to the awaited result tuple. """
+    return function(await result)
+
+  def get_authorized_client(self, access_token, access_token_secret):
+    """ Returns a client for talking to an authorized endpoint. All resource methods of the
+        returned client tree are awaitable.
+    """
+    return BitBucketClient(self, access_token, access_token_secret)
+
+  async def _send(self, method, url, oauth, params=None, data=None, json_body=False,
+                  stream=False, raw=False):
+    """ Signs and sends a request, returning a tuple of the status code, reason and body text.
+        If `stream` is True, the body of a successful response is returned as an async iterator
+        of byte chunks instead, and if `raw` is True as bytes.
+    """
+    if params:
+      query = urlencode([(key, value) for (key, value) in params.items() if value is not None])
+      if query:
+        url = url + ('&' if '?' in url else '?') + query
+
+    headers = {}
+    body = None
+    if json_body:
+      (url, headers, _) = oauth.sign(url, http_method=method)
+      headers['Content-Type'] = 'application/json'
+      body = json.dumps(data)
+    elif data:
+      body = urlencode(data)
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+      (url, headers, body) = oauth.sign(url, http_method=method, body=body, headers=headers)
+    else:
+      (url, headers, _) = oauth.sign(url, http_method=method)
+
+    session = self._get_session()
+    response = await session.request(method, url, data=body, headers=headers)
+    if stream and response.status // 100 == 2:
+      return (response.status, response.reason, _iter_response_chunks(response))
+
+    try:
+      if raw and response.status // 100 == 2:
+        text = await response.read()
+      else:
+        text = await response.text()
+    finally:
+      response.release()
+
+    return (response.status, response.reason, text)
+
+  @property
+  def single_flight(self):
+    """ Returns the single-flight coalescer of duplicate in-flight GETs, if any. """
+    return self._single_flight
+
+  async def dispatch(self, api_url, access_token, access_token_secret, method='GET', params=None,
+                     json_body=False, stream=False, raw=False, **kwargs):
+    """ Dispatches a signed request to the given URL, with the given access token and secret.
+        If `stream` is True, the body of a successful response is returned as an async iterator
+        of its raw byte chunks, and if `raw` is True as undecoded bytes.
+    """
+    single_flight = self._single_flight
+    if single_flight is not None and method == 'GET' and not stream:
+      key = coalescing_key(api_url, access_token, access_token_secret, params, raw)
+      return await single_flight.do(key, self._dispatch, api_url, access_token,
+                                    access_token_secret, method, params, json_body, stream, raw,
+                                    kwargs)
+
+    return await self._dispatch(api_url, access_token, access_token_secret, method, params,
+                                json_body, stream, raw, kwargs)
+
+  async def _dispatch(self, api_url, access_token, access_token_secret, method, params,
+                      json_body, stream, raw, data):
+    """ Performs the work of `dispatch`. """
+    oauth = self._get_signer(access_token, access_token_secret)
+
+    try:
+      async with self._token_slot(access_token):
+        (status_code, error, text) = await self._send(method, api_url, oauth, params=params,
+                                                      data=data, json_body=json_body,
+                                                      stream=stream, raw=raw)
+    except asyncio.TimeoutError:
+      return (False, None, 'Timeout when contacting BitBucket')
+    except aiohttp.ClientError as cex:
+      return (False, None, 'Exception when contacting BitBucket: %s' % cex)
+
+    # 200-299: OK.
+    if status_code // 100 == 2:
+      if stream or raw:
+        return (True, text, None)
+
+      try:
+        return (True, json.loads(text or ''), None)
+      except TypeError:
+        pass
+      except ValueError:
+        pass
+
+      return (True, text, None)
+
+    return (False, None, ResponseError(error, status_code))
+
+  async def _post_for_token(self, url, oauth):
+    """ Posts to one of the OAuth token endpoints, returning the token and secret found. """
+    try:
+      (status_code, _, text) = await self._send('POST', url, oauth)
+    except asyncio.TimeoutError:
+      return (False, None, 'Timeout when contacting BitBucket')
+    except aiohttp.ClientError as cex:
+      return (False, None, 'Exception when contacting BitBucket: %s' % cex)
+
+    if status_code == 200:
+      credentials = parse_qs(text)
+      token = (credentials.get('oauth_token')[0], credentials.get('oauth_token_secret')[0])
+      return (True, token, None)
+
+    return (False, None, text)
+
+  async def get_authorization_url(self):
+    """ Returns the URL for requesting OAuth authorization for the client, along with the
+        access token and access token secret for the authorization. See
+        `BitBucket.get_authorization_url`.
+    """
+    oauth = OAuth1Client(self._consumer_key, client_secret=self._consumer_secret,
+                         callback_uri=self._callback_url)
+
+    (status, token, error) = await self._post_for_token(request_token_url(), oauth)
+    if not status:
+      return (False, None, error)
+
+    data = {
+      'url': authenticate_url(token[0]),
+      'access_token': token[0],
+      'access_token_secret': token[1]
+    }
+
+    return (True, data, None)
+
+  async def verify_token(self, access_token, access_token_secret, verifier):
+    """ Exchanges the verifier for a new access token and secret which can be used to make
+        requests.
+    """
+    oauth = OAuth1Client(self._consumer_key, client_secret=self._consumer_secret,
+                         resource_owner_key=access_token,
+                         resource_owner_secret=access_token_secret, verifier=verifier)
+    return await self._post_for_token(access_token_url(), oauth)
+
+
+def asgi_webhook_app(receiver):
+  """ Returns an ASGI application handing webhook deliveries to the given
+      `bitbucket.receiver.WebhookReceiver`. Queueing never blocks, so deliveries are
+      acknowledged (or refused when the receiver is overloaded) without waiting for the workers.
+  """
+  async def app(scope, receive, send):
+    if scope['type'] != 'http':
+      return
+
+    if scope['method'] != 'POST':
+      status = STATUS_METHOD_NOT_ALLOWED
+    else:
+      body = bytearray()
+      while True:
+        message = await receive()
+        body.extend(message.get('body', b''))
+        if len(body) > receiver.max_body_size:
+          status = STATUS_TOO_LARGE
+          break
+
+        if not message.get('more_body'):
+          headers = dict((key.decode('latin-1').lower(), value.decode('latin-1'))
+                         for (key, value) in scope['headers'])
+          status = receiver.receive(headers, bytes(body))
+          break
+
+    await send({
+      'type': 'http.response.start',
+      'status': int(status.split(' ', 1)[0]),
+      'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                  for (key, value) in receiver.response_headers(status)],
+    })
+    await send({'type': 'http.response.body', 'body': b''})
+
+  return app
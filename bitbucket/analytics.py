@@ -0,0 +1,202 @@
+""" Defines the changeset analytics pipeline, which streams the changesets of a repository into
+    columnar batches and aggregates them (commits per author, histogram of the number of files
+    touched per changeset, activity over time) on a pool of processes. NumPy is used for the
+    aggregation when it is installed.
+
+      (result, stats, error) = repository.changesets().analyze(processes=4)
+      stats.authors.most_common(10)
+      stats.activity_series()
+"""
+
+import calendar
+import multiprocessing
+
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+class ChangesetBatch(object):
+  """ A batch of changesets stored as columns: the author, the UTC timestamp (as returned by the
+      API, e.g. `2015-01-01 00:00:00+00:00`, or '' if unknown) and the number of files touched
+      of each changeset. The latter is a NumPy array when NumPy is installed.
+  """
+  __slots__ = ('authors', 'timestamps', 'file_counts')
+
+  def __init__(self, authors, timestamps, file_counts):
+    self.authors = authors
+    self.timestamps = timestamps
+    if numpy is not None:
+      self.file_counts = numpy.array(file_counts, dtype=numpy.int32)
+    else:
+      self.file_counts = array('i', file_counts)
+
+  def __len__(self):
+    return len(self.authors)
+
+
+def iter_batches(changesets, batch_size=10000):
+  """ Yields the given changesets (dictionaries, as returned by the changesets API) in
+      ChangesetBatches of `batch_size` changesets.
+  """
+  authors = []
+  timestamps = []
+  file_counts = []
+  for changeset in changesets:
+    authors.append(changeset.get('author') or changeset.get('raw_author'))
+    timestamps.append(changeset.get('utctimestamp') or changeset.get('timestamp') or '')
+    file_counts.append(len(changeset.get('files') or ()))
+    if len(authors) >= batch_size:
+      yield ChangesetBatch(authors, timestamps, file_counts)
+      authors = []
+      timestamps = []
+      file_counts = []
+
+  if authors:
+    yield ChangesetBatch(authors, timestamps, file_counts)
+
+
+class ChangesetStats(object):
+  """ Aggregated statistics of changesets: their number, the number of changesets per author
+      (`authors`), the number of changesets per number of files touched (`files_touched`) and
+      the number of changesets per period of `bucket_seconds` seconds, keyed by the UTC epoch
+      second the period starts at (`activity`). Statistics of disjoint sets of changesets are
+      combined with `merge`.
+  """
+  def __init__(self, bucket_seconds=86400):
+    self.bucket_seconds = bucket_seconds
+    self.changesets = 0
+    self.authors = Counter()
+    self.files_touched = Counter()
+    self.activity = Counter()
+
+  def merge(self, other):
+    """ Adds the statistics of other changesets to these, returning them. """
+    self.changesets += other.changesets
+    self.authors.update(other.authors)
+    self.files_touched.update(other.files_touched)
+    self.activity.update(other.activity)
+    return self
+
+  def activity_series(self):
+    """ Returns the list of `(period_start, changesets)` of the activity, in chronological
+        order, including the periods without any changeset.
+    """
+    if not self.activity:
+      return []
+
+    first = min(self.activity)
+    last = max(self.activity)
+    return [(start, self.activity.get(start, 0))
+            for start in range(first, last + self.bucket_seconds, self.bucket_seconds)]
+
+  def to_dict(self):
+    """ Returns the statistics as a dictionary which can be serialized to JSON. """
+    return {
+      'changesets': self.changesets,
+      'bucket_seconds': self.bucket_seconds,
+      'authors': dict(self.authors),
+      'files_touched': dict((str(count), total) for (count, total)
+                            in self.files_touched.items()),
+      'activity': self.activity_series(),
+    }
+
+
+def _epoch_seconds(timestamps):
+  """ Returns the UTC epoch seconds of the given timestamps, skipping the unknown ones. """
+  if numpy is not None:
+    parsed = numpy.array([timestamp[:10] + 'T' + timestamp[11:19] if timestamp else 'NaT'
+                          for timestamp in timestamps], dtype='datetime64[s]')
+    return parsed[~numpy.isnat(parsed)].astype(numpy.int64)
+
+  # Changesets come in bursts on the same days, so the start of each day is only computed once.
+  day_starts = {}
+  seconds = []
+  for timestamp in timestamps:
+    if not timestamp:
+      continue
+
+    day = timestamp[:10]
+    day_start = day_starts.get(day)
+    if day_start is None:
+      day_start = day_starts[day] = calendar.timegm((int(day[:4]), int(day[5:7]), int(day[8:10]),
+                                                     0, 0, 0, 0, 0, 0))
+    seconds.append(day_start + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 +
+                   int(timestamp[17:19]))
+  return seconds
+
+
+def aggregate_batch(batch, bucket_seconds=86400):
+  """ Returns the ChangesetStats of a ChangesetBatch. """
+  stats = ChangesetStats(bucket_seconds)
+  stats.changesets = len(batch)
+  stats.authors.update(batch.authors)
+
+  seconds = _epoch_seconds(batch.timestamps)
+  if numpy is not None:
+    (starts, counts) = numpy.unique(seconds - seconds % bucket_seconds, return_counts=True)
+    stats.activity.update(dict(zip(starts.tolist(), counts.tolist())))
+
+    totals = numpy.bincount(batch.file_counts)
+    touched = numpy.nonzero(totals)[0]
+    stats.files_touched.update(dict(zip(touched.tolist(), totals[touched].tolist())))
+  else:
+    stats.activity.update(second - second % bucket_seconds for second in seconds)
+    stats.files_touched.update(batch.file_counts)
+
+  return stats
+
+
+class AnalyticsPipeline(object):
+  """ Aggregates streams of changesets in batches of `batch_size` changesets, which are handed
+      to a pool of `processes` processes (by default, one per CPU) while the next batches are
+      being read. At most `max_pending` batches (by default, twice the number of processes) are
+      queued at a time, bounding memory use. With `processes=0`, batches are aggregated in the
+      calling process.
+  """
+  def __init__(self, batch_size=10000, processes=None, bucket_seconds=86400, max_pending=None):
+    self._batch_size = batch_size
+    self._processes = processes
+    self._bucket_seconds = bucket_seconds
+    self._max_pending = max_pending
+
+  def run(self, changesets):
+    """ Returns the ChangesetStats of the given changesets (an iterable of dictionaries, as
+        returned by the changesets API).
+    """
+    return self.run_batches(iter_batches(changesets, self._batch_size))
+
+  def run_batches(self, batches):
+    """ Returns the ChangesetStats of the changesets of the given ChangesetBatches. """
+    stats = ChangesetStats(self._bucket_seconds)
+    if self._processes == 0:
+      for batch in batches:
+        stats.merge(aggregate_batch(batch, self._bucket_seconds))
+      return stats
+
+    processes = self._processes or multiprocessing.cpu_count()
+    max_pending = self._max_pending or 2 * processes
+    executor = ProcessPoolExecutor(max_workers=processes)
+    pending = set()
+    try:
+      for batch in batches:
+        if len(pending) >= max_pending:
+          (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+          for future in done:
+            stats.merge(future.result())
+
+        pending.add(executor.submit(aggregate_batch, batch, self._bucket_seconds))
+
+      for future in pending:
+        stats.merge(future.result())
+    finally:
+      for future in pending:
+        future.cancel()
+      executor.shutdown(wait=True)
+
+    return stats
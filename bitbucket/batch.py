@@ -0,0 +1,157 @@
+""" Defines batches, which record calls made through a client and then send them concurrently.
+
+      with repository.batch() as batch:
+        main_branch = batch.get_main_branch()
+        hooks = batch.webhooks().all()
+        branch = batch.then(main_branch,
+                            lambda data: repository.get_branch(data['name']))
+
+      (result, data, error) = branch.result()
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from bitbucket.errors import BitBucketError
+
+
+class BatchFuture(Future):
+  """ The future result tuple of a call recorded by a batch. Available once the batch has run. """
+  def __iter__(self):
+    # Guards against unpacking the result while the batch is still being recorded.
+    raise BitBucketError('The result of a batched call is only available once the batch has run')
+
+
+class _BatchDispatcher(object):
+  """ A dispatcher which records the requests (and the reads through the content cache) made
+      while the batch is being recorded, and passes them through to the real dispatcher once it
+      has run.
+  """
+  def __init__(self, batch, dispatcher):
+    self._batch = batch
+    self._dispatcher = dispatcher
+
+  @property
+  def content_cache(self):
+    """ Returns the content cache of the real dispatcher, if any. """
+    return self._dispatcher.content_cache
+
+  def defer(self, function):
+    """ Records the call of the function, which makes its requests through this dispatcher, or
+        calls it right away once the batch has run. The cache is so only checked when the call
+        runs.
+    """
+    if not self._batch.recording:
+      return function()
+
+    return self._batch._record(function)
+
+  def dispatch(self, api_url, *args, **kwargs):
+    return self.defer(lambda: self._dispatcher.dispatch(api_url, *args, **kwargs))
+
+
+def _resolve(future, function, *args):
+  """ Resolves the future with the result of calling the function. """
+  if not future.set_running_or_notify_cancel():
+    return
+
+  try:
+    future.set_result(function(*args))
+  except Exception as ex:
+    future.set_exception(ex)
+
+
+class Batch(object):
+  """ Records the calls made through `client` (or through the batch itself, which forwards
+      attribute access to it) and, when the `with` block exits, sends them concurrently on a
+      pool of `max_workers` threads over the shared connection pool. Each recorded call returns
+      a BatchFuture of its result tuple.
+
+      `then` records a call depending on the result of another, which is made as soon as that
+      result is ready. Once the batch has run, calls made through its client are sent right
+      away. Methods which post-process their responses (e.g. with `typed=True`) cannot be
+      recorded.
+  """
+  def __init__(self, client_factory, dispatcher, max_workers=8):
+    self.client = client_factory(_BatchDispatcher(self, dispatcher))
+    self.recording = True
+    self._max_workers = max_workers
+    self._calls = []
+    self._futures = []
+    self._dependents = []
+
+  def __getattr__(self, name):
+    return getattr(self.client, name)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      self.recording = False
+      for future in self._futures:
+        future.cancel()
+      return
+
+    self.run()
+
+  def _record(self, function):
+    """ Records a call, returning its future result. """
+    future = BatchFuture()
+    self._calls.append((future, function))
+    self._futures.append(future)
+    return future
+
+  def then(self, future, function):
+    """ Records a call of `function` with the data of the result of `future` (another call of
+        the batch), returning its future result. The function must return a result tuple. If
+        the call it depends on fails, its result is returned instead.
+    """
+    dependent = BatchFuture()
+    self._dependents.append((future, dependent, function))
+    self._futures.append(dependent)
+    return dependent
+
+  def run(self):
+    """ Sends the recorded calls concurrently, returning once all of them are resolved. """
+    self.recording = False
+    executor = ThreadPoolExecutor(max_workers=self._max_workers)
+
+    def chain(dependent, function):
+      def call_with(parent):
+        if parent.cancelled() or parent.exception() is not None:
+          dependent.set_exception(parent.exception() if not parent.cancelled() else
+                                  BitBucketError('Batched call cancelled'))
+          return
+
+        (result, data, error) = parent.result()
+        if not result:
+          dependent.set_result((result, data, error))
+          return
+
+        executor.submit(_resolve, dependent, function, data)
+      return call_with
+
+    try:
+      for (future, dependent, function) in self._dependents:
+        future.add_done_callback(chain(dependent, function))
+
+      for (future, function) in self._calls:
+        executor.submit(_resolve, future, function)
+
+      # Dependent calls are submitted from callbacks, so wait for every future rather than
+      # for the executor.
+      wait(self._futures)
+    finally:
+      executor.shutdown(wait=True)
+
+  def results(self):
+    """ Returns the result tuples of all the calls, in the order they were recorded. Calls
+        which raised an exception are reported as failed.
+    """
+    results = []
+    for future in self._futures:
+      if future.exception() is not None:
+        results.append((False, None, str(future.exception())))
+      else:
+        results.append(future.result())
+    return results
@@ -0,0 +1,65 @@
+""" Defines the bulk executor used to run operations against many repositories concurrently. """
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+BulkResult = namedtuple('BulkResult', ['namespace', 'repository_name', 'operation', 'result',
+                                       'data', 'error'])
+
+
+def _resolve_operation(repository_client, operation):
+  """ Returns the callable performing the operation on the given repository client. Operations
+      are either callables taking the repository client, or the name of one of its methods,
+      with a dot separating a sub-client accessor from its method (e.g. `webhooks.all`).
+  """
+  if callable(operation):
+    return lambda: operation(repository_client)
+
+  target = repository_client
+  parts = operation.split('.')
+  for accessor in parts[:-1]:
+    target = getattr(target, accessor)()
+
+  return getattr(target, parts[-1])
+
+
+def _run_job(client, namespace, repository_name, operation):
+  """ Runs a single job, turning any exception raised into an error result. """
+  repository_client = client.for_namespace(namespace).repositories().get(repository_name)
+  try:
+    (result, data, error) = _resolve_operation(repository_client, operation)()
+  except Exception as ex:
+    return BulkResult(namespace, repository_name, operation, False, None, str(ex))
+
+  return BulkResult(namespace, repository_name, operation, result, data, error)
+
+
+def run_bulk(client, jobs, max_workers=8):
+  """ Runs the given `(namespace, repository_name, operation)` jobs on a pool of `max_workers`
+      threads and yields a BulkResult for each of them in completion order. At most twice as
+      many jobs as workers are queued at a time, so `jobs` may be a lazy iterable.
+  """
+  jobs = iter(jobs)
+  executor = ThreadPoolExecutor(max_workers=max_workers)
+  pending = set()
+
+  def submit_next():
+    for (namespace, repository_name, operation) in jobs:
+      pending.add(executor.submit(_run_job, client, namespace, repository_name, operation))
+      return True
+    return False
+
+  try:
+    while len(pending) < max_workers * 2 and submit_next():
+      pass
+
+    while pending:
+      (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        pending.remove(future)
+        submit_next()
+        yield future.result()
+  finally:
+    for future in pending:
+      future.cancel()
+    executor.shutdown(wait=False)
@@ -0,0 +1,310 @@
+""" Defines the conditional request (ETag / Last-Modified) cache which can be plugged into the
+    `BitBucket` dispatcher, along with its storage backends.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+
+class CachedResponse(object):
+  """ A successful GET response along with the validators returned for it. """
+  __slots__ = ('etag', 'last_modified', 'data')
+
+  def __init__(self, etag, last_modified, data):
+    self.etag = etag
+    self.last_modified = last_modified
+    self.data = data
+
+  def conditional_headers(self):
+    """ Returns the headers to send to revalidate this response. """
+    headers = {}
+    if self.etag:
+      headers['If-None-Match'] = self.etag
+    if self.last_modified:
+      headers['If-Modified-Since'] = self.last_modified
+    return headers
+
+
+class MemoryCacheStorage(object):
+  """ In-memory LRU storage holding at most `max_entries` responses. """
+  def __init__(self, max_entries=1024):
+    self._max_entries = max_entries
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    """ Returns the entry stored under the key, if any. """
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._entries[key] = entry
+      return entry
+
+  def set(self, key, entry):
+    """ Stores the entry under the key, evicting the least recently used entries if needed. """
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = entry
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    """ Removes all entries. """
+    with self._lock:
+      self._entries.clear()
+
+
+class DiskCacheStorage(object):
+  """ Storage keeping one JSON file per response under the given directory. When `max_bytes` is
+      given, the least recently used files are removed once the entries take more space than
+      that. The directory may be shared between processes.
+  """
+  def __init__(self, directory, max_bytes=None):
+    self._directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    self._max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._current_bytes = 0
+    if max_bytes is not None:
+      self._current_bytes = sum(size for (_, size, _) in self._entries())
+
+  def _path(self, key):
+    """ Returns the path of the file holding the entry for the key. """
+    return os.path.join(self._directory, key + '.json')
+
+  def _entries(self):
+    """ Returns a list of the `(last_used, size, path)` of the entry files. """
+    entries = []
+    for filename in os.listdir(self._directory):
+      if filename.endswith('.json'):
+        path = os.path.join(self._directory, filename)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+  def get_sized(self, key):
+    """ Returns a tuple of the entry stored under the key and the size of its file, if any. """
+    path = self._path(key)
+    try:
+      with open(path) as entry_file:
+        text = entry_file.read()
+      stored = json.loads(text)
+    except (IOError, OSError, ValueError):
+      return (None, 0)
+
+    if self._max_bytes is not None:
+      # The modification time tracks the last use, for evicting the least recently used files.
+      try:
+        os.utime(path, None)
+      except OSError:
+        pass
+
+    entry = CachedResponse(stored.get('etag'), stored.get('last_modified'), stored.get('data'))
+    return (entry, len(text))
+
+  def get(self, key):
+    """ Returns the entry stored under the key, if any. """
+    return self.get_sized(key)[0]
+
+  def set(self, key, entry):
+    """ Stores the entry under the key. The file is written atomically. """
+    path = self._path(key)
+    (handle, temp_path) = tempfile.mkstemp(suffix='.tmp', dir=self._directory)
+    try:
+      with os.fdopen(handle, 'w') as entry_file:
+        json.dump({'etag': entry.etag, 'last_modified': entry.last_modified, 'data': entry.data},
+                  entry_file)
+      size = os.path.getsize(temp_path)
+      os.rename(temp_path, path)
+    except Exception:
+      try:
+        os.remove(temp_path)
+      except OSError:
+        pass
+      raise
+
+    if self._max_bytes is not None:
+      with self._lock:
+        self._current_bytes += size
+        if self._current_bytes > self._max_bytes:
+          self._trim()
+
+  def _trim(self):
+    """ Removes the least recently used files until the entries fit in `max_bytes`. The usage
+        is recomputed from the directory, since other processes may share it. Must be called
+        with the lock held.
+    """
+    entries = sorted(self._entries())
+    total = sum(size for (_, size, _) in entries)
+    for (_, size, path) in entries:
+      if total <= self._max_bytes:
+        break
+
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      total -= size
+
+    self._current_bytes = total
+
+  def clear(self):
+    """ Removes all entries. """
+    for filename in os.listdir(self._directory):
+      if filename.endswith('.json'):
+        os.remove(os.path.join(self._directory, filename))
+    with self._lock:
+      self._current_bytes = 0
+
+
+class ConditionalRequestCache(object):
+  """ Cache of GET responses keyed by URL, query parameters and access token. Cached responses
+      are revalidated with `If-None-Match` / `If-Modified-Since` and their parsed body is reused
+      when BitBucket answers 304 Not Modified. Defaults to an in-memory LRU storage.
+  """
+  def __init__(self, storage=None):
+    self._storage = storage if storage is not None else MemoryCacheStorage()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  @property
+  def storage(self):
+    """ Returns the storage backend. """
+    return self._storage
+
+  @staticmethod
+  def cache_key(api_url, params, access_token):
+    """ Returns the storage key for a request. The access token is hashed into the key so it is
+        never written out by persistent storages.
+    """
+    key_parts = [access_token or '', api_url]
+    for (name, value) in sorted((params or {}).items()):
+      if value is not None:
+        key_parts.append('%s=%s' % (name, value))
+
+    return hashlib.sha256('\n'.join(key_parts).encode('utf-8')).hexdigest()
+
+  def lookup(self, key):
+    """ Returns the cached response for the key, if any. """
+    return self._storage.get(key)
+
+  def store(self, key, response_headers, data):
+    """ Stores the parsed body of a response if it carries any validators. """
+    etag = response_headers.get('ETag')
+    last_modified = response_headers.get('Last-Modified')
+    if etag or last_modified:
+      self._storage.set(key, CachedResponse(etag, last_modified, data))
+
+  def record_hit(self):
+    """ Counts a response served from the cache. """
+    with self._lock:
+      self.hits += 1
+
+  def record_miss(self):
+    """ Counts a GET response that had to be downloaded in full. """
+    with self._lock:
+      self.misses += 1
+
+  def stats(self):
+    """ Returns a dictionary of the hit and miss counters. """
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses}
+
+
+class ContentCache(object):
+  """ Cache of repository contents read at an immutable revision (a full commit hash), keyed by
+      the kind of read, namespace, repository, node and path. Entries are kept in memory up to
+      `max_bytes` of content (as sized by the response bodies they were read from); when a
+      `directory` is given, entries evicted from memory spill over to disk, up to
+      `max_disk_bytes`, instead of being dropped and are promoted back on their next read.
+      Entries are not keyed by credentials, so a cache must only be shared between users with the
+      same access to the repositories.
+  """
+  def __init__(self, max_bytes=64 * 1024 * 1024, directory=None,
+               max_disk_bytes=1024 * 1024 * 1024):
+    self._max_bytes = max_bytes
+    self._current_bytes = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self._disk = None
+    if directory:
+      self._disk = DiskCacheStorage(directory, max_bytes=max_disk_bytes)
+    self.hits = 0
+    self.misses = 0
+
+  @staticmethod
+  def cache_key(kind, namespace, repository_name, node, path):
+    """ Returns the key under which the given content is stored. """
+    key = '\n'.join([kind, namespace, repository_name, node, path or ''])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+  def get(self, key):
+    """ Returns a tuple of whether the key was found and the content stored under it. """
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._entries[key] = entry
+        self.hits += 1
+        return (True, entry[0])
+
+    if self._disk is not None:
+      (stored, size) = self._disk.get_sized(key)
+      if stored is not None:
+        self._put_in_memory(key, stored.data, size)
+        with self._lock:
+          self.hits += 1
+        return (True, stored.data)
+
+    with self._lock:
+      self.misses += 1
+    return (False, None)
+
+  def set(self, key, content, size=None):
+    """ Stores the content under the key. `size` is the size in bytes the content is accounted
+        for, typically the length of the response body it was decoded from; if not given, the
+        content is serialized to size it.
+    """
+    if size is None:
+      size = len(content) if isinstance(content, (bytes, str)) else len(json.dumps(content))
+    self._put_in_memory(key, content, size)
+
+  def _put_in_memory(self, key, content, size):
+    """ Adds the content to the memory tier, spilling the least recently used entries to disk
+        (or dropping them) until the tier fits in its byte budget again.
+    """
+    evicted = []
+    with self._lock:
+      previous = self._entries.pop(key, None)
+      if previous is not None:
+        self._current_bytes -= previous[1]
+
+      self._entries[key] = (content, size)
+      self._current_bytes += size
+      while self._current_bytes > self._max_bytes and self._entries:
+        (evicted_key, (evicted_content, evicted_size)) = self._entries.popitem(last=False)
+        self._current_bytes -= evicted_size
+        evicted.append((evicted_key, evicted_content))
+
+    if self._disk is not None:
+      for (evicted_key, evicted_content) in evicted:
+        self._disk.set(evicted_key, CachedResponse(None, None, evicted_content))
+
+  def stats(self):
+    """ Returns a dictionary of the hit and miss counters and the memory tier usage. """
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+              'bytes': self._current_bytes}
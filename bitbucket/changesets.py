@@ -1,35 +1,120 @@
 """ Defines a client class for working with a specific BitBucket repository's change set. """
 
+from concurrent.futures import ThreadPoolExecutor
+
+from bitbucket.errors import BitBucketError
+from bitbucket.models import Changeset, model_result, model_list_result
 from bitbucket.urls import repository_changesets_url, repository_changeset_url
+from bitbucket.context import BitBucketContext, ContextClient
 
-class BitBucketRepositoryChangeSetsClient(object):
+class BitBucketRepositoryChangeSetsClient(ContextClient):
   """ Client class representing the changesets under a repository in bitbucket. """
+  __slots__ = ()
+
   def __init__(self, dispatcher, access_token, access_token_secret, namespace, repository_name):
-    self._dispatcher = dispatcher
-    self._access_token = access_token
-    self._access_token_secret = access_token_secret
-    self._namespace = namespace
-    self._repository_name = repository_name
+    self._attach(BitBucketContext(dispatcher, access_token, access_token_secret, namespace,
+                                  repository_name))
 
   @property
   def namespace(self):
     """ Returns the namespace. """
-    return self._namespace
+    return self._context.namespace
 
   @property
   def repository_name(self):
     """ Returns the repository name. """
-    return self._repository_name
-
-  def list(self, start, limit=50):
-    """ Returns a list of the change sets found under the repository. """
-    url = repository_changesets_url(self._namespace, self._repository_name)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret,
-                                          params={'start': start, 'limit': limit})
-
-  def get(self, node_id):
-    """ Returns the contents of the specified changeset. """
-    url = repository_changeset_url(self._namespace, self._repository_name, node_id)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    return self._context.repository_name
+
+  def list(self, start, limit=50, typed=False):
+    """ Returns a list of the change sets found under the repository. If `typed` is True, the
+        list is returned as a lazily decoded sequence of `Changeset` models.
+    """
+    url = repository_changesets_url(self._context.namespace, self._context.repository_name)
+    if typed:
+      return self._context.dispatch_then(
+          url, lambda result: model_list_result(result, Changeset, items_key='changesets'),
+          params={'start': start, 'limit': limit}, raw=True)
+
+    return self._context.dispatch(url, params={'start': start, 'limit': limit})
+
+  def get(self, node_id, typed=False):
+    """ Returns the contents of the specified changeset, as a `Changeset` model if `typed` is
+        True.
+    """
+    url = repository_changeset_url(self._context.namespace, self._context.repository_name, node_id)
+    if typed:
+      return self._context.dispatch_then(url, lambda result: model_result(result, Changeset),
+                                         raw=True)
+
+    return self._context.dispatch(url)
+
+  def iter_all(self, since=None, page_size=50, prefetch=True):
+    """ Yields every changeset under the repository, newest first, retrieving `page_size`
+        changesets per request (or fewer, if the server returns smaller pages) so that only a
+        page or two is ever held in memory. If `since` is
+        given, iteration stops once the changeset with that node (short or raw) is reached; that
+        changeset is not yielded. When `prefetch` is True, the next page is requested in the
+        background while the current one is being consumed. Raises a BitBucketError if a page
+        cannot be retrieved. Only usable with the blocking `BitBucket` dispatcher.
+    """
+    self._context.require_blocking('iter_all')
+    return self._iter_all(since, page_size, prefetch)
+
+  def _iter_all(self, since, page_size, prefetch):
+    """ Yields the changesets for `iter_all`. """
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def request_page(start):
+      # Pages after the first also include the `start` changeset, so ask for one more.
+      limit = page_size if start is None else page_size + 1
+      if executor is None:
+        return lambda: self.list(start, limit=limit)
+      return executor.submit(self.list, start, limit=limit).result
+
+    try:
+      start = None
+      pending = request_page(start)
+      while pending is not None:
+        (result, data, error) = pending()
+        if not result:
+          raise BitBucketError(error)
+
+        # Pages are returned oldest first and, after the first, end with the `start` changeset
+        # which was already yielded as the oldest entry of the previous page.
+        changesets = data.get('changesets') or []
+        if start is not None and changesets and changesets[-1]['node'] == start:
+          changesets = changesets[:-1]
+
+        # The server may return fewer changesets than asked for, so the history only ends once a
+        # page has nothing older to add.
+        pending = None
+        if changesets:
+          start = changesets[0]['node']
+          pending = request_page(start)
+
+        for changeset in reversed(changesets):
+          if since is not None and since in (changeset.get('node'), changeset.get('raw_node')):
+            return
+
+          yield changeset
+    finally:
+      if executor is not None:
+        executor.shutdown(wait=False)
+
+  def analyze(self, since=None, page_size=50, batch_size=10000, processes=None,
+              bucket_seconds=86400):
+    """ Returns the `bitbucket.analytics.ChangesetStats` (commits per author, files touched per
+        changeset, activity per `bucket_seconds`) of every changeset under the repository, up
+        to `since` if given (see `iter_all`). Batches of `batch_size` changesets are aggregated
+        on a pool of `processes` processes while the next pages are being retrieved. Only usable
+        with the blocking `BitBucket` dispatcher.
+    """
+    self._context.require_blocking('analyze')
+    # Imported here so that clients which never analyze do not load the pipeline (and NumPy).
+    from bitbucket.analytics import AnalyticsPipeline
+    pipeline = AnalyticsPipeline(batch_size=batch_size, processes=processes,
+                                 bucket_seconds=bucket_seconds)
+    try:
+      return (True, pipeline.run(self.iter_all(since=since, page_size=page_size)), None)
+    except BitBucketError as bbe:
+      return (False, None, str(bbe))
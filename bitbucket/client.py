@@ -1,33 +1,88 @@
 """ Defines a client class for working with BitBucket with a set of auth credentials. """
 
+from bitbucket.context import BitBucketContext, ContextClient
+from bitbucket.models import Repository, model_list_result
 from bitbucket.urls import current_user_url, current_user_repos_url
 from bitbucket.namespace import BitBucketNamespaceClient
 from bitbucket.accounts import BitBucketAccountsClient
+from bitbucket.batch import Batch
+from bitbucket.bulk import run_bulk
+from bitbucket.mirror import MetadataMirror
+from bitbucket.reconcile import reconcile
 
-class BitBucketClient(object):
+class BitBucketClient(ContextClient):
   """ A client for talking to the BitBucket API. """
+  __slots__ = ('_accounts',)
+
   def __init__(self, dispatcher, access_token, access_token_secret):
-    self._dispatcher = dispatcher
-    self._access_token = access_token
-    self._access_token_secret = access_token_secret
+    self._attach(BitBucketContext(dispatcher, access_token, access_token_secret))
+
+  def _attach(self, context):
+    self._context = context
+    self._accounts = None
 
   def get_current_user(self):
     """ Returns information about the authorized user. """
     url = current_user_url()
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    return self._context.dispatch(url)
 
-  def get_visible_repositories(self):
-    """ Returns a list of all repositories visible to the authorized user. """
+  def get_visible_repositories(self, typed=False):
+    """ Returns a list of all repositories visible to the authorized user, as a lazily decoded
+        sequence of `Repository` models if `typed` is True.
+    """
     url = current_user_repos_url()
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    if typed:
+      return self._context.dispatch_then(
+          url, lambda result: model_list_result(result, Repository), raw=True)
+
+    return self._context.dispatch(url)
 
   def for_namespace(self, namespace):
     """ Returns a client for accessing information for the given user or team. """
-    return BitBucketNamespaceClient(self._dispatcher, self._access_token, self._access_token_secret,
-                                    namespace)
+    return BitBucketNamespaceClient.from_context(self._context.for_namespace(namespace))
 
   def accounts(self):
     """ Returns a client for accessing account information. """
-    return BitBucketAccountsClient(self._dispatcher, self._access_token, self._access_token_secret)
+    if self._accounts is None:
+      self._accounts = BitBucketAccountsClient.from_context(self._context)
+    return self._accounts
+
+  def batch(self, max_workers=8):
+    """ Returns a `Batch` recording the calls made through it (and the clients it returns) and
+        sending them concurrently when its `with` block exits. Only usable with the blocking
+        `BitBucket` dispatcher.
+    """
+    context = self._context
+    context.require_blocking('batch')
+    def client_factory(dispatcher):
+      return BitBucketClient(dispatcher, context.access_token, context.access_token_secret)
+    return Batch(client_factory, context.dispatcher, max_workers=max_workers)
+
+  def bulk(self, jobs, max_workers=8):
+    """ Runs the given `(namespace, repository_name, operation)` jobs concurrently on a bounded
+        thread pool, yielding a `BulkResult` for each job in completion order. An operation is
+        either the name of a repository client method (e.g. `get_main_branch` or
+        `webhooks.all`) or a callable taking the repository client and returning a result
+        tuple. All jobs share the dispatcher's connection pool, so `max_workers` should not
+        exceed its `pool_maxsize`. Only usable with the blocking `BitBucket` dispatcher.
+    """
+    self._context.require_blocking('bulk')
+    return run_bulk(self, jobs, max_workers=max_workers)
+
+  def reconcile(self, desired, dry_run=False, max_workers=8):
+    """ Reconciles the webhooks, deploy keys, links and services of repositories against the
+        `bitbucket.reconcile.DesiredState` given for each `(namespace, repository_name)` in
+        `desired`, applying only the changes needed. Returns a `RepositoryReport` per
+        repository; when `dry_run` is True, the changes are reported but not applied. Only
+        usable with the blocking `BitBucket` dispatcher.
+    """
+    self._context.require_blocking('reconcile')
+    return reconcile(self, desired, dry_run=dry_run, max_workers=max_workers)
+
+  def mirror(self, path=':memory:'):
+    """ Returns a `MetadataMirror` keeping the webhooks, deploy keys, links and services of the
+        repositories visible to this client in the SQLite database at `path`, for querying them
+        locally. Call its `refresh` method to fetch them.
+    """
+    self._context.require_blocking('mirror')
+    return MetadataMirror(self, path)
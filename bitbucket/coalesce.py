@@ -0,0 +1,96 @@
+""" Defines the single-flight coalescing of duplicate in-flight requests which can be plugged into
+    the `BitBucket` dispatcher (see `bitbucket.aio.AsyncSingleFlight` for its asyncio counterpart).
+"""
+
+import threading
+
+from bitbucket.errors import BitBucketError
+
+
+def coalescing_key(api_url, access_token, access_token_secret, params, raw):
+  """ Returns the key under which identical GET requests made with the same credentials are
+      coalesced.
+  """
+  params_key = tuple(sorted(params.items())) if params else None
+  return (api_url, access_token, access_token_secret, params_key, raw)
+
+
+class SingleFlightCounters(object):
+  """ Counters shared by the single-flight implementations. `calls` counts every call made,
+      `executed` those which actually ran and `coalesced` those which waited on the result of an
+      identical call already in flight.
+  """
+  def __init__(self):
+    self.calls = 0
+    self.executed = 0
+    self.coalesced = 0
+
+  def stats(self):
+    """ Returns a dictionary of the counters and the number of calls currently in flight. """
+    return {'calls': self.calls, 'executed': self.executed, 'coalesced': self.coalesced,
+            'in_flight': len(self._calls)}
+
+
+class _Call(object):
+  """ A call in flight, whose result is shared with the callers waiting on it. """
+  __slots__ = ('done', 'result', 'error')
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+class SingleFlight(SingleFlightCounters):
+  """ Coalesces concurrent calls sharing a key across threads: while a call is in flight, the
+      callers making an identical one wait for its result instead of running their own. The
+      result (or exception) is shared between all of them, so it must not be modified. When the
+      call is interrupted (raises a BaseException which is not an Exception), the callers which
+      waited on it get a BitBucketError.
+  """
+  def __init__(self):
+    super(SingleFlight, self).__init__()
+    self._calls = {}
+    self._lock = threading.Lock()
+
+  def do(self, key, function, *args):
+    """ Returns the result of `function(*args)`, or of the identical call in flight under
+        `key`, if any.
+    """
+    with self._lock:
+      self.calls += 1
+      call = self._calls.get(key)
+      if call is None:
+        call = self._calls[key] = _Call()
+        self.executed += 1
+        leader = True
+      else:
+        self.coalesced += 1
+        leader = False
+
+    if not leader:
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = function(*args)
+    except Exception as ex:
+      call.error = ex
+      raise
+    except BaseException as ex:
+      # Interruptions (e.g. KeyboardInterrupt) of the leader are not raised in the other callers'
+      # threads, which get an error instead of a missing result.
+      call.error = BitBucketError('The coalesced call was interrupted: %r' % ex)
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+    return call.result
+
+  def stats(self):
+    with self._lock:
+      return super(SingleFlight, self).stats()
@@ -0,0 +1,85 @@
+""" Defines the context shared by a tree of resource clients. """
+
+from bitbucket.errors import BitBucketError
+
+class BitBucketContext(object):
+  """ The dispatcher and credentials (and, further down the client tree, the namespace and
+      repository) that resource clients make their requests with. A single context instance is
+      shared by a client and all of the sub-clients it returns.
+  """
+  __slots__ = ('dispatcher', 'access_token', 'access_token_secret', 'namespace',
+               'repository_name')
+
+  def __init__(self, dispatcher, access_token, access_token_secret, namespace=None,
+               repository_name=None):
+    self.dispatcher = dispatcher
+    self.access_token = access_token
+    self.access_token_secret = access_token_secret
+    self.namespace = namespace
+    self.repository_name = repository_name
+
+  def for_namespace(self, namespace):
+    """ Returns a context for the given namespace with the same dispatcher and credentials. """
+    return BitBucketContext(self.dispatcher, self.access_token, self.access_token_secret,
+                            namespace)
+
+  def for_repository(self, repository_name):
+    """ Returns a context for the given repository under this context's namespace. """
+    return BitBucketContext(self.dispatcher, self.access_token, self.access_token_secret,
+                            self.namespace, repository_name)
+
+  def dispatch(self, api_url, **kwargs):
+    """ Dispatches a request to the given URL with this context's credentials. """
+    return self.dispatcher.dispatch(api_url, access_token=self.access_token,
+                                         access_token_secret=self.access_token_secret, **kwargs)
+
+  @property
+  def is_async(self):
+    """ Returns whether the dispatcher is asynchronous, i.e. returns awaitables. """
+    return getattr(self.dispatcher, 'is_async', False)
+
+  def dispatch_then(self, api_url, function, **kwargs):
+    """ Dispatches a request to the given URL and returns `function` applied to its result
+        tuple, or with an asynchronous dispatcher an awaitable of it.
+    """
+    result = self.dispatch(api_url, **kwargs)
+    if self.is_async:
+      return self.dispatcher.map_result(result, function)
+    return function(result)
+
+  def call(self, function):
+    """ Returns the result tuple of calling `function`, which makes its requests through this
+        context. A dispatcher which defers requests (such as a batch being recorded) defers the
+        whole call instead, returning its future result.
+    """
+    defer = getattr(self.dispatcher, 'defer', None)
+    if defer is not None:
+      return defer(function)
+    return function()
+
+  def require_blocking(self, feature):
+    """ Raises a BitBucketError if the dispatcher is asynchronous, for features which make
+        several requests (or use threads) and so only work with the blocking dispatcher.
+    """
+    if self.is_async:
+      raise BitBucketError('%s is not supported with an asynchronous dispatcher' % feature)
+
+
+class ContextClient(object):
+  """ The base of the resource clients, which make their requests through a BitBucketContext.
+      Clients are constructed from a dispatcher, credentials, namespace and repository as they
+      always were; the client tree creates its sub-clients with `from_context` instead, so that
+      they share their parent's context.
+  """
+  __slots__ = ('_context',)
+
+  @classmethod
+  def from_context(cls, context):
+    """ Returns a client making its requests through the given context. """
+    client = cls.__new__(cls)
+    client._attach(context)
+    return client
+
+  def _attach(self, context):
+    """ Sets the context of the client, resetting its memoized sub-clients. """
+    self._context = context
@@ -1,47 +1,55 @@
 """ Defines a client class for working with a specific BitBucket repository's deploy keys. """
 
+from bitbucket.models import DeployKey, model_result, model_list_result
 from bitbucket.urls import repository_deploy_keys_url, repository_deploy_key_url
+from bitbucket.context import BitBucketContext, ContextClient
 
-class BitBucketRepositoryDeployKeysClient(object):
+class BitBucketRepositoryDeployKeysClient(ContextClient):
   """ Client class representing the deploy keys under a repository in bitbucket. """
+  __slots__ = ()
+
   def __init__(self, dispatcher, access_token, access_token_secret, namespace, repository_name):
-    self._dispatcher = dispatcher
-    self._access_token = access_token
-    self._access_token_secret = access_token_secret
-    self._namespace = namespace
-    self._repository_name = repository_name
+    self._attach(BitBucketContext(dispatcher, access_token, access_token_secret, namespace,
+                                  repository_name))
 
   @property
   def namespace(self):
     """ Returns the namespace. """
-    return self._namespace
+    return self._context.namespace
 
   @property
   def repository_name(self):
     """ Returns the repository name. """
-    return self._repository_name
-
-  def all(self):
-    """ Returns a list of the deploy keys found under the repository. """
-    url = repository_deploy_keys_url(self._namespace, self._repository_name)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
-
-  def get(self, key_id):
-    """ Returns the contents of the specified deploy key. """
-    url = repository_deploy_key_url(self._namespace, self._repository_name, key_id)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    return self._context.repository_name
+
+  def all(self, typed=False):
+    """ Returns a list of the deploy keys found under the repository, as a lazily decoded
+        sequence of `DeployKey` models if `typed` is True.
+    """
+    url = repository_deploy_keys_url(self._context.namespace, self._context.repository_name)
+    if typed:
+      return self._context.dispatch_then(
+          url, lambda result: model_list_result(result, DeployKey), raw=True)
+
+    return self._context.dispatch(url)
+
+  def get(self, key_id, typed=False):
+    """ Returns the contents of the specified deploy key, as a `DeployKey` model if `typed` is
+        True.
+    """
+    url = repository_deploy_key_url(self._context.namespace, self._context.repository_name, key_id)
+    if typed:
+      return self._context.dispatch_then(url, lambda result: model_result(result, DeployKey),
+                                         raw=True)
+
+    return self._context.dispatch(url)
 
   def delete(self, key_id):
     """ Deletes the specified deploy key. """
-    url = repository_deploy_key_url(self._namespace, self._repository_name, key_id)
-    return self._dispatcher.dispatch(url, method='DELETE', access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    url = repository_deploy_key_url(self._context.namespace, self._context.repository_name, key_id)
+    return self._context.dispatch(url, method='DELETE')
 
   def create(self, label, contents):
     """ Creates a new deploy key. """
-    url = repository_deploy_keys_url(self._namespace, self._repository_name)
-    return self._dispatcher.dispatch(url, method='POST', access_token=self._access_token,
-                                     access_token_secret=self._access_token_secret,
-                                     label=label, key=contents)
+    url = repository_deploy_keys_url(self._context.namespace, self._context.repository_name)
+    return self._context.dispatch(url, method='POST', label=label, key=contents)
@@ -0,0 +1,22 @@
+""" Defines the exceptions raised by the helpers which cannot report errors as result tuples,
+    and the errors reported in result tuples for unsuccessful responses.
+"""
+
+class BitBucketError(Exception):
+  """ Raised when a call made on behalf of an iterator or other long-running helper fails. The
+      message is the error returned by the dispatcher.
+  """
+
+
+class ResponseError(str):
+  """ The error reported in the result tuple of a response with an unsuccessful status: the
+      reason of the response (or `Error: <status>` when it has none), which also carries the
+      HTTP `status_code`.
+  """
+  def __new__(cls, reason, status_code):
+    error = str.__new__(cls, reason or 'Error: %s' % status_code)
+    error.status_code = status_code
+    return error
+
+  def __getnewargs__(self):
+    return (str(self), self.status_code)
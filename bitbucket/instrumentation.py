@@ -0,0 +1,147 @@
+""" Defines the instrumentation hooks which can be plugged into the `BitBucket` dispatcher, along
+    with a built-in collector of per-endpoint latency histograms.
+"""
+
+import bisect
+import threading
+
+# Timed phases of a dispatched request, in the order they happen:
+#   wait: time spent blocked by the rate limiter (including retry backoff).
+#   sign: preparing and OAuth signing the request.
+#   connect: establishing a new connection (and its TLS session), when no pooled connection was
+#            available. Connections made through a proxy are counted in `send`.
+#   send: sending the request and waiting for the response headers.
+#   download: reading the response body.
+#   decode: decoding the body text and parsing it as JSON.
+PHASES = ('wait', 'sign', 'connect', 'send', 'download', 'decode')
+
+# Upper bounds (in seconds) of the default latency histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestInfo(object):
+  """ Describes a request made by the dispatcher. `template` is the endpoint template the URL
+      was built from (see `bitbucket.urls.url_template`), `timings` maps the phases in PHASES to
+      the seconds spent in them, and `status`, `bytes` and `error` are filled in once the
+      response has been handled. `bytes` is None for streamed responses.
+  """
+  __slots__ = ('method', 'url', 'template', 'status', 'bytes', 'error', 'timings', 'total')
+
+  def __init__(self, method, url, template):
+    self.method = method
+    self.url = url
+    self.template = template
+    self.status = None
+    self.bytes = None
+    self.error = None
+    self.timings = dict.fromkeys(PHASES, 0.0)
+    self.total = None
+
+
+class Instrumentation(object):
+  """ Base class for dispatcher instrumentation. Subclasses override the hooks they need; both
+      are called on the dispatching thread, so they should return quickly.
+  """
+  def before_request(self, info):
+    """ Called before a request is signed and sent. Only the method, URL and template of the
+        info are filled in.
+    """
+
+  def after_request(self, info):
+    """ Called once the response to a request has been handled (or the request failed). """
+
+
+class Histogram(object):
+  """ A fixed-bucket histogram of observed values. """
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self._buckets = tuple(buckets)
+    self.counts = [0] * (len(self._buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    """ Records a single value. """
+    self.counts[bisect.bisect_left(self._buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def quantile(self, q):
+    """ Returns an estimate of the given quantile: the upper bound of the bucket holding it. """
+    if not self.count:
+      return None
+
+    rank = q * self.count
+    seen = 0
+    for (index, bucket_count) in enumerate(self.counts):
+      seen += bucket_count
+      if seen >= rank and bucket_count:
+        return self._buckets[index] if index < len(self._buckets) else float('inf')
+
+    return float('inf')
+
+  def to_dict(self):
+    """ Returns the histogram as a dictionary, with cumulative counts per bucket bound. """
+    cumulative = []
+    seen = 0
+    for (bound, bucket_count) in zip(self._buckets + (float('inf'),), self.counts):
+      seen += bucket_count
+      cumulative.append((bound, seen))
+
+    return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class LatencyCollector(Instrumentation):
+  """ Collects in-process latency histograms, per `(method, template)` endpoint, of the total
+      time of each request and of each of its phases, along with the number of requests, errors
+      and bytes received.
+  """
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self._buckets = buckets
+    self._endpoints = {}
+    self._lock = threading.Lock()
+
+  def after_request(self, info):
+    key = (info.method, info.template or info.url)
+    with self._lock:
+      endpoint = self._endpoints.get(key)
+      if endpoint is None:
+        endpoint = {
+          'requests': 0,
+          'errors': 0,
+          'bytes': 0,
+          'total': Histogram(self._buckets),
+          'phases': dict((phase, Histogram(self._buckets)) for phase in PHASES),
+        }
+        self._endpoints[key] = endpoint
+
+      endpoint['requests'] += 1
+      if info.error is not None:
+        endpoint['errors'] += 1
+      endpoint['bytes'] += info.bytes or 0
+      endpoint['total'].observe(info.total)
+      for (phase, seconds) in info.timings.items():
+        endpoint['phases'][phase].observe(seconds)
+
+  def snapshot(self):
+    """ Returns a dictionary, keyed by `(method, template)`, of the statistics collected for
+        each endpoint so far. Suitable for exporting to a metrics system.
+    """
+    with self._lock:
+      snapshot = {}
+      for (key, endpoint) in self._endpoints.items():
+        snapshot[key] = {
+          'requests': endpoint['requests'],
+          'errors': endpoint['errors'],
+          'bytes': endpoint['bytes'],
+          'p50': endpoint['total'].quantile(0.5),
+          'p99': endpoint['total'].quantile(0.99),
+          'total': endpoint['total'].to_dict(),
+          'phases': dict((phase, histogram.to_dict())
+                         for (phase, histogram) in endpoint['phases'].items()),
+        }
+      return snapshot
+
+  def reset(self):
+    """ Discards all the statistics collected so far. """
+    with self._lock:
+      self._endpoints.clear()
@@ -0,0 +1,358 @@
+""" Defines the local SQLite mirror of the metadata (webhooks, deploy keys, links and services) of
+    the repositories visible to a client, which answers questions such as "which repositories
+    have a webhook pointing at X" from local data instead of sweeping the API.
+
+      mirror = client.mirror('metadata.db')
+      mirror.refresh(max_age=3600)
+      mirror.repositories_with_webhook('https://ci.example.com/*', glob=True)
+      mirror.repositories_missing_deploy_key('ssh-rsa AAAA...')
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+
+from bitbucket.reconcile import KINDS_BY_NAME
+
+# The outcome of a refresh. `refreshed` and `failed` list the `(namespace, repository_name,
+# table)` tables fetched and those whose fetch failed (as `(namespace, repository_name, table,
+# error)`), `skipped` counts the tables still fresh and `removed` lists the `(namespace,
+# repository_name)` repositories no longer visible, which were dropped from the mirror.
+MirrorRefresh = namedtuple('MirrorRefresh', ['refreshed', 'skipped', 'failed', 'removed'])
+
+# The name under which the staleness of the list of repositories is tracked.
+_REPOSITORY_LIST = ('', '', 'repositories')
+
+
+class _MirrorTable(object):
+  """ Describes a table of mirrored resources: the reconcile kind used to list them and the
+      indexed columns extracted from each resource.
+  """
+  def __init__(self, name, columns, indexed, row):
+    self.name = name
+    self.kind = KINDS_BY_NAME[name]
+    self.columns = columns
+    self.indexed = indexed
+    self.row = row
+
+  def schema(self):
+    """ Returns the statements creating the table and its indexes. """
+    statements = ['CREATE TABLE IF NOT EXISTS %s (namespace TEXT NOT NULL, '
+                  'repository_name TEXT NOT NULL, %s, data TEXT NOT NULL)' %
+                  (self.name, ', '.join(self.columns)),
+                  'CREATE INDEX IF NOT EXISTS %s_repository ON %s (namespace, repository_name)' %
+                  (self.name, self.name)]
+    for column in self.indexed:
+      statements.append('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' %
+                        (self.name, column, self.name, column))
+    return statements
+
+  def insert_statement(self):
+    """ Returns the statement inserting a row of the table. """
+    return 'INSERT INTO %s (namespace, repository_name, %s, data) VALUES (?, ?, %s?)' % (
+        self.name, ', '.join(self.columns), '?, ' * len(self.columns))
+
+
+def _link_handler(link):
+  handler = link.get('handler')
+  return handler.get('name') if isinstance(handler, dict) else handler
+
+
+_TABLES = (
+  _MirrorTable('webhooks', ['uuid', 'url', 'active', 'events'], ['url'],
+               lambda hook: (hook.get('uuid'), hook.get('url'), bool(hook.get('active', True)),
+                             json.dumps(sorted(hook.get('events') or [])))),
+  _MirrorTable('deploy_keys', ['pk', 'label', 'key'], ['key'],
+               lambda key: (key.get('pk'), key.get('label'),
+                            KINDS_BY_NAME['deploy_keys'].key(key))),
+  _MirrorTable('links', ['id', 'handler', 'link_key', 'link_url'], ['handler', 'link_url'],
+               lambda link: (link.get('id'), _link_handler(link), link.get('link_key'),
+                             link.get('link_url'))),
+  _MirrorTable('services', ['id', 'type'], ['type'],
+               lambda service: (service.get('id'), (service.get('service') or {}).get('type'))),
+)
+_TABLES_BY_NAME = dict((table.name, table) for table in _TABLES)
+
+
+class _FetchOperation(object):
+  """ A bulk operation listing the resources of a table, which remembers the table. """
+  __slots__ = ('table',)
+
+  def __init__(self, table):
+    self.table = table
+
+  def __call__(self, repository_client):
+    return self.table.kind.fetch(repository_client)
+
+
+class MetadataMirror(object):
+  """ Mirrors the webhooks, deploy keys, links and services of the repositories visible to the
+      given client into the SQLite database at `path`, where they are indexed for querying.
+
+      Each table of each repository (and the list of repositories itself) is refreshed on its
+      own, and the time of its last successful refresh is recorded, so `refresh` only fetches
+      what is older than the given age, and tables can be marked stale (e.g. upon receiving a
+      webhook) to be fetched again on the next refresh. When a fetch fails, the previously
+      mirrored rows are kept. Refreshing is only usable with the blocking `BitBucket`
+      dispatcher; queries never touch the API.
+  """
+  def __init__(self, client, path=':memory:'):
+    self._client = client
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._lock = threading.Lock()
+    with self._lock:
+      self._connection.execute('CREATE TABLE IF NOT EXISTS repositories ('
+                               'namespace TEXT NOT NULL, repository_name TEXT NOT NULL, '
+                               'data TEXT NOT NULL, PRIMARY KEY (namespace, repository_name))')
+      self._connection.execute('CREATE TABLE IF NOT EXISTS mirror_state ('
+                               'namespace TEXT NOT NULL, repository_name TEXT NOT NULL, '
+                               'table_name TEXT NOT NULL, refreshed REAL, error TEXT, '
+                               'PRIMARY KEY (namespace, repository_name, table_name))')
+      for table in _TABLES:
+        for statement in table.schema():
+          self._connection.execute(statement)
+      self._connection.commit()
+
+  def _refreshed(self):
+    """ Returns a dictionary of the time of the last successful refresh of each tracked
+        `(namespace, repository_name, table)`.
+    """
+    with self._lock:
+      rows = self._connection.execute('SELECT namespace, repository_name, table_name, refreshed '
+                                      'FROM mirror_state').fetchall()
+    return dict(((namespace, repository_name, table), refreshed)
+                for (namespace, repository_name, table, refreshed) in rows)
+
+  def _record(self, namespace, repository_name, table, refreshed, error):
+    """ Records the outcome of refreshing a table. Must be called with the lock held. """
+    if refreshed is None:
+      # Keep the time of the last successful refresh.
+      self._connection.execute('INSERT OR IGNORE INTO mirror_state '
+                               '(namespace, repository_name, table_name) VALUES (?, ?, ?)',
+                               (namespace, repository_name, table))
+      self._connection.execute('UPDATE mirror_state SET error = ? WHERE namespace = ? AND '
+                               'repository_name = ? AND table_name = ?',
+                               (error, namespace, repository_name, table))
+      return
+
+    self._connection.execute('INSERT OR REPLACE INTO mirror_state '
+                             '(namespace, repository_name, table_name, refreshed, error) '
+                             'VALUES (?, ?, ?, ?, NULL)',
+                             (namespace, repository_name, table, refreshed))
+
+  def _refresh_repositories(self):
+    """ Fetches the list of visible repositories, returning a tuple of whether it succeeded and
+        the repositories which are no longer visible (or the error encountered).
+    """
+    (result, data, error) = self._client.get_visible_repositories()
+    with self._lock:
+      if not result:
+        self._record('', '', 'repositories', None, error)
+        self._connection.commit()
+        return (False, error)
+
+      visible = {}
+      for repository in data or []:
+        visible[(repository.get('owner'), repository.get('slug'))] = repository
+
+      known = set(self._connection.execute('SELECT namespace, repository_name '
+                                           'FROM repositories').fetchall())
+      removed = sorted(known - set(visible))
+      for (namespace, repository_name) in removed:
+        for name in ['repositories', 'mirror_state'] + [table.name for table in _TABLES]:
+          self._connection.execute('DELETE FROM %s WHERE namespace = ? AND repository_name = ?' %
+                                   name, (namespace, repository_name))
+
+      self._connection.executemany('INSERT OR REPLACE INTO repositories '
+                                   '(namespace, repository_name, data) VALUES (?, ?, ?)',
+                                   [(namespace, repository_name, json.dumps(repository))
+                                    for ((namespace, repository_name), repository)
+                                    in visible.items()])
+      self._record('', '', 'repositories', time.time(), None)
+      self._connection.commit()
+    return (True, removed)
+
+  def _store(self, namespace, repository_name, table, resources):
+    """ Replaces the mirrored resources of the repository in the table. """
+    rows = [(namespace, repository_name) + tuple(table.row(resource)) + (json.dumps(resource),)
+            for resource in resources]
+    with self._lock:
+      self._connection.execute('DELETE FROM %s WHERE namespace = ? AND repository_name = ?' %
+                               table.name, (namespace, repository_name))
+      self._connection.executemany(table.insert_statement(), rows)
+      self._record(namespace, repository_name, table.name, time.time(), None)
+      self._connection.commit()
+
+  def refresh(self, max_age=None, tables=None, max_workers=8):
+    """ Refreshes the tables (by default all of `webhooks`, `deploy_keys`, `links` and
+        `services`) of every visible repository which were last refreshed more than `max_age`
+        seconds ago, or never, or were marked stale. Without `max_age`, everything is
+        refreshed. The list of repositories is refreshed first, by the same rule. At most
+        `max_workers` requests are in flight at a time. Returns a MirrorRefresh.
+    """
+    mirrored = [_TABLES_BY_NAME[name] for name in tables] if tables is not None else _TABLES
+    refreshed_before = time.time() - max_age if max_age is not None else None
+    last_refreshed = self._refreshed()
+    def is_fresh(key):
+      refreshed = last_refreshed.get(key)
+      return refreshed_before is not None and refreshed is not None and \
+          refreshed > refreshed_before
+
+    removed = []
+    failed = []
+    if not is_fresh(_REPOSITORY_LIST):
+      (result, data) = self._refresh_repositories()
+      if result:
+        removed = data
+      else:
+        failed.append(_REPOSITORY_LIST + (data,))
+
+    jobs = []
+    skipped = 0
+    for (namespace, repository_name) in self.repositories():
+      for table in mirrored:
+        if is_fresh((namespace, repository_name, table.name)):
+          skipped += 1
+        else:
+          jobs.append((namespace, repository_name, _FetchOperation(table)))
+
+    refreshed = []
+    for bulk_result in self._client.bulk(jobs, max_workers=max_workers):
+      table = bulk_result.operation.table
+      key = (bulk_result.namespace, bulk_result.repository_name, table.name)
+      if not bulk_result.result:
+        with self._lock:
+          self._record(bulk_result.namespace, bulk_result.repository_name, table.name, None,
+                       bulk_result.error)
+          self._connection.commit()
+        failed.append(key + (bulk_result.error,))
+        continue
+
+      self._store(bulk_result.namespace, bulk_result.repository_name, table,
+                  table.kind.items(bulk_result.data))
+      refreshed.append(key)
+
+    return MirrorRefresh(refreshed, skipped, failed, removed)
+
+  def mark_stale(self, namespace, repository_name, table=None):
+    """ Marks the given table (by default, all the tables) of the repository as stale, so that
+        it is fetched again by the next refresh.
+    """
+    with self._lock:
+      if table is None:
+        self._connection.execute('UPDATE mirror_state SET refreshed = NULL '
+                                 'WHERE namespace = ? AND repository_name = ?',
+                                 (namespace, repository_name))
+      else:
+        self._connection.execute('UPDATE mirror_state SET refreshed = NULL WHERE namespace = ? '
+                                 'AND repository_name = ? AND table_name = ?',
+                                 (namespace, repository_name, table))
+      self._connection.commit()
+
+  def staleness(self, table=None):
+    """ Returns a list of `(namespace, repository_name, table, age, error)` tuples of the
+        tracked tables (or only of the given table), where `age` is the number of seconds since
+        their last successful refresh (None if never or if marked stale) and `error` the error
+        of their last failed refresh, if it failed.
+    """
+    now = time.time()
+    sql = 'SELECT namespace, repository_name, table_name, refreshed, error FROM mirror_state'
+    params = ()
+    if table is not None:
+      sql += ' WHERE table_name = ?'
+      params = (table,)
+
+    rows = self.query(sql + ' ORDER BY namespace, repository_name, table_name', params)
+    return [(namespace, repository_name, table_name,
+             now - refreshed if refreshed is not None else None, error)
+            for (namespace, repository_name, table_name, refreshed, error) in rows]
+
+  def query(self, sql, params=()):
+    """ Runs the given SQL query against the mirror, returning the list of rows. Resources are
+        stored as JSON in the `data` column of the `repositories`, `webhooks`, `deploy_keys`,
+        `links` and `services` tables, alongside indexed columns.
+    """
+    with self._lock:
+      return self._connection.execute(sql, params).fetchall()
+
+  def repositories(self):
+    """ Returns the list of `(namespace, repository_name)` of the mirrored repositories. """
+    return self.query('SELECT namespace, repository_name FROM repositories '
+                      'ORDER BY namespace, repository_name')
+
+  def resources(self, table, namespace=None, repository_name=None):
+    """ Returns a list of `(namespace, repository_name, resource)` of the resources mirrored in
+        the table, optionally only those of the given namespace and repository.
+    """
+    sql = 'SELECT namespace, repository_name, data FROM %s' % _TABLES_BY_NAME[table].name
+    conditions = []
+    params = []
+    if namespace is not None:
+      conditions.append('namespace = ?')
+      params.append(namespace)
+    if repository_name is not None:
+      conditions.append('repository_name = ?')
+      params.append(repository_name)
+    if conditions:
+      sql += ' WHERE ' + ' AND '.join(conditions)
+
+    return [(row_namespace, row_repository_name, json.loads(data))
+            for (row_namespace, row_repository_name, data) in self.query(sql, params)]
+
+  def _repositories_with(self, table, column, value, glob):
+    """ Returns the repositories with a resource in the table whose column matches the value. """
+    return self.query('SELECT DISTINCT namespace, repository_name FROM %s WHERE %s %s ? '
+                      'ORDER BY namespace, repository_name' %
+                      (table, column, 'GLOB' if glob else '='), (value,))
+
+  def _repositories_without(self, table, column, value):
+    """ Returns the mirrored repositories without any resource in the table whose column equals
+        the value. Repositories whose table was never mirrored are not reported.
+    """
+    return self.query('SELECT namespace, repository_name FROM repositories AS r WHERE '
+                      'EXISTS (SELECT 1 FROM mirror_state AS s WHERE s.namespace = r.namespace '
+                      'AND s.repository_name = r.repository_name AND s.table_name = ? '
+                      'AND s.refreshed IS NOT NULL) AND '
+                      'NOT EXISTS (SELECT 1 FROM %s AS t WHERE t.namespace = r.namespace AND '
+                      't.repository_name = r.repository_name AND t.%s = ?) '
+                      'ORDER BY namespace, repository_name' % (table, column), (table, value))
+
+  def repositories_with_webhook(self, url, glob=False):
+    """ Returns the repositories with a webhook pointing at the URL, or matching the URL as a
+        glob pattern if `glob` is True.
+    """
+    return self._repositories_with('webhooks', 'url', url, glob)
+
+  def repositories_without_webhook(self, url):
+    """ Returns the repositories without any webhook pointing at the URL. """
+    return self._repositories_without('webhooks', 'url', url)
+
+  def repositories_with_deploy_key(self, key):
+    """ Returns the repositories with the given deploy key (its type and material; any
+        trailing comment is ignored).
+    """
+    return self._repositories_with('deploy_keys', 'key', KINDS_BY_NAME['deploy_keys'].key(
+        {'key': key}), False)
+
+  def repositories_missing_deploy_key(self, key):
+    """ Returns the repositories without the given deploy key. """
+    return self._repositories_without('deploy_keys', 'key', KINDS_BY_NAME['deploy_keys'].key(
+        {'key': key}))
+
+  def repositories_with_link(self, link_url, glob=False):
+    """ Returns the repositories with a link to the URL, or matching the URL as a glob pattern
+        if `glob` is True.
+    """
+    return self._repositories_with('links', 'link_url', link_url, glob)
+
+  def repositories_with_service(self, service_type):
+    """ Returns the repositories with a service of the given type. """
+    return self._repositories_with('services', 'type', service_type, False)
+
+  def close(self):
+    """ Closes the database connection. """
+    with self._lock:
+      self._connection.close()
@@ -0,0 +1,255 @@
+""" Defines typed, lazily decoded models for the most common BitBucket resources.
+
+    Methods accepting `typed=True` return these models in place of the decoded JSON. The response
+    body is kept as raw bytes and only parsed (with orjson or ujson when installed) the first
+    time one of the fields of its models is read, and each field is converted and cached on first
+    access. With an `AsyncBitBucket`, these methods return awaitables of the model results.
+"""
+
+import json
+
+try:
+  import orjson
+  _loads = orjson.loads
+except ImportError:
+  try:
+    import ujson
+    _loads = ujson.loads
+  except ImportError:
+    _loads = json.loads
+
+_MISSING = object()
+
+
+class Field(object):
+  """ A model field read from the model's JSON object. `paths` are the keys (or tuples of keys
+      for nested values) the field is read from; the first one present is used. The value is
+      passed to `converter` (if any) when first read.
+  """
+  def __init__(self, *paths, **kwargs):
+    self.paths = [path if isinstance(path, tuple) else (path,) for path in paths]
+    self.converter = kwargs.get('converter')
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+
+    values = instance._values
+    if values is None:
+      values = instance._values = {}
+
+    value = values.get(self, _MISSING)
+    if value is _MISSING:
+      value = self._read(instance._get_data())
+      if value is not None and self.converter is not None:
+        value = self.converter(value)
+      values[self] = value
+
+    return value
+
+  def _read(self, data):
+    """ Returns the value found at the first of the field's paths present in the data. """
+    for path in self.paths:
+      value = data
+      for key in path:
+        if not isinstance(value, dict) or key not in value:
+          value = _MISSING
+          break
+        value = value[key]
+
+      if value is not _MISSING:
+        return value
+
+    return None
+
+
+class Model(object):
+  """ Base class of the models. A model wraps either the raw bytes of a response body or, for
+      the items of a list response, an already decoded JSON object.
+  """
+  __slots__ = ('_raw', '_data', '_values')
+
+  # Name of the field identifying the model in its representation.
+  _identifier = None
+
+  def __init__(self, raw=None, data=None):
+    self._raw = raw
+    self._data = data
+    self._values = None
+
+  def _get_data(self):
+    """ Returns the decoded JSON object of the model, decoding it on first use. """
+    data = self._data
+    if data is None:
+      data = self._data = _loads(self._raw)
+      self._raw = None
+    return data
+
+  def to_dict(self):
+    """ Returns the decoded JSON object the model was built from. """
+    return self._get_data()
+
+  def __repr__(self):
+    if self._identifier is None:
+      return '<%s>' % type(self).__name__
+    return '<%s %r>' % (type(self).__name__, getattr(self, self._identifier))
+
+
+class ModelList(object):
+  """ A read-only sequence of models built from the raw bytes of a list response. The body is
+      decoded on first access, and the models for its items are created as they are accessed.
+      `items_key` names the key holding the items when the body is an object rather than a list;
+      `name_key` is set on each item from the object key when the body maps names to items.
+  """
+  __slots__ = ('_model_class', '_raw', '_items_key', '_name_key', '_items', '_models')
+
+  def __init__(self, model_class, raw, items_key=None, name_key=None):
+    self._model_class = model_class
+    self._raw = raw
+    self._items_key = items_key
+    self._name_key = name_key
+    self._items = None
+    self._models = None
+
+  def _get_items(self):
+    """ Returns the decoded JSON objects of the items, decoding the body on first use. """
+    items = self._items
+    if items is None:
+      data = _loads(self._raw)
+      self._raw = None
+      if self._items_key is not None:
+        data = data.get(self._items_key) or []
+
+      if self._name_key is not None:
+        items = []
+        for (name, item) in data.items():
+          item[self._name_key] = name
+          items.append(item)
+      else:
+        items = data
+
+      self._items = items
+      self._models = [None] * len(items)
+
+    return items
+
+  def __len__(self):
+    return len(self._get_items())
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(len(self)))]
+
+    items = self._get_items()
+    model = self._models[index]
+    if model is None:
+      model = self._models[index] = self._model_class(data=items[index])
+    return model
+
+  def __iter__(self):
+    for index in range(len(self)):
+      yield self[index]
+
+  def __repr__(self):
+    return '<ModelList of %s>' % self._model_class.__name__
+
+
+def decode_body(body):
+  """ Decodes a raw response body as JSON if it parses, and as text otherwise. The body is
+      decoded as UTF-8 (the encoding of JSON), with undecodable bytes replaced, whatever charset
+      the response declares, so that a body decodes the same way wherever it was read from.
+  """
+  text = body.decode('utf-8', 'replace') if isinstance(body, bytes) else body
+  try:
+    return json.loads(text or '')
+  except ValueError:
+    return text
+
+
+def model_result(result, model_class):
+  """ Wraps the raw body of a successful `(ok, raw, error)` result tuple in a model. """
+  (ok, raw, error) = result
+  if not ok:
+    return result
+  return (True, model_class(raw=raw), error)
+
+
+def model_list_result(result, model_class, items_key=None, name_key=None):
+  """ Wraps the raw body of a successful `(ok, raw, error)` result tuple in a ModelList. """
+  (ok, raw, error) = result
+  if not ok:
+    return result
+  return (True, ModelList(model_class, raw, items_key=items_key, name_key=name_key), error)
+
+
+class Changeset(Model):
+  """ A changeset (commit) of a repository, as returned by the V1 changesets API. """
+  __slots__ = ()
+  _identifier = 'node'
+
+  node = Field('node')
+  raw_node = Field('raw_node')
+  author = Field('author')
+  raw_author = Field('raw_author')
+  timestamp = Field('timestamp')
+  utctimestamp = Field('utctimestamp')
+  branch = Field('branch')
+  message = Field('message')
+  revision = Field('revision')
+  size = Field('size')
+  parents = Field('parents', converter=tuple)
+  files = Field('files', converter=tuple)
+
+
+class Branch(Model):
+  """ A branch of a repository, as returned by either the V1 branches or the V2 refs API. """
+  __slots__ = ()
+  _identifier = 'name'
+
+  name = Field('name')
+  node = Field('node', ('target', 'hash'))
+  raw_node = Field('raw_node', ('target', 'hash'))
+  author = Field('author', ('target', 'author', 'raw'))
+  timestamp = Field('timestamp', ('target', 'date'))
+  message = Field('message', ('target', 'message'))
+
+
+class Webhook(Model):
+  """ A webhook of a repository, as returned by the V2 webhooks API. """
+  __slots__ = ()
+  _identifier = 'uuid'
+
+  uuid = Field('uuid')
+  description = Field('description')
+  url = Field('url')
+  active = Field('active')
+  events = Field('events', converter=tuple)
+  skip_cert_verification = Field('skip_cert_verification')
+  created_at = Field('created_at')
+
+
+class DeployKey(Model):
+  """ A deploy key of a repository, as returned by the V1 deploy keys API. """
+  __slots__ = ()
+  _identifier = 'pk'
+
+  pk = Field('pk')
+  label = Field('label')
+  key = Field('key')
+
+
+class Repository(Model):
+  """ A repository, as returned by the V1 repositories API. """
+  __slots__ = ()
+  _identifier = 'slug'
+
+  slug = Field('slug')
+  name = Field('name')
+  owner = Field('owner')
+  scm = Field('scm')
+  is_private = Field('is_private')
+  description = Field('description')
+  language = Field('language')
+  size = Field('size')
+  last_updated = Field('last_updated')
+  utc_last_updated = Field('utc_last_updated')
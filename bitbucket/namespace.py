@@ -1,21 +1,26 @@
 """ Defines a client class for working with a BitBucket namespace. """
 
 from bitbucket.repositories import BitBucketRepositoriesClient
+from bitbucket.context import BitBucketContext, ContextClient
 
-class BitBucketNamespaceClient(object):
+class BitBucketNamespaceClient(ContextClient):
   """ Client class representing a single namespace in bitbucket. """
+  __slots__ = ('_repositories',)
+
   def __init__(self, dispatcher, access_token, access_token_secret, namespace):
-    self._dispatcher = dispatcher
-    self._access_token = access_token
-    self._access_token_secret = access_token_secret
-    self._namespace = namespace
+    self._attach(BitBucketContext(dispatcher, access_token, access_token_secret, namespace))
+
+  def _attach(self, context):
+    self._context = context
+    self._repositories = None
 
   @property
   def namespace(self):
     """ Returns the namespace. """
-    return self._namespace
+    return self._context.namespace
 
   def repositories(self):
     """ Returns access to the namespace's repositories. """
-    return BitBucketRepositoriesClient(self._dispatcher, self._access_token,
-                                       self._access_token_secret, self._namespace)
\ No newline at end of file
+    if self._repositories is None:
+      self._repositories = BitBucketRepositoriesClient.from_context(self._context)
+    return self._repositories
\ No newline at end of file
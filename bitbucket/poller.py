@@ -0,0 +1,274 @@
+""" Defines the poller which watches the branches and tags of many repositories for changes. """
+
+import heapq
+import itertools
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
+
+# A change to a ref of a repository. `kind` is either 'branch' or 'tag' and `change` one of
+# 'created', 'moved' or 'deleted'; `old_node` is None for created refs and `new_node` is None for
+# deleted ones.
+RefEvent = namedtuple('RefEvent', ['namespace', 'repository_name', 'kind', 'name', 'change',
+                                   'old_node', 'new_node'])
+
+
+def _snapshot_refs(data):
+  """ Returns the compact snapshot, a dictionary mapping `(kind, name)` to the node, of the refs
+      returned by the branches and tags API.
+  """
+  refs = {}
+  for (kind, key) in (('branch', 'branches'), ('tag', 'tags')):
+    for ref in data.get(key) or []:
+      refs[(kind, ref['name'])] = ref.get('changeset') or ref.get('node')
+  return refs
+
+
+def diff_refs(namespace, repository_name, old_refs, new_refs):
+  """ Returns the list of RefEvents turning the `old_refs` snapshot into `new_refs`. """
+  events = []
+  for (key, new_node) in new_refs.items():
+    old_node = old_refs.get(key)
+    if old_node is None:
+      events.append(RefEvent(namespace, repository_name, key[0], key[1], 'created', None,
+                             new_node))
+    elif old_node != new_node:
+      events.append(RefEvent(namespace, repository_name, key[0], key[1], 'moved', old_node,
+                             new_node))
+
+  for (key, old_node) in old_refs.items():
+    if key not in new_refs:
+      events.append(RefEvent(namespace, repository_name, key[0], key[1], 'deleted', old_node,
+                             None))
+
+  return events
+
+
+class _WatchedRepository(object):
+  """ The polling state of a watched repository. """
+  __slots__ = ('namespace', 'repository_name', 'refs', 'interval', 'due', 'polling', 'triggered',
+               'watching')
+
+  def __init__(self, namespace, repository_name, interval):
+    self.namespace = namespace
+    self.repository_name = repository_name
+    self.refs = None
+    self.interval = interval
+    self.due = None
+    self.polling = False
+    self.triggered = False
+    self.watching = True
+
+
+class RefPoller(object):
+  """ Watches the branches and tags of repositories, calling `on_events` with the list of
+      RefEvents found each time the refs of a watched repository change.
+
+      All watched repositories are polled by a single scheduler thread through one pool of
+      `max_workers` threads, sharing the client's connection pool. Each repository is polled
+      every `min_interval` seconds after a change; every poll that finds no change (or fails)
+      multiplies its interval by `backoff`, up to `max_interval`, so that rarely changing
+      repositories cost few requests. Installing a `ConditionalRequestCache` on the dispatcher
+      makes the polls of unchanged repositories cheaper still.
+
+      The first poll of a repository only records its refs, unless `emit_initial` is True, in
+      which case every ref is reported as created. Failed polls, and exceptions raised by
+      `on_events`, are reported to `on_error` with the namespace, repository name and error (the
+      error message, or the exception raised), if given. A repository keeps being polled
+      whatever happens to one of its polls; `errors` counts the failed polls and callbacks.
+  """
+  def __init__(self, client, on_events, on_error=None, min_interval=30, max_interval=900,
+               backoff=1.5, max_workers=8, emit_initial=False):
+    self._client = client
+    self._on_events = on_events
+    self._on_error = on_error
+    self._min_interval = min_interval
+    self._max_interval = max_interval
+    self._backoff = backoff
+    self._max_workers = max_workers
+    self._emit_initial = emit_initial
+
+    self._watched = {}
+    self._schedule = []
+    self._sequence = itertools.count()
+    self._condition = threading.Condition()
+    self._executor = None
+    self._thread = None
+    self._running = False
+
+    self.errors = 0
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
+
+  def _schedule_poll(self, watched, due):
+    """ Schedules the next poll of the repository. Must be called with the condition held. """
+    watched.due = due
+    heapq.heappush(self._schedule, (due, next(self._sequence), watched))
+    self._condition.notify()
+
+  def watch(self, namespace, repository_name):
+    """ Starts watching the repository. Its first poll happens as soon as possible. """
+    with self._condition:
+      if (namespace, repository_name) in self._watched:
+        return
+
+      watched = _WatchedRepository(namespace, repository_name, self._min_interval)
+      self._watched[(namespace, repository_name)] = watched
+      self._schedule_poll(watched, default_timer())
+
+  def unwatch(self, namespace, repository_name):
+    """ Stops watching the repository and forgets its refs. """
+    with self._condition:
+      watched = self._watched.pop((namespace, repository_name), None)
+      if watched is not None:
+        watched.watching = False
+
+  def trigger(self, namespace, repository_name):
+    """ Polls the watched repository as soon as possible and resets its interval, e.g. when a
+        webhook reports a push to it.
+    """
+    with self._condition:
+      watched = self._watched.get((namespace, repository_name))
+      if watched is None:
+        return
+
+      watched.interval = self._min_interval
+      if watched.polling:
+        watched.triggered = True
+      else:
+        self._schedule_poll(watched, default_timer())
+
+  def refs(self, namespace, repository_name):
+    """ Returns the last snapshot of the refs of the watched repository, a dictionary mapping
+        `(kind, name)` to the node, or None if it has not been polled yet.
+    """
+    with self._condition:
+      watched = self._watched.get((namespace, repository_name))
+      return dict(watched.refs) if watched is not None and watched.refs is not None else None
+
+  def start(self):
+    """ Starts the scheduler thread. """
+    with self._condition:
+      if self._running:
+        return
+
+      self._running = True
+      self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+      self._thread = threading.Thread(target=self._run)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def stop(self):
+    """ Stops the scheduler thread, waiting for the polls in progress to finish. """
+    with self._condition:
+      if not self._running:
+        return
+
+      self._running = False
+      self._condition.notify()
+
+    self._thread.join()
+    self._executor.shutdown(wait=True)
+    self._thread = None
+    self._executor = None
+
+  def _run(self):
+    """ Submits the polls of the repositories as they become due. """
+    with self._condition:
+      while self._running:
+        now = default_timer()
+        while self._schedule and self._schedule[0][0] <= now:
+          (due, _, watched) = heapq.heappop(self._schedule)
+          # Skip entries superseded by a trigger or belonging to unwatched repositories.
+          if not watched.watching or watched.polling or due != watched.due:
+            continue
+
+          watched.polling = True
+          self._executor.submit(self._poll_watched, watched)
+
+        timeout = self._schedule[0][0] - now if self._schedule else None
+        self._condition.wait(timeout)
+
+  def _poll_watched(self, watched):
+    """ Polls a watched repository, schedules its next poll and reports the events found or the
+        error encountered.
+    """
+    events = []
+    error = None
+    watching = True
+    try:
+      (result, new_refs, error) = self._poll_refs(watched.namespace, watched.repository_name)
+      if result:
+        with self._condition:
+          if watched.refs is not None or self._emit_initial:
+            events = diff_refs(watched.namespace, watched.repository_name, watched.refs or {},
+                               new_refs)
+          watched.refs = new_refs
+    except Exception as ex:
+      error = ex
+    finally:
+      with self._condition:
+        watched.polling = False
+        watching = watched.watching
+        if watching:
+          if events:
+            watched.interval = self._min_interval
+          else:
+            watched.interval = min(watched.interval * self._backoff, self._max_interval)
+
+          if watched.triggered:
+            watched.triggered = False
+            self._schedule_poll(watched, default_timer())
+          else:
+            self._schedule_poll(watched, default_timer() + watched.interval)
+
+    if not watching:
+      return
+
+    if error is not None:
+      self._report_error(watched, error)
+    elif events:
+      try:
+        self._on_events(events)
+      except Exception as ex:
+        self._report_error(watched, ex)
+
+  def _report_error(self, watched, error):
+    """ Counts the error of a watched repository and passes it to `on_error`, if given. """
+    with self._condition:
+      self.errors += 1
+
+    if self._on_error is not None:
+      try:
+        self._on_error(watched.namespace, watched.repository_name, error)
+      except Exception:
+        # There is nothing left to report the failure of `on_error` to; it is counted instead.
+        with self._condition:
+          self.errors += 1
+
+  def _poll_refs(self, namespace, repository_name):
+    """ Retrieves the compact snapshot of the refs of the repository. """
+    repository = self._client.for_namespace(namespace).repositories().get(repository_name)
+    (result, data, error) = repository.get_branches_and_tags()
+    if not result:
+      return (False, None, error)
+
+    return (True, _snapshot_refs(data), None)
+
+  def poll(self, namespace, repository_name, refs):
+    """ Retrieves the refs of the repository and diffs them against the given `refs` snapshot,
+        returning a tuple of whether it succeeded and a tuple of the list of RefEvents found and
+        the new snapshot (or the error encountered). Does not affect the watched repositories.
+    """
+    (result, new_refs, error) = self._poll_refs(namespace, repository_name)
+    if not result:
+      return (False, None, error)
+
+    return (True, (diff_refs(namespace, repository_name, refs, new_refs), new_refs), None)
@@ -0,0 +1,226 @@
+""" Defines the resolver of account profiles, which caches the profiles fetched through the accounts
+    API in memory (and optionally in a persistent store) so that the same accounts are not fetched
+    over and over, for example when annotating changesets with the profiles of their authors.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from bitbucket.coalesce import SingleFlight
+from bitbucket.errors import ResponseError
+
+def is_unknown_account(result):
+  """ Returns whether the result tuple of a profile lookup reports an account which does not
+      exist (a 404 response), as opposed to a transient failure.
+  """
+  (ok, _, error) = result
+  return not ok and getattr(error, 'status_code', None) == 404
+
+
+class SQLiteProfileStore(object):
+  """ Keeps the resolved profiles, along with when they expire, in a table of the SQLite
+      database at the given path, so that they survive restarts. The status code of failed
+      results is kept alongside them, so that their errors are read back as ResponseErrors.
+  """
+  def __init__(self, path):
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._lock = threading.Lock()
+    with self._lock:
+      self._connection.execute('CREATE TABLE IF NOT EXISTS account_profiles ('
+                               'account TEXT PRIMARY KEY, result TEXT NOT NULL, '
+                               'expires REAL NOT NULL, status_code INTEGER)')
+      columns = [row[1] for row
+                 in self._connection.execute('PRAGMA table_info(account_profiles)').fetchall()]
+      if 'status_code' not in columns:
+        # Tables created before status codes were stored.
+        self._connection.execute('ALTER TABLE account_profiles ADD COLUMN status_code INTEGER')
+      self._connection.commit()
+
+  def get(self, account):
+    """ Returns a tuple of the stored result tuple of the account and when it expires, if any. """
+    with self._lock:
+      row = self._connection.execute('SELECT result, expires, status_code FROM account_profiles '
+                                     'WHERE account = ?', (account,)).fetchone()
+    if row is None:
+      return None
+
+    (ok, data, error) = json.loads(row[0])
+    if row[2] is not None:
+      error = ResponseError(error, row[2])
+    return ((ok, data, error), row[1])
+
+  def set(self, account, result, expires):
+    """ Stores the result tuple of the account along with when it expires. """
+    status_code = getattr(result[2], 'status_code', None)
+    with self._lock:
+      self._connection.execute('INSERT OR REPLACE INTO account_profiles '
+                               '(account, result, expires, status_code) VALUES (?, ?, ?, ?)',
+                               (account, json.dumps(list(result)), expires, status_code))
+      self._connection.commit()
+
+  def delete(self, account):
+    """ Forgets the stored result of the account. """
+    with self._lock:
+      self._connection.execute('DELETE FROM account_profiles WHERE account = ?', (account,))
+      self._connection.commit()
+
+  def purge(self, before=None):
+    """ Removes the results which expired before the given time (by default, now). """
+    with self._lock:
+      self._connection.execute('DELETE FROM account_profiles WHERE expires <= ?',
+                               (before if before is not None else time.time(),))
+      self._connection.commit()
+
+  def close(self):
+    """ Closes the database connection. """
+    with self._lock:
+      self._connection.close()
+
+
+class ProfileResolver(object):
+  """ Resolves account profiles through the given `BitBucketAccountsClient`, caching them.
+
+      Profiles are kept in memory for `ttl` seconds, and accounts which do not exist for
+      `negative_ttl` seconds; other failures are not cached. At most `max_entries` results are
+      kept in memory, the least recently used being evicted first. When a `store` (such as a
+      `SQLiteProfileStore`) is given, results are also written to it and read back from it on
+      memory misses, so a restarted process does not have to fetch them again. Concurrent
+      lookups of the same account are coalesced into a single request.
+
+      Only usable with the blocking `BitBucket` dispatcher.
+  """
+  def __init__(self, accounts, ttl=3600, negative_ttl=300, max_entries=10000, store=None,
+               max_workers=8):
+    self._accounts = accounts
+    self._ttl = ttl
+    self._negative_ttl = negative_ttl
+    self._max_entries = max_entries
+    self._store = store
+    self._max_workers = max_workers
+
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self._single_flight = SingleFlight()
+    self.hits = 0
+    self.store_hits = 0
+    self.misses = 0
+
+  def _cached(self, account, now):
+    """ Returns the unexpired result of the account held in memory, if any. """
+    with self._lock:
+      entry = self._entries.pop(account, None)
+      if entry is None:
+        return None
+
+      if entry[1] <= now:
+        return None
+
+      self._entries[account] = entry
+      self.hits += 1
+      return entry[0]
+
+  def _remember(self, account, result, expires):
+    """ Keeps the result of the account in memory, evicting the least recently used results if
+        needed.
+    """
+    with self._lock:
+      self._entries.pop(account, None)
+      self._entries[account] = (result, expires)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def _load(self, account):
+    """ Returns the result of the account from the store or else from the accounts API, caching
+        it.
+    """
+    now = time.time()
+    if self._store is not None:
+      stored = self._store.get(account)
+      if stored is not None and stored[1] > now:
+        with self._lock:
+          self.store_hits += 1
+        self._remember(account, stored[0], stored[1])
+        return stored[0]
+
+    with self._lock:
+      self.misses += 1
+
+    result = self._accounts.get_profile(account)
+    if result[0]:
+      expires = now + self._ttl
+    elif is_unknown_account(result):
+      expires = now + self._negative_ttl
+    else:
+      return result
+
+    self._remember(account, result, expires)
+    if self._store is not None:
+      self._store.set(account, result, expires)
+    return result
+
+  def get_profile(self, accountname_or_email):
+    """ Returns the profile of the account matching the given account name or email address,
+        as the result tuple of `BitBucketAccountsClient.get_profile`.
+    """
+    result = self._cached(accountname_or_email, time.time())
+    if result is not None:
+      return result
+
+    return self._single_flight.do(accountname_or_email, self._load, accountname_or_email)
+
+  def get_profiles(self, accountnames_or_emails):
+    """ Returns a dictionary of the result tuple of the profile of each of the given accounts.
+        The accounts not already cached are fetched concurrently on a pool of `max_workers`
+        threads.
+    """
+    now = time.time()
+    results = {}
+    missing = []
+    for account in accountnames_or_emails:
+      if account in results:
+        continue
+
+      result = self._cached(account, now)
+      results[account] = result
+      if result is None:
+        missing.append(account)
+
+    if len(missing) == 1:
+      results[missing[0]] = self.get_profile(missing[0])
+    elif missing:
+      executor = ThreadPoolExecutor(max_workers=min(self._max_workers, len(missing)))
+      try:
+        for (account, result) in zip(missing, executor.map(self.get_profile, missing)):
+          results[account] = result
+      finally:
+        executor.shutdown(wait=True)
+
+    return results
+
+  def invalidate(self, accountname_or_email):
+    """ Forgets the cached result of the account, so that it is fetched again. """
+    with self._lock:
+      self._entries.pop(accountname_or_email, None)
+
+    if self._store is not None:
+      self._store.delete(accountname_or_email)
+
+  def clear(self):
+    """ Forgets all the results held in memory. The store, if any, is left as is. """
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    """ Returns a dictionary of the number of lookups served from memory and from the store,
+        the number of profiles fetched, the number of lookups coalesced with one in flight and
+        the number of results held in memory.
+    """
+    coalesced = self._single_flight.stats()['coalesced']
+    with self._lock:
+      return {'hits': self.hits, 'store_hits': self.store_hits, 'misses': self.misses,
+              'coalesced': coalesced, 'entries': len(self._entries)}
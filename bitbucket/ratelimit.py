@@ -0,0 +1,167 @@
+""" Defines the client-side rate limiter and retry policy which can be plugged into the
+    `BitBucket` dispatcher.
+"""
+
+import random
+import threading
+import time
+
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
+# Buckets are refilled on a clock unaffected by changes of the system time, where available.
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Methods which can safely be sent again after a throttled or unavailable response.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class TokenBucket(object):
+  """ A token bucket refilled at `rate` tokens per second, holding at most `capacity` tokens. """
+  def __init__(self, rate, capacity):
+    self._rate = float(rate)
+    self._capacity = float(capacity)
+    self._tokens = float(capacity)
+    self._last_refill = _monotonic()
+    self._lock = threading.Lock()
+
+  def is_full(self):
+    """ Returns whether the bucket has refilled to capacity, i.e. is as good as a new one. """
+    with self._lock:
+      elapsed = _monotonic() - self._last_refill
+      return self._tokens + elapsed * self._rate >= self._capacity
+
+  def reserve(self, max_wait=None):
+    """ Takes a token from the bucket and returns the number of seconds the caller must wait
+        before using it. Reservations are handed out in order, so callers are served FIFO. If
+        the wait would exceed `max_wait` seconds, no token is taken and None is returned.
+    """
+    with self._lock:
+      now = _monotonic()
+      self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+      self._last_refill = now
+      wait = max(0, (1 - self._tokens) / self._rate)
+      if max_wait is not None and wait > max_wait:
+        return None
+
+      self._tokens -= 1
+      return wait
+
+
+class RateLimiter(object):
+  """ Limits the requests made through a dispatcher to `rate` requests per second (with bursts of
+      up to `burst` requests) for each access token, and decides how throttled (429) and
+      unavailable (503) responses to idempotent requests are retried: after the delay given by
+      the `Retry-After` header when present, or else with jittered exponential backoff starting
+      at `backoff_base` seconds and capped at `backoff_max`, for at most `max_retries` retries.
+
+      The buckets of access tokens are dropped once they have refilled, and at most
+      `max_buckets` are kept, the least recently used being dropped first.
+  """
+  def __init__(self, rate=10, burst=20, max_retries=3, backoff_base=0.5, backoff_max=30,
+               retry_statuses=(429, 503), max_buckets=10000):
+    self._rate = rate
+    self._burst = burst
+    self._max_retries = max_retries
+    self._backoff_base = backoff_base
+    self._backoff_max = backoff_max
+    self._retry_statuses = frozenset(retry_statuses)
+
+    self._max_buckets = max_buckets
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+
+    self._queued = 0
+    self._requests = 0
+    self._throttled = 0
+    self._wait_time = 0.0
+    self._retries = 0
+
+  def _get_bucket(self, access_token):
+    """ Returns the token bucket for the access token, creating it if necessary. """
+    with self._lock:
+      bucket = self._buckets.pop(access_token, None)
+      if bucket is None:
+        bucket = TokenBucket(self._rate, self._burst)
+      self._buckets[access_token] = bucket
+
+      # Buckets are ordered by last use, so the idle ones are at the front.
+      while self._buckets:
+        (oldest_token, oldest) = next(iter(self._buckets.items()))
+        if oldest is bucket or (len(self._buckets) <= self._max_buckets and
+                                not oldest.is_full()):
+          break
+        del self._buckets[oldest_token]
+
+      return bucket
+
+  def acquire(self, access_token):
+    """ Blocks until a request may be made with the given access token. """
+    wait = self._get_bucket(access_token).reserve()
+    with self._lock:
+      self._requests += 1
+      if wait > 0:
+        self._queued += 1
+        self._throttled += 1
+        self._wait_time += wait
+
+    if wait > 0:
+      try:
+        time.sleep(wait)
+      finally:
+        with self._lock:
+          self._queued -= 1
+
+  def should_retry(self, method, status_code, attempt):
+    """ Returns whether a request which received the given status on the given (zero-based)
+        attempt should be sent again.
+    """
+    return (status_code in self._retry_statuses and method in IDEMPOTENT_METHODS and
+            attempt < self._max_retries)
+
+  def retry_delay(self, attempt, response_headers):
+    """ Returns the number of seconds to wait before the next attempt. """
+    delay = _parse_retry_after(response_headers.get('Retry-After'))
+    if delay is None:
+      delay = random.uniform(0, min(self._backoff_max, self._backoff_base * (2 ** attempt)))
+    return min(delay, self._backoff_max)
+
+  def wait_for_retry(self, attempt, response_headers):
+    """ Sleeps before the next attempt of a retried request. """
+    delay = self.retry_delay(attempt, response_headers)
+    with self._lock:
+      self._retries += 1
+      self._wait_time += delay
+
+    time.sleep(delay)
+
+  def metrics(self):
+    """ Returns a dictionary of the number of requests currently queued, the total number of
+        requests, how many of them were delayed by the limiter, the total time spent waiting
+        (in seconds) and the number of retries.
+    """
+    with self._lock:
+      return {
+        'queued': self._queued,
+        'requests': self._requests,
+        'throttled': self._throttled,
+        'wait_time': self._wait_time,
+        'retries': self._retries,
+      }
+
+
+def _parse_retry_after(value):
+  """ Parses a `Retry-After` header, given either in seconds or as an HTTP date. """
+  if not value:
+    return None
+
+  try:
+    return max(0, float(value))
+  except ValueError:
+    pass
+
+  parsed = parsedate_tz(value)
+  if parsed is None:
+    return None
+
+  return max(0, mktime_tz(parsed) - time.time())
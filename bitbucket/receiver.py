@@ -0,0 +1,348 @@
+""" Defines a receiver for the webhooks BitBucket delivers, handing the received events in
+    batches to a pool of worker threads.
+
+    The receiver is a WSGI application; `bitbucket.aio.asgi_webhook_app` adapts it to ASGI. For
+    local testing, `make_server` serves it on a threaded HTTP server which webhooks can be POSTed
+    to:
+
+      with WebhookReceiver(handler) as receiver:
+        server = make_server(receiver, port=8080)
+        server.serve_forever()
+"""
+
+import threading
+
+from collections import OrderedDict
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server as _make_server
+
+try:
+  from socketserver import ThreadingMixIn
+except ImportError:
+  from SocketServer import ThreadingMixIn
+
+try:
+  from queue import Queue, Empty, Full
+except ImportError:
+  from Queue import Queue, Empty, Full
+
+from timeit import default_timer
+
+from bitbucket.errors import BitBucketError
+from bitbucket.models import Model, Field
+
+# Statuses returned to BitBucket, along with their reason phrases.
+STATUS_ACCEPTED = '202 Accepted'
+STATUS_DUPLICATE = '200 OK'
+STATUS_BAD_REQUEST = '400 Bad Request'
+STATUS_METHOD_NOT_ALLOWED = '405 Method Not Allowed'
+STATUS_TOO_LARGE = '413 Request Entity Too Large'
+STATUS_OVERLOADED = '503 Service Unavailable'
+
+
+class WebhookPayload(Model):
+  """ The body of a webhook delivery, decoded when one of its fields is first read. """
+  __slots__ = ()
+  _identifier = 'repository_full_name'
+
+  repository_full_name = Field(('repository', 'full_name'))
+  actor = Field(('actor', 'username'), ('actor', 'display_name'))
+  changes = Field(('push', 'changes'), converter=tuple)
+
+
+class WebhookEvent(object):
+  """ A received webhook delivery. `event_key` is the type of the event (e.g. `repo:push`),
+      `delivery_id` the unique id of the delivery and `payload` the lazily decoded
+      WebhookPayload.
+  """
+  __slots__ = ('event_key', 'delivery_id', 'hook_uuid', 'received', 'payload')
+
+  def __init__(self, event_key, delivery_id, hook_uuid, body):
+    self.event_key = event_key
+    self.delivery_id = delivery_id
+    self.hook_uuid = hook_uuid
+    self.received = default_timer()
+    self.payload = WebhookPayload(raw=body)
+
+  @property
+  def namespace(self):
+    """ Returns the namespace of the repository the event is about, if any. """
+    full_name = self.payload.repository_full_name
+    return full_name.split('/', 1)[0] if full_name else None
+
+  @property
+  def repository_name(self):
+    """ Returns the name of the repository the event is about, if any. """
+    full_name = self.payload.repository_full_name
+    return full_name.split('/', 1)[1] if full_name and '/' in full_name else None
+
+  def __repr__(self):
+    return '<WebhookEvent %s %s>' % (self.event_key, self.delivery_id)
+
+
+class WebhookReceiver(object):
+  """ Receives webhook deliveries and calls `handler` with lists of at most `batch_size`
+      WebhookEvents from a pool of `workers` threads. A worker waits up to `batch_delay` seconds
+      for a batch to fill before handing it over.
+
+      Deliveries whose id was among the last `dedup_size` received are acknowledged but
+      dropped. At most `queue_size` events are queued; once full, deliveries are refused with a
+      503 so that BitBucket retries them later, as are the deliveries received while the
+      receiver is stopping. Bodies over `max_body_size` bytes are refused
+      with a 413. Exceptions raised by the handler are passed to `on_error`, if given, along with
+      the batch; `errors` counts them, as well as the exceptions raised by `on_error` itself.
+  """
+  def __init__(self, handler, on_error=None, workers=4, batch_size=50, batch_delay=0.1,
+               queue_size=1000, dedup_size=10000, max_body_size=10 * 1024 * 1024,
+               retry_after=5):
+    self._handler = handler
+    self._on_error = on_error
+    self._workers = workers
+    self._batch_size = batch_size
+    self._batch_delay = batch_delay
+    self._dedup_size = dedup_size
+    self._max_body_size = max_body_size
+    self._retry_after = retry_after
+
+    self._queue = Queue(maxsize=queue_size)
+    self._seen = OrderedDict()
+    self._lock = threading.Lock()
+    self._threads = []
+    self._stopping = object()
+    self._stopped = False
+
+    self.received = 0
+    self.duplicates = 0
+    self.rejected = 0
+    self.processed = 0
+    self.errors = 0
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.stop()
+
+  def start(self):
+    """ Starts the worker threads. """
+    if self._threads:
+      return
+
+    self._stopped = False
+    for _ in range(self._workers):
+      thread = threading.Thread(target=self._run_worker)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def stop(self):
+    """ Stops the worker threads once the queued events have been processed. """
+    with self._lock:
+      self._stopped = True
+    for _ in self._threads:
+      self._queue.put(self._stopping)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+  @property
+  def max_body_size(self):
+    """ Returns the size, in bytes, over which deliveries are refused. """
+    return self._max_body_size
+
+  def stats(self):
+    """ Returns a dictionary of the delivery counters and the current queue length. """
+    with self._lock:
+      return {
+        'received': self.received,
+        'duplicates': self.duplicates,
+        'rejected': self.rejected,
+        'processed': self.processed,
+        'errors': self.errors,
+        'queued': self._queue.qsize(),
+      }
+
+  def _is_duplicate(self, delivery_id):
+    """ Records the delivery id, returning whether it was already seen. """
+    with self._lock:
+      if delivery_id in self._seen:
+        self.duplicates += 1
+        return True
+
+      self._seen[delivery_id] = True
+      if len(self._seen) > self._dedup_size:
+        self._seen.popitem(last=False)
+      return False
+
+  def receive(self, headers, body):
+    """ Queues the delivery with the given headers (a dictionary keyed by lowercase header
+        name) and body, returning the status to respond with.
+    """
+    event_key = headers.get('x-event-key')
+    if not event_key:
+      return STATUS_BAD_REQUEST
+
+    delivery_id = headers.get('x-request-uuid')
+    if delivery_id and self._is_duplicate(delivery_id):
+      return STATUS_DUPLICATE
+
+    event = WebhookEvent(event_key, delivery_id, headers.get('x-hook-uuid'), body)
+    # Checked and queued under the lock, so that no event is queued once `stop` has run.
+    with self._lock:
+      try:
+        if self._stopped:
+          raise Full()
+        self._queue.put_nowait(event)
+      except Full:
+        # The delivery id is forgotten, so that the refused delivery is accepted when retried.
+        if delivery_id:
+          self._seen.pop(delivery_id, None)
+        self.rejected += 1
+        return STATUS_OVERLOADED
+
+      self.received += 1
+
+    return STATUS_ACCEPTED
+
+  def __call__(self, environ, start_response):
+    """ Handles a webhook delivery as a WSGI application. """
+    if environ.get('REQUEST_METHOD') != 'POST':
+      return self._respond(start_response, STATUS_METHOD_NOT_ALLOWED)
+
+    try:
+      length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+      return self._respond(start_response, STATUS_BAD_REQUEST)
+
+    if length > self.max_body_size:
+      return self._respond(start_response, STATUS_TOO_LARGE)
+
+    body = environ['wsgi.input'].read(length) if length else b''
+    headers = {}
+    for (key, value) in environ.items():
+      if key.startswith('HTTP_'):
+        headers[key[5:].replace('_', '-').lower()] = value
+
+    return self._respond(start_response, self.receive(headers, body))
+
+  def response_headers(self, status):
+    """ Returns the headers of the (empty) response with the given status. """
+    headers = [('Content-Type', 'text/plain'), ('Content-Length', '0')]
+    if status == STATUS_OVERLOADED:
+      headers.append(('Retry-After', str(self._retry_after)))
+    return headers
+
+  def _respond(self, start_response, status):
+    """ Starts an empty WSGI response with the given status. """
+    start_response(status, self.response_headers(status))
+    return [b'']
+
+  def _next_batch(self):
+    """ Blocks for the next batch of events, returning it along with whether this worker was
+        asked to stop once the batch is handled. The batch is empty when there is nothing left
+        to handle.
+    """
+    event = self._queue.get()
+    if event is self._stopping:
+      return ([], True)
+
+    batch = [event]
+    deadline = default_timer() + self._batch_delay
+    while len(batch) < self._batch_size:
+      remaining = deadline - default_timer()
+      try:
+        event = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+      except Empty:
+        break
+
+      if event is self._stopping:
+        return (batch, True)
+      batch.append(event)
+
+    return (batch, False)
+
+  def _run_worker(self):
+    """ Hands batches of events to the handler until the receiver is stopped. """
+    stopping = False
+    while not stopping:
+      (batch, stopping) = self._next_batch()
+      if batch:
+        self._handle(batch)
+
+  def _handle(self, batch):
+    """ Hands a batch of events to the handler, passing its failure to `on_error`. """
+    try:
+      self._handler(batch)
+    except Exception as ex:
+      with self._lock:
+        self.errors += 1
+      if self._on_error is not None:
+        try:
+          self._on_error(batch, ex)
+        except Exception:
+          # The worker must survive a failing `on_error`; the failure is counted instead.
+          with self._lock:
+            self.errors += 1
+    finally:
+      with self._lock:
+        self.processed += len(batch)
+
+
+def _pushed_repositories(events):
+  """ Returns the distinct `(namespace, repository_name)` pairs pushed to in the events, in the
+      order first seen.
+  """
+  repositories = OrderedDict()
+  for event in events:
+    if event.event_key == 'repo:push' and event.repository_name:
+      repositories[(event.namespace, event.repository_name)] = True
+  return list(repositories)
+
+
+def poller_handler(poller):
+  """ Returns a handler which triggers an immediate poll by the given RefPoller of the
+      repositories pushed to, so that the poller can run with a long `max_interval`.
+  """
+  def handle(events):
+    for (namespace, repository_name) in _pushed_repositories(events):
+      poller.trigger(namespace, repository_name)
+  return handle
+
+
+def sync_handler(engine, on_delta):
+  """ Returns a handler which syncs the repositories pushed to with the given
+      ChangesetSyncEngine, calling `on_delta` with each ChangesetDelta. Multiple pushes to a
+      repository within a batch cause a single sync. Failed syncs are raised as a single
+      BitBucketError once the whole batch has been handled.
+  """
+  def handle(events):
+    errors = []
+    for (namespace, repository_name) in _pushed_repositories(events):
+      (result, delta, error) = engine.sync(namespace, repository_name)
+      if result:
+        on_delta(delta)
+      else:
+        errors.append('%s/%s: %s' % (namespace, repository_name, error))
+
+    if errors:
+      raise BitBucketError('Could not sync %s' % '; '.join(errors))
+  return handle
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+  """ A WSGI server handling each request on its own thread. """
+  daemon_threads = True
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+  """ A WSGI request handler which does not log requests. """
+  def log_message(self, format, *args):
+    pass
+
+
+def make_server(receiver, host='127.0.0.1', port=0):
+  """ Returns a threaded HTTP server serving the receiver, for local use and testing. Its
+      `server_port` attribute holds the port bound when `port` is 0.
+  """
+  return _make_server(host, port, receiver, server_class=_ThreadingWSGIServer,
+                      handler_class=_QuietRequestHandler)
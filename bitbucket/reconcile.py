@@ -0,0 +1,339 @@
+""" Defines the declarative reconciliation of the webhooks, deploy keys, links and services of
+    many repositories against a desired state.
+"""
+
+from abc import ABCMeta, abstractmethod
+from collections import namedtuple
+
+# The desired state of a repository. Each of `webhooks`, `deploy_keys`, `links` and `services`
+# is either None, to leave that kind of resource untouched, or a list of specs:
+#   webhooks: dictionaries with `url`, `description`, `events` and optionally `active` and
+#             `skip_cert_verification`; identified by URL.
+#   deploy_keys: dictionaries with `label` and `key`; identified by the key type and material.
+#   links: dictionaries with `handler`, `link_url` and `link_key`; identified by the handler and
+#          key.
+#   services: dictionaries with the service `type` and its fields; identified by all of them.
+# When `prune` is True, resources of the managed kinds which match no spec are deleted.
+DesiredState = namedtuple('DesiredState', ['webhooks', 'deploy_keys', 'links', 'services',
+                                           'prune'])
+DesiredState.__new__.__defaults__ = (None, None, None, None, False)
+
+# A mutation needed to reconcile a repository. `action` is one of 'create', 'update', 'replace'
+# (delete then create, for resources which cannot be updated; the existing resource is recreated
+# if the creation fails) or 'delete'; `existing` is the current resource (None when creating)
+# and `desired` the spec (None when deleting).
+Change = namedtuple('Change', ['kind', 'action', 'key', 'existing', 'desired'])
+
+# The outcome of reconciling a repository. `changes` lists the mutations needed, `results` a
+# `(change, result, error)` tuple for each mutation applied (empty in dry-run mode) and `error`
+# the error encountered when retrieving the current state, in which case nothing was changed.
+RepositoryReport = namedtuple('RepositoryReport', ['namespace', 'repository_name', 'changes',
+                                                   'results', 'error'])
+
+
+# The metaclass is applied through the base so that this works on both Python 2 and 3.
+class _ResourceKind(ABCMeta('_AbstractBase', (object,), {})):
+  """ Describes how a kind of resource is listed, compared and mutated. """
+  # Name of the DesiredState field and of the repository client accessor.
+  name = None
+  accessor = None
+
+  def fetch(self, repository_client):
+    """ Retrieves the current resources of the repository, returning a `(result, data, error)`
+        tuple.
+    """
+    return getattr(repository_client, self.accessor)().all()
+
+  def items(self, data):
+    """ Returns the resources in the data returned by `fetch`. """
+    return data or []
+
+  @abstractmethod
+  def key(self, resource):
+    """ Returns the identity of an existing resource. """
+
+  @abstractmethod
+  def spec_key(self, spec):
+    """ Returns the identity of a desired resource spec. """
+
+  @abstractmethod
+  def spec(self, resource):
+    """ Returns the spec recreating an existing resource. """
+
+  def differs(self, existing, spec):
+    """ Returns whether the existing resource must be changed to match the spec. """
+    return False
+
+  @abstractmethod
+  def create(self, resource_client, spec):
+    """ Creates a resource from the spec. """
+
+  @abstractmethod
+  def delete(self, resource_client, existing):
+    """ Deletes the existing resource. """
+
+  # Kinds whose resources can be updated in place override this; others are replaced.
+  update = None
+
+
+class _WebhookKind(_ResourceKind):
+  name = 'webhooks'
+  accessor = 'webhooks'
+
+  def fetch(self, repository_client):
+    return repository_client.webhooks().all_pages()
+
+  def items(self, data):
+    return (data or {}).get('values') or []
+
+  def key(self, resource):
+    return resource.get('url')
+
+  def spec_key(self, spec):
+    return spec['url']
+
+  def spec(self, resource):
+    return {'url': resource.get('url'), 'description': resource.get('description'),
+            'events': resource.get('events') or [], 'active': resource.get('active', True),
+            'skip_cert_verification': resource.get('skip_cert_verification', False)}
+
+  def differs(self, existing, spec):
+    return (existing.get('description') != spec['description'] or
+            bool(existing.get('active', True)) != bool(spec.get('active', True)) or
+            bool(existing.get('skip_cert_verification', False)) !=
+            bool(spec.get('skip_cert_verification', False)) or
+            sorted(existing.get('events') or []) != sorted(spec['events']))
+
+  def create(self, resource_client, spec):
+    return resource_client.create(spec['description'], spec['url'], spec['events'],
+                                  active=spec.get('active', True),
+                                  skip_cert_verification=spec.get('skip_cert_verification', False))
+
+  def update(self, resource_client, existing, spec):
+    return resource_client.update(existing['uuid'], spec['description'], spec['url'],
+                                  spec['events'], active=spec.get('active', True),
+                                  skip_cert_verification=spec.get('skip_cert_verification',
+                                                                  False))
+
+  def delete(self, resource_client, existing):
+    return resource_client.delete(existing['uuid'])
+
+
+class _DeployKeyKind(_ResourceKind):
+  name = 'deploy_keys'
+  accessor = 'deploykeys'
+
+  def key(self, resource):
+    # Only the key type and material identify a key; the trailing comment is not significant.
+    return ' '.join((resource.get('key') or '').split()[:2])
+
+  def spec_key(self, spec):
+    return self.key(spec)
+
+  def spec(self, resource):
+    return {'label': resource.get('label'), 'key': resource.get('key')}
+
+  def differs(self, existing, spec):
+    return existing.get('label') != spec['label']
+
+  def create(self, resource_client, spec):
+    return resource_client.create(spec['label'], spec['key'])
+
+  def delete(self, resource_client, existing):
+    return resource_client.delete(existing['pk'])
+
+
+class _LinkKind(_ResourceKind):
+  name = 'links'
+  accessor = 'links'
+
+  def key(self, resource):
+    return (self._handler(resource), resource.get('link_key'))
+
+  @staticmethod
+  def _handler(resource):
+    handler = resource.get('handler')
+    if isinstance(handler, dict):
+      handler = handler.get('name')
+    return handler
+
+  def spec_key(self, spec):
+    return (spec['handler'], spec['link_key'])
+
+  def spec(self, resource):
+    return {'handler': self._handler(resource), 'link_url': resource.get('link_url'),
+            'link_key': resource.get('link_key')}
+
+  def differs(self, existing, spec):
+    return existing.get('link_url') != spec['link_url']
+
+  def create(self, resource_client, spec):
+    return resource_client.create(spec['handler'], spec['link_url'], spec['link_key'])
+
+  def delete(self, resource_client, existing):
+    return resource_client.delete(existing['id'])
+
+
+class _ServiceKind(_ResourceKind):
+  name = 'services'
+  accessor = 'services'
+
+  def key(self, resource):
+    service = resource.get('service') or {}
+    fields = tuple(sorted((field['name'], field.get('value'))
+                          for field in service.get('fields') or []))
+    return (service.get('type'), fields)
+
+  def spec_key(self, spec):
+    fields = tuple(sorted((name, value) for (name, value) in spec.items() if name != 'type'))
+    return (spec['type'], fields)
+
+  def spec(self, resource):
+    (service_type, fields) = self.key(resource)
+    spec = dict(fields)
+    spec['type'] = service_type
+    return spec
+
+  def create(self, resource_client, spec):
+    fields = dict((name, value) for (name, value) in spec.items() if name != 'type')
+    return resource_client.create(spec['type'], **fields)
+
+  def delete(self, resource_client, existing):
+    return resource_client.delete(existing['id'])
+
+
+# The kinds of resources managed, which describe how their resources are fetched, identified,
+# compared and mutated, by DesiredState field name.
+KINDS = (_WebhookKind(), _DeployKeyKind(), _LinkKind(), _ServiceKind())
+KINDS_BY_NAME = dict((kind.name, kind) for kind in KINDS)
+
+
+def plan_changes(kind, existing_resources, specs, prune):
+  """ Returns the list of Changes turning the existing resources of the kind into the specs. """
+  existing_by_key = {}
+  for resource in existing_resources:
+    existing_by_key.setdefault(kind.key(resource), resource)
+
+  changes = []
+  desired_keys = set()
+  for spec in specs:
+    key = kind.spec_key(spec)
+    if key in desired_keys:
+      continue
+    desired_keys.add(key)
+
+    existing = existing_by_key.get(key)
+    if existing is None:
+      changes.append(Change(kind.name, 'create', key, None, spec))
+    elif kind.differs(existing, spec):
+      action = 'update' if kind.update is not None else 'replace'
+      changes.append(Change(kind.name, action, key, existing, spec))
+
+  if prune:
+    for resource in existing_resources:
+      if kind.key(resource) not in desired_keys:
+        changes.append(Change(kind.name, 'delete', kind.key(resource), resource, None))
+
+  return changes
+
+
+def _apply_change(repository_client, change):
+  """ Applies a single change, returning a `(result, data, error)` tuple. """
+  kind = KINDS_BY_NAME[change.kind]
+  resource_client = getattr(repository_client, kind.accessor)()
+  if change.action == 'create':
+    return kind.create(resource_client, change.desired)
+  if change.action == 'update':
+    return kind.update(resource_client, change.existing, change.desired)
+  if change.action == 'delete':
+    return kind.delete(resource_client, change.existing)
+
+  # BitBucket refuses a second resource with the same identity (e.g. the same deploy key), so the
+  # existing resource is deleted first, and recreated if its replacement cannot be created.
+  (result, data, error) = kind.delete(resource_client, change.existing)
+  if not result:
+    return (result, data, error)
+
+  (result, data, error) = kind.create(resource_client, change.desired)
+  if result:
+    return (result, data, error)
+
+  (restored, _, restore_error) = kind.create(resource_client, kind.spec(change.existing))
+  if restored:
+    return (False, None, 'Could not replace the resource, which was restored: %s' % error)
+  return (False, None, 'Could not replace the resource (%s), nor restore it: %s' %
+          (error, restore_error))
+
+
+def reconcile(client, desired, dry_run=False, max_workers=8):
+  """ Reconciles repositories against their desired state. `desired` maps (or is a list of
+      pairs of) `(namespace, repository_name)` pairs to a DesiredState. The current resources
+      of every managed kind are retrieved concurrently, the changes are computed locally and
+      then only those are applied, at most `max_workers` requests being in flight at a time.
+      Returns a RepositoryReport for each repository, in the order of `desired`, whose results
+      are in completion order. When `dry_run` is True, the changes are computed but not
+      applied.
+  """
+  desired = list(desired.items()) if hasattr(desired, 'items') else list(desired)
+  fetch_jobs = []
+  for ((namespace, repository_name), state) in desired:
+    for kind in KINDS:
+      if getattr(state, kind.name) is not None:
+        fetch_jobs.append((namespace, repository_name, _FetchOperation(kind)))
+
+  current = {}
+  for bulk_result in client.bulk(fetch_jobs, max_workers=max_workers):
+    current[(bulk_result.namespace, bulk_result.repository_name,
+             bulk_result.operation.kind.name)] = bulk_result
+
+  reports = {}
+  apply_jobs = []
+  for ((namespace, repository_name), state) in desired:
+    changes = []
+    error = None
+    for kind in KINDS:
+      specs = getattr(state, kind.name)
+      if specs is None:
+        continue
+
+      bulk_result = current[(namespace, repository_name, kind.name)]
+      if not bulk_result.result:
+        error = bulk_result.error
+        break
+      changes.extend(plan_changes(kind, kind.items(bulk_result.data), specs, state.prune))
+
+    if error is not None:
+      changes = []
+    reports[(namespace, repository_name)] = RepositoryReport(namespace, repository_name, changes,
+                                                             [], error)
+    if not dry_run:
+      for change in changes:
+        apply_jobs.append((namespace, repository_name, _ChangeOperation(change)))
+
+  for bulk_result in client.bulk(apply_jobs, max_workers=max_workers):
+    report = reports[(bulk_result.namespace, bulk_result.repository_name)]
+    report.results.append((bulk_result.operation.change, bulk_result.result, bulk_result.error))
+
+  return [reports[repository] for (repository, _) in desired]
+
+
+class _FetchOperation(object):
+  """ A bulk operation retrieving the resources of a kind, which remembers the kind. """
+  __slots__ = ('kind',)
+
+  def __init__(self, kind):
+    self.kind = kind
+
+  def __call__(self, repository_client):
+    return self.kind.fetch(repository_client)
+
+
+class _ChangeOperation(object):
+  """ A bulk operation applying a change, which remembers the change for the report. """
+  __slots__ = ('change',)
+
+  def __init__(self, change):
+    self.change = change
+
+  def __call__(self, repository_client):
+    return _apply_change(repository_client, self.change)
@@ -1,22 +1,20 @@
 """ Defines a client class for working with BitBucket repositories. """
 
 from bitbucket.repository import BitBucketRepositoryClient
+from bitbucket.context import BitBucketContext, ContextClient
 
-class BitBucketRepositoriesClient(object):
+class BitBucketRepositoriesClient(ContextClient):
   """ Client class representing the repositories under a namespace in bitbucket. """
+  __slots__ = ()
+
   def __init__(self, dispatcher, access_token, access_token_secret, namespace):
-    self._dispatcher = dispatcher
-    self._access_token = access_token
-    self._access_token_secret = access_token_secret
-    self._namespace = namespace
+    self._attach(BitBucketContext(dispatcher, access_token, access_token_secret, namespace))
 
   @property
   def namespace(self):
     """ Returns the namespace. """
-    return self._namespace
+    return self._context.namespace
 
   def get(self, repository_name):
     """ Returns a client for interacting with a specific repository. """
-    return BitBucketRepositoryClient(self._dispatcher, self._access_token,
-                                     self._access_token_secret, self._namespace,
-                                     repository_name)
\ No newline at end of file
+    return BitBucketRepositoryClient.from_context(self._context.for_repository(repository_name))
\ No newline at end of file
@@ -1,121 +1,242 @@
 """ Defines a client class for working with a specific BitBucket repository. """
 
+import os
+import re
+
 from bitbucket.urls import (repository_branches_url, repository_tags_url, repository_branches_tags_url,
                   repository_manifest_url, repository_path_contents_url,
                   repository_path_raw_contents_url, repository_main_branch_url,
                   repository_branch_url, repository_tag_url)
 
+from bitbucket.batch import Batch
+from bitbucket.context import BitBucketContext, ContextClient
+from bitbucket.errors import BitBucketError
+from bitbucket.models import Branch, decode_body, model_result, model_list_result
+from bitbucket.snapshot import take_snapshot
 from bitbucket.deploykeys import BitBucketRepositoryDeployKeysClient
 from bitbucket.links import BitBucketRepositoryLinksClient
 from bitbucket.services import BitBucketRepositoryServicesClient
 from bitbucket.changesets import BitBucketRepositoryChangeSetsClient
 from bitbucket.webhooks import BitBucketRepositoryWebhooksClient
 
-class BitBucketRepositoryClient(object):
+# Full commit hashes (SHA-1 or SHA-256) name immutable revisions; anything else (branch names,
+# tags, 'default', short hashes) may move.
+_IMMUTABLE_REVISION_REGEX = re.compile(r'^(?:[0-9a-f]{40}|[0-9a-f]{64})$')
+
+
+def _write_chunks(chunks, destination_file):
+  """ Writes the streamed chunks to the file object, returning the number of bytes written. """
+  written = 0
+  try:
+    for chunk in chunks:
+      destination_file.write(chunk)
+      written += len(chunk)
+  except BitBucketError as bbe:
+    return (False, None, str(bbe))
+  finally:
+    chunks.close()
+
+  return (True, written, None)
+
+
+class BitBucketRepositoryClient(ContextClient):
   """ Client class representing a repository in bitbucket. """
+  __slots__ = ('_changesets', '_webhooks', '_services', '_links', '_deploykeys')
+
   def __init__(self, dispatcher, access_token, access_token_secret, namespace, repository_name):
-    self._dispatcher = dispatcher
-    self._access_token = access_token
-    self._access_token_secret = access_token_secret
-    self._namespace = namespace
-    self._repository_name = repository_name
+    self._attach(BitBucketContext(dispatcher, access_token, access_token_secret, namespace,
+                                  repository_name))
+
+  def _attach(self, context):
+    self._context = context
+    self._changesets = None
+    self._webhooks = None
+    self._services = None
+    self._links = None
+    self._deploykeys = None
 
   @property
   def namespace(self):
     """ Returns the namespace. """
-    return self._namespace
+    return self._context.namespace
 
   @property
   def repository_name(self):
     """ Returns the repository name. """
-    return self._repository_name
+    return self._context.repository_name
 
   def changesets(self):
     """ Returns a resource for managing the changesets under this repository. """
-    return BitBucketRepositoryChangeSetsClient(self._dispatcher, self._access_token,
-                                              self._access_token_secret, self._namespace,
-                                              self._repository_name)
+    if self._changesets is None:
+      self._changesets = BitBucketRepositoryChangeSetsClient.from_context(self._context)
+    return self._changesets
 
   def webhooks(self):
     """ Returns a resource for managing the webhooks under this repository. """
-    return BitBucketRepositoryWebhooksClient(self._dispatcher, self._access_token,
-                                             self._access_token_secret, self._namespace,
-                                             self._repository_name)
+    if self._webhooks is None:
+      self._webhooks = BitBucketRepositoryWebhooksClient.from_context(self._context)
+    return self._webhooks
 
   def services(self):
     """ Returns a resource for managing the services under this repository. """
-    return BitBucketRepositoryServicesClient(self._dispatcher, self._access_token,
-                                             self._access_token_secret, self._namespace,
-                                             self._repository_name)
+    if self._services is None:
+      self._services = BitBucketRepositoryServicesClient.from_context(self._context)
+    return self._services
 
   def links(self):
     """ Returns a resource for managing the links under this repository. """
-    return BitBucketRepositoryLinksClient(self._dispatcher, self._access_token,
-                                          self._access_token_secret, self._namespace,
-                                          self._repository_name)
+    if self._links is None:
+      self._links = BitBucketRepositoryLinksClient.from_context(self._context)
+    return self._links
 
   def deploykeys(self):
     """ Returns a resource for managing the deploy keys under this repository. """
-    return BitBucketRepositoryDeployKeysClient(self._dispatcher, self._access_token,
-                                               self._access_token_secret, self._namespace,
-                                               self._repository_name)
+    if self._deploykeys is None:
+      self._deploykeys = BitBucketRepositoryDeployKeysClient.from_context(self._context)
+    return self._deploykeys
+
+  def batch(self, max_workers=8):
+    """ Returns a `Batch` recording the calls made through it on this repository and sending
+        them concurrently when its `with` block exits. Only usable with the blocking `BitBucket`
+        dispatcher.
+    """
+    context = self._context
+    context.require_blocking('batch')
+    def client_factory(dispatcher):
+      return BitBucketRepositoryClient(dispatcher, context.access_token,
+                                       context.access_token_secret, context.namespace,
+                                       context.repository_name)
+    return Batch(client_factory, context.dispatcher, max_workers=max_workers)
 
   def get_main_branch(self):
     """ Returns the main branch for this repository. """
-    url = repository_main_branch_url(self._namespace, self._repository_name)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    url = repository_main_branch_url(self._context.namespace, self._context.repository_name)
+    return self._context.dispatch(url)
+
+  def get_branches(self, typed=False):
+    """ Returns the list of branches in this repository. If `typed` is True, the branches are
+        returned as a lazily decoded sequence of `Branch` models.
+    """
+    url = repository_branches_url(self._context.namespace, self._context.repository_name)
+    if typed:
+      return self._context.dispatch_then(
+          url, lambda result: model_list_result(result, Branch, name_key='name'), raw=True)
 
-  def get_branches(self):
-    """ Returns the list of branches in this repository. """
-    url = repository_branches_url(self._namespace, self._repository_name)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    return self._context.dispatch(url)
 
   def get_tags(self):
     """ Returns the list of tags in this repository. """
-    url = repository_tags_url(self._namespace, self._repository_name)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    url = repository_tags_url(self._context.namespace, self._context.repository_name)
+    return self._context.dispatch(url)
 
   def get_branches_and_tags(self):
     """ Returns the list of branches and tags in this repository. """
-    url = repository_branches_tags_url(self._namespace, self._repository_name)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    url = repository_branches_tags_url(self._context.namespace, self._context.repository_name)
+    return self._context.dispatch(url)
+
+  def _dispatch_for_revision(self, kind, url, revision, path=None):
+    """ Dispatches a read of repository contents at the given revision, going through the
+        dispatcher's content cache when the revision is a full commit hash.
+    """
+    content_cache = self._context.dispatcher.content_cache
+    if content_cache is None or not _IMMUTABLE_REVISION_REGEX.match(revision):
+      return self._context.dispatch(url)
+
+    cache_key = content_cache.cache_key(kind, self._context.namespace,
+                                        self._context.repository_name, revision, path)
+
+    def read():
+      (found, content) = content_cache.get(cache_key)
+      if found:
+        return (True, content, None)
+
+      # The raw body is fetched so that the entry is sized without serializing the content again.
+      (result, body, error) = self._context.dispatch(url, raw=True)
+      if not result:
+        return (result, body, error)
+
+      content = decode_body(body)
+      content_cache.set(cache_key, content, size=len(body))
+      return (True, content, None)
+
+    return self._context.call(read)
 
   def get_manifest(self, revision='default'):
     """ Returns the manifest for the repository. """
-    url = repository_manifest_url(self._namespace, self._repository_name, revision)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    url = repository_manifest_url(self._context.namespace, self._context.repository_name, revision)
+    return self._dispatch_for_revision('manifest', url, revision)
 
   def get_path_contents(self, path, revision='default'):
     """ Returns the contents of the given path. If the path ends in a /, it is treated as a
         directory and the contents of the directory are returned.
     """
-    url = repository_path_contents_url(self._namespace, self._repository_name, revision, path)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    context = self._context
+    url = repository_path_contents_url(context.namespace, context.repository_name, revision, path)
+    return self._dispatch_for_revision('src', url, revision, path)
+
+  def snapshot(self, revision='default', index_path=None, max_workers=8):
+    """ Returns a tuple of whether it succeeded and the `RepositorySnapshot` of the whole source
+        tree at the given revision (or the error encountered), built by listing its directories
+        breadth first with at most `max_workers` listings in flight. The snapshot answers path,
+        prefix and glob queries locally; it is held in memory, or in the SQLite database at
+        `index_path` if given. When the revision is a full commit hash, the snapshot is reused
+        from that database or from the dispatcher's content cache, if any, without contacting
+        BitBucket. Only usable with the blocking `BitBucket` dispatcher.
+    """
+    self._context.require_blocking('snapshot')
+    content_cache = self._context.dispatcher.content_cache
+    immutable = bool(_IMMUTABLE_REVISION_REGEX.match(revision))
+    return take_snapshot(self, revision, immutable, content_cache=content_cache,
+                         index_path=index_path, max_workers=max_workers)
 
-  def get_raw_path_contents(self, path, revision='default'):
+  def get_raw_path_contents(self, path, revision='default', stream=False):
     """ Returns the raw contents of the given path. If the path ends in a /, it is treated as a
-        directory and the contents of the directory are returned.
+        directory and the contents of the directory are returned. If `stream` is True, the
+        contents are returned as an iterator of byte chunks rather than being read into memory.
     """
-    url = repository_path_raw_contents_url(self._namespace, self._repository_name, revision, path)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    context = self._context
+    url = repository_path_raw_contents_url(context.namespace, context.repository_name, revision,
+                                           path)
+    if stream:
+      return self._context.dispatch(url, stream=True)
+
+    return self._dispatch_for_revision('raw', url, revision, path)
+
+  def download_raw_path_contents(self, path, destination, revision='default'):
+    """ Streams the raw contents of the given path into `destination`, which is either a
+        writable binary file object or the path of a file to create. Returns the number of bytes
+        written. A partially written destination file is removed on failure. Only usable with the
+        blocking `BitBucket` dispatcher.
+    """
+    self._context.require_blocking('download_raw_path_contents')
+    (result, chunks, error) = self.get_raw_path_contents(path, revision=revision, stream=True)
+    if not result:
+      return (False, None, error)
+
+    if hasattr(destination, 'write'):
+      return _write_chunks(chunks, destination)
+
+    with open(destination, 'wb') as destination_file:
+      (result, written, error) = _write_chunks(chunks, destination_file)
 
-  def get_branch(self, branch_name):
+    if not result:
+      os.remove(destination)
+
+    return (result, written, error)
+
+  def get_branch(self, branch_name, typed=False):
     """ Returns information about the branch with the specified name under this repository, if any.
+        The branch is returned as a `Branch` model if `typed` is True.
     """
-    url = repository_branch_url(self._namespace, self._repository_name, branch_name)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    url = repository_branch_url(self._context.namespace, self._context.repository_name, branch_name)
+    if typed:
+      return self._context.dispatch_then(url, lambda result: model_result(result, Branch),
+                                         raw=True)
+
+    return self._context.dispatch(url)
 
   def get_tag(self, tag_name):
     """ Returns information about the tag with the specified name under this repository, if any.
     """
-    url = repository_tag_url(self._namespace, self._repository_name, tag_name)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    url = repository_tag_url(self._context.namespace, self._context.repository_name, tag_name)
+    return self._context.dispatch(url)
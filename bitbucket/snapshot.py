@@ -0,0 +1,300 @@
+""" Defines snapshots of the source tree of a repository at a revision, built by crawling its
+    directories, along with the in-memory and SQLite indexes holding them.
+"""
+
+import bisect
+import fnmatch
+import re
+import sqlite3
+import threading
+
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# An entry of a snapshot. `type` is either 'file' or 'directory'; directories have no trailing
+# slash and no size. `hash` is the (short) node of the changeset which last modified a file, as
+# reported by the V1 source API, and None for directories.
+SnapshotEntry = namedtuple('SnapshotEntry', ['path', 'type', 'size', 'hash'])
+
+# Matches the first glob wildcard of a pattern.
+_WILDCARD_REGEX = re.compile(r'[*?\[]')
+
+# Sorts after any path starting with a given prefix.
+_PREFIX_END = u'\U0010ffff'
+
+
+def _literal_prefix(pattern):
+  """ Returns the part of the glob pattern before its first wildcard. """
+  match = _WILDCARD_REGEX.search(pattern)
+  return pattern[:match.start()] if match else pattern
+
+
+def _glob_entries(entries, pattern):
+  """ Returns the entries whose path matches the glob pattern. Both indexes match with
+      `fnmatch`, whose `[!...]` negation SQLite's GLOB does not understand.
+  """
+  return [entry for entry in entries if fnmatch.fnmatchcase(entry.path, pattern)]
+
+
+class MemorySnapshotIndex(object):
+  """ Holds the entries of a snapshot in memory, with the paths kept sorted for prefix queries.
+  """
+  def __init__(self):
+    self._entries = {}
+    self._paths = None
+    self.completed = None
+
+  def add(self, entries):
+    """ Adds the given SnapshotEntries. """
+    for entry in entries:
+      self._entries[entry.path] = entry
+    self._paths = None
+
+  def complete(self, namespace, repository_name, revision):
+    """ Marks the index as holding the complete snapshot of the repository at the given
+        revision.
+    """
+    self.completed = (namespace, repository_name, revision)
+
+  def get(self, path):
+    """ Returns the entry at the path, if any. """
+    return self._entries.get(path)
+
+  def _sorted_paths(self):
+    """ Returns the sorted list of paths, sorting them on first use. """
+    if self._paths is None:
+      self._paths = sorted(self._entries)
+    return self._paths
+
+  def prefix(self, prefix):
+    """ Returns the entries whose path starts with the prefix, sorted by path. """
+    paths = self._sorted_paths()
+    start = bisect.bisect_left(paths, prefix)
+    end = bisect.bisect_left(paths, prefix + _PREFIX_END)
+    return [self._entries[path] for path in paths[start:end]]
+
+  def glob(self, pattern):
+    """ Returns the entries whose path matches the glob pattern, sorted by path. """
+    return _glob_entries(self.prefix(_literal_prefix(pattern)), pattern)
+
+  def __len__(self):
+    return len(self._entries)
+
+
+class SQLiteSnapshotIndex(object):
+  """ Holds the entries of a snapshot in the SQLite database at the given path, so that large
+      trees need not be kept in memory and complete snapshots survive restarts.
+  """
+  def __init__(self, path):
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._lock = threading.Lock()
+    with self._lock:
+      self._connection.execute('CREATE TABLE IF NOT EXISTS snapshot_entries ('
+                               'path TEXT PRIMARY KEY, type TEXT NOT NULL, size INTEGER, '
+                               'hash TEXT)')
+      self._connection.execute('CREATE TABLE IF NOT EXISTS snapshot_meta ('
+                               'name TEXT PRIMARY KEY, value TEXT)')
+      self._connection.commit()
+
+  @property
+  def completed(self):
+    """ Returns the `(namespace, repository_name, revision)` of the complete snapshot held, if
+        any.
+    """
+    with self._lock:
+      meta = dict(self._connection.execute('SELECT name, value FROM snapshot_meta').fetchall())
+    try:
+      return (meta['namespace'], meta['repository_name'], meta['revision'])
+    except KeyError:
+      return None
+
+  def add(self, entries):
+    """ Adds the given SnapshotEntries. """
+    with self._lock:
+      self._connection.executemany('INSERT OR REPLACE INTO snapshot_entries '
+                                   '(path, type, size, hash) VALUES (?, ?, ?, ?)',
+                                   [tuple(entry) for entry in entries])
+      self._connection.commit()
+
+  def complete(self, namespace, repository_name, revision):
+    """ Marks the index as holding the complete snapshot of the repository at the given
+        revision.
+    """
+    with self._lock:
+      self._connection.executemany('INSERT OR REPLACE INTO snapshot_meta (name, value) '
+                                   'VALUES (?, ?)',
+                                   [('namespace', namespace),
+                                    ('repository_name', repository_name),
+                                    ('revision', revision)])
+      self._connection.commit()
+
+  def clear(self):
+    """ Removes all entries, along with the revision they were complete at. """
+    with self._lock:
+      self._connection.execute('DELETE FROM snapshot_entries')
+      self._connection.execute('DELETE FROM snapshot_meta')
+      self._connection.commit()
+
+  def _query(self, where, params):
+    """ Returns the entries matching the WHERE clause, sorted by path. """
+    with self._lock:
+      rows = self._connection.execute('SELECT path, type, size, hash FROM snapshot_entries '
+                                      'WHERE %s ORDER BY path' % where, params).fetchall()
+    return [SnapshotEntry(*row) for row in rows]
+
+  def get(self, path):
+    """ Returns the entry at the path, if any. """
+    entries = self._query('path = ?', (path,))
+    return entries[0] if entries else None
+
+  def prefix(self, prefix):
+    """ Returns the entries whose path starts with the prefix, sorted by path. """
+    return self._query('path >= ? AND path < ?', (prefix, prefix + _PREFIX_END))
+
+  def glob(self, pattern):
+    """ Returns the entries whose path matches the glob pattern, sorted by path. """
+    return _glob_entries(self.prefix(_literal_prefix(pattern)), pattern)
+
+  def __len__(self):
+    with self._lock:
+      return self._connection.execute('SELECT COUNT(*) FROM snapshot_entries').fetchone()[0]
+
+  def close(self):
+    """ Closes the database connection. """
+    with self._lock:
+      self._connection.close()
+
+
+class RepositorySnapshot(object):
+  """ The source tree of a repository at a revision. All queries are answered from the index
+      without contacting BitBucket.
+  """
+  def __init__(self, revision, index):
+    self.revision = revision
+    self._index = index
+
+  def get(self, path):
+    """ Returns the SnapshotEntry at the path (without trailing slash), if any. """
+    return self._index.get(path.rstrip('/'))
+
+  def prefix(self, prefix):
+    """ Returns the entries whose path starts with the prefix, sorted by path. """
+    return self._index.prefix(prefix)
+
+  def glob(self, pattern):
+    """ Returns the entries whose path matches the glob pattern, sorted by path. As with
+        `fnmatch`, `*` also matches slashes.
+    """
+    return self._index.glob(pattern)
+
+  def files(self):
+    """ Returns the entries of all the files, sorted by path. """
+    return [entry for entry in self._index.prefix('') if entry.type == 'file']
+
+  def __len__(self):
+    return len(self._index)
+
+  def __contains__(self, path):
+    return self.get(path) is not None
+
+  def __repr__(self):
+    return '<RepositorySnapshot %s (%d entries)>' % (self.revision, len(self))
+
+
+def _directory_entries(directory, data):
+  """ Returns the entries and the subdirectories found in a directory listing. """
+  entries = []
+  subdirectories = []
+  for name in data.get('directories') or []:
+    path = directory + name
+    entries.append(SnapshotEntry(path, 'directory', None, None))
+    subdirectories.append(path + '/')
+
+  for listed in data.get('files') or []:
+    path = listed['path']
+    if not path.startswith(directory):
+      path = directory + path
+    entries.append(SnapshotEntry(path, 'file', listed.get('size'), listed.get('revision')))
+
+  return (entries, subdirectories)
+
+
+def crawl(repository_client, revision, max_workers=8):
+  """ Lists every directory of the repository at the revision, breadth first, with at most
+      `max_workers` listings in flight. Returns a tuple of whether it succeeded and the list of
+      SnapshotEntries found (or the error encountered).
+  """
+  executor = ThreadPoolExecutor(max_workers=max_workers)
+  directories = deque([''])
+  pending = {}
+  entries = []
+  try:
+    while directories or pending:
+      while directories and len(pending) < max_workers:
+        directory = directories.popleft()
+        future = executor.submit(repository_client.get_path_contents, directory, revision)
+        pending[future] = directory
+
+      (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        directory = pending.pop(future)
+        (result, data, error) = future.result()
+        if not result:
+          return (False, None, error)
+
+        (found, subdirectories) = _directory_entries(directory, data)
+        entries.extend(found)
+        directories.extend(subdirectories)
+  finally:
+    for future in pending:
+      future.cancel()
+    executor.shutdown(wait=False)
+
+  return (True, entries, None)
+
+
+def take_snapshot(repository_client, revision, immutable, content_cache=None, index_path=None,
+                  max_workers=8):
+  """ Returns a tuple of whether it succeeded and the RepositorySnapshot of the repository at
+      the revision (or the error encountered). Snapshots at `immutable` revisions are reused
+      from the SQLite index at `index_path` when it already holds the one of the same
+      repository, and otherwise from (and stored into) the content cache, if any. The index is
+      closed when no snapshot is returned.
+  """
+  snapshot_key = (repository_client.namespace, repository_client.repository_name, revision)
+  index = SQLiteSnapshotIndex(index_path) if index_path is not None else MemorySnapshotIndex()
+  snapshot = None
+  try:
+    if index_path is not None:
+      if immutable and index.completed == snapshot_key:
+        snapshot = RepositorySnapshot(revision, index)
+        return (True, snapshot, None)
+      index.clear()
+
+    cache_key = None
+    if immutable and content_cache is not None:
+      cache_key = content_cache.cache_key('snapshot', repository_client.namespace,
+                                          repository_client.repository_name, revision, None)
+      (found, rows) = content_cache.get(cache_key)
+      if found:
+        index.add(SnapshotEntry(*row) for row in rows)
+        index.complete(*snapshot_key)
+        snapshot = RepositorySnapshot(revision, index)
+        return (True, snapshot, None)
+
+    (result, entries, error) = crawl(repository_client, revision, max_workers=max_workers)
+    if not result:
+      return (False, None, error)
+
+    index.add(entries)
+    index.complete(*snapshot_key)
+    if cache_key is not None:
+      # Sized by an estimate of the serialized entries rather than by serializing them.
+      content_cache.set(cache_key, [list(entry) for entry in entries],
+                        size=sum(len(entry.path) + 64 for entry in entries))
+
+    snapshot = RepositorySnapshot(revision, index)
+    return (True, snapshot, None)
+  finally:
+    if snapshot is None and index_path is not None:
+      index.close()
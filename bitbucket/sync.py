@@ -0,0 +1,222 @@
+""" Defines the incremental changeset sync engine and the stores it keeps its per-repository
+    cursors in.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+
+try:
+  from urllib import quote
+except ImportError:
+  from urllib.parse import quote
+
+from bitbucket.errors import BitBucketError
+
+# The changes found by a sync of a repository: `added` holds the new changesets (newest first),
+# `removed` the nodes of previously synced changesets which are no longer in the history, and
+# `resynced` is True when the history was rewritten beyond the remembered window, in which case
+# `added` holds the whole history.
+ChangesetDelta = namedtuple('ChangesetDelta', ['namespace', 'repository_name', 'added', 'removed',
+                                               'resynced'])
+
+# The sync position of a repository: the nodes of its most recently synced changesets, newest
+# first, and when it was last synced.
+SyncCursor = namedtuple('SyncCursor', ['nodes', 'updated'])
+
+
+def _changeset_node(changeset):
+  """ Returns the full node of a changeset. """
+  return changeset.get('raw_node') or changeset['node']
+
+
+def _quote_name(name):
+  """ Returns the name quoted for use in a filename, without any `/` or `_`. """
+  return quote(name, safe='').replace('_', '%5F')
+
+
+class MemoryCursorStore(object):
+  """ Keeps the sync cursors in memory. """
+  def __init__(self):
+    self._cursors = {}
+    self._lock = threading.Lock()
+
+  def get(self, namespace, repository_name):
+    """ Returns the cursor of the repository, if any. """
+    with self._lock:
+      return self._cursors.get((namespace, repository_name))
+
+  def set(self, namespace, repository_name, cursor):
+    """ Stores the cursor of the repository. """
+    with self._lock:
+      self._cursors[(namespace, repository_name)] = cursor
+
+  def delete(self, namespace, repository_name):
+    """ Forgets the cursor of the repository, so that it is fully synced again. """
+    with self._lock:
+      self._cursors.pop((namespace, repository_name), None)
+
+
+class FileCursorStore(object):
+  """ Keeps each sync cursor in a JSON file under the given directory. """
+  def __init__(self, directory):
+    self._directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def _path(self, namespace, repository_name):
+    """ Returns the path of the file holding the cursor of the repository. Underscores are
+        escaped too (quote keeps them), so that the `__` separator is unambiguous.
+    """
+    filename = '%s__%s.json' % (_quote_name(namespace), _quote_name(repository_name))
+    return os.path.join(self._directory, filename)
+
+  def get(self, namespace, repository_name):
+    """ Returns the cursor of the repository, if any. """
+    try:
+      with open(self._path(namespace, repository_name)) as cursor_file:
+        stored = json.load(cursor_file)
+    except (IOError, OSError, ValueError):
+      return None
+
+    return SyncCursor(stored['nodes'], stored['updated'])
+
+  def set(self, namespace, repository_name, cursor):
+    """ Stores the cursor of the repository. The file is written atomically. """
+    path = self._path(namespace, repository_name)
+    temp_path = '%s.%s.tmp' % (path, threading.current_thread().ident)
+    with open(temp_path, 'w') as cursor_file:
+      json.dump({'nodes': list(cursor.nodes), 'updated': cursor.updated}, cursor_file)
+    os.rename(temp_path, path)
+
+  def delete(self, namespace, repository_name):
+    """ Forgets the cursor of the repository, so that it is fully synced again. """
+    try:
+      os.remove(self._path(namespace, repository_name))
+    except OSError:
+      pass
+
+
+class SQLiteCursorStore(object):
+  """ Keeps the sync cursors in a table of the SQLite database at the given path. """
+  def __init__(self, path):
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._lock = threading.Lock()
+    with self._lock:
+      self._connection.execute('CREATE TABLE IF NOT EXISTS sync_cursors ('
+                               'namespace TEXT NOT NULL, repository_name TEXT NOT NULL, '
+                               'nodes TEXT NOT NULL, updated REAL NOT NULL, '
+                               'PRIMARY KEY (namespace, repository_name))')
+      self._connection.commit()
+
+  def get(self, namespace, repository_name):
+    """ Returns the cursor of the repository, if any. """
+    with self._lock:
+      row = self._connection.execute('SELECT nodes, updated FROM sync_cursors '
+                                     'WHERE namespace = ? AND repository_name = ?',
+                                     (namespace, repository_name)).fetchone()
+    if row is None:
+      return None
+
+    return SyncCursor(json.loads(row[0]), row[1])
+
+  def set(self, namespace, repository_name, cursor):
+    """ Stores the cursor of the repository. """
+    with self._lock:
+      self._connection.execute('INSERT OR REPLACE INTO sync_cursors '
+                               '(namespace, repository_name, nodes, updated) VALUES (?, ?, ?, ?)',
+                               (namespace, repository_name, json.dumps(list(cursor.nodes)),
+                                cursor.updated))
+      self._connection.commit()
+
+  def delete(self, namespace, repository_name):
+    """ Forgets the cursor of the repository, so that it is fully synced again. """
+    with self._lock:
+      self._connection.execute('DELETE FROM sync_cursors '
+                               'WHERE namespace = ? AND repository_name = ?',
+                               (namespace, repository_name))
+      self._connection.commit()
+
+  def close(self):
+    """ Closes the database connection. """
+    with self._lock:
+      self._connection.close()
+
+
+class ChangesetSyncEngine(object):
+  """ Incrementally mirrors the changesets of repositories. For each repository, the nodes of the
+      `window` most recently synced changesets are kept in the `store`; a sync only walks the
+      history (newest first, `page_size` changesets per request) until it reaches one of them.
+
+      When the newest remembered node is reached, only the new changesets are reported. When an
+      older remembered node is reached first, the history was rewritten (e.g. force-pushed) and
+      the remembered nodes newer than it are reported as removed. When none is reached, the
+      history was rewritten beyond the window and the whole history is reported again.
+  """
+  def __init__(self, client, store=None, page_size=50, window=200):
+    self._client = client
+    self._store = store if store is not None else MemoryCursorStore()
+    self._page_size = page_size
+    self._window = window
+
+  @property
+  def store(self):
+    """ Returns the cursor store. """
+    return self._store
+
+  def sync(self, namespace, repository_name):
+    """ Syncs the repository, returning a tuple of whether it succeeded and the ChangesetDelta
+        found (or the error encountered). The cursor is only advanced on success.
+    """
+    cursor = self._store.get(namespace, repository_name)
+    known_nodes = list(cursor.nodes) if cursor is not None else []
+    known_positions = dict((node, index) for (index, node) in enumerate(known_nodes))
+
+    changesets = (self._client.for_namespace(namespace).repositories().get(repository_name)
+                  .changesets())
+
+    added = []
+    matched_position = None
+    # Most syncs stop within the first page, so the next one is never requested ahead of time.
+    iterator = changesets.iter_all(page_size=self._page_size, prefetch=False)
+    try:
+      for changeset in iterator:
+        position = known_positions.get(_changeset_node(changeset))
+        if position is not None:
+          matched_position = position
+          break
+
+        added.append(changeset)
+    except BitBucketError as bbe:
+      return (False, None, str(bbe))
+    finally:
+      iterator.close()
+
+    if matched_position is not None:
+      removed = known_nodes[:matched_position]
+      remaining = known_nodes[matched_position:]
+      resynced = False
+    else:
+      removed = known_nodes
+      remaining = []
+      resynced = cursor is not None
+
+    nodes = ([_changeset_node(changeset) for changeset in added[:self._window]] +
+             remaining)[:self._window]
+    self._store.set(namespace, repository_name, SyncCursor(nodes, time.time()))
+
+    return (True, ChangesetDelta(namespace, repository_name, added, removed, resynced), None)
+
+  def sync_many(self, repositories, max_workers=8):
+    """ Syncs the given `(namespace, repository_name)` pairs concurrently, yielding a BulkResult
+        (see `BitBucketClient.bulk`) whose data is the ChangesetDelta of each repository, in
+        completion order.
+    """
+    jobs = ((namespace, repository_name,
+             lambda repository: self.sync(repository.namespace, repository.repository_name))
+            for (namespace, repository_name) in repositories)
+    return self._client.bulk(jobs, max_workers=max_workers)
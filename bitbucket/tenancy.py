@@ -0,0 +1,302 @@
+""" Defines the manager of the clients of many tenants sharing a single `BitBucket` dispatcher, with
+    per-tenant request quotas and fair scheduling of the shared connections.
+"""
+
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+from bitbucket.client import BitBucketClient
+from bitbucket.errors import BitBucketError
+from bitbucket.ratelimit import TokenBucket
+
+
+class FairScheduler(object):
+  """ Hands out `max_concurrency` slots to tenants, at most `max_per_tenant` (if given) to any
+      one tenant. When slots are contended, waiting tenants are served in round-robin order
+      rather than in the order they asked, so a tenant queueing many requests only delays the
+      others by one request each.
+  """
+  def __init__(self, max_concurrency, max_per_tenant=None):
+    self._available = max_concurrency
+    self._max_per_tenant = max_per_tenant
+    self._active = {}
+    self._waiting = OrderedDict()
+    self._lock = threading.Lock()
+
+  def _under_cap(self, tenant):
+    """ Returns whether the tenant may be handed another slot. Must be called with the lock. """
+    return self._max_per_tenant is None or self._active.get(tenant, 0) < self._max_per_tenant
+
+  def _grant(self, tenant):
+    """ Hands a slot to the tenant. Must be called with the lock held. """
+    self._available -= 1
+    self._active[tenant] = self._active.get(tenant, 0) + 1
+
+  def acquire(self, tenant):
+    """ Blocks until the tenant is handed a slot. """
+    with self._lock:
+      if self._available > 0 and self._under_cap(tenant):
+        self._grant(tenant)
+        return
+
+      granted = threading.Event()
+      waiters = self._waiting.get(tenant)
+      if waiters is None:
+        waiters = self._waiting[tenant] = deque()
+      waiters.append(granted)
+
+    granted.wait()
+
+  def release(self, tenant):
+    """ Returns a slot of the tenant and hands the free slots to the next waiting tenants. """
+    with self._lock:
+      self._available += 1
+      self._active[tenant] -= 1
+      if not self._active[tenant]:
+        del self._active[tenant]
+
+      while self._available > 0:
+        for (waiting_tenant, waiters) in self._waiting.items():
+          if self._under_cap(waiting_tenant):
+            break
+        else:
+          return
+
+        granted = waiters.popleft()
+        # Move the tenant to the back of the rotation (or out of it once it has no waiters).
+        del self._waiting[waiting_tenant]
+        if waiters:
+          self._waiting[waiting_tenant] = waiters
+
+        self._grant(waiting_tenant)
+        granted.set()
+
+  def busy(self, tenant):
+    """ Returns whether the tenant holds or waits for any slot. """
+    with self._lock:
+      return tenant in self._active or tenant in self._waiting
+
+
+class _TenantState(object):
+  """ The quota and counters of a tenant. """
+  __slots__ = ('bucket', 'clients', 'requests', 'throttled', 'rejected', 'wait_time')
+
+  def __init__(self, bucket):
+    self.bucket = bucket
+    self.clients = 0
+    self.requests = 0
+    self.throttled = 0
+    self.rejected = 0
+    self.wait_time = 0.0
+
+
+class _CachedClient(object):
+  """ A cached client along with when it was last used. """
+  __slots__ = ('client', 'tenant', 'last_used')
+
+  def __init__(self, tenant):
+    self.client = None
+    self.tenant = tenant
+    self.last_used = time.time()
+
+
+class _ScopedContentCache(object):
+  """ A view of a `ContentCache` whose entries are keyed by a scope as well, so that contents
+      read with some credentials are never served to others.
+  """
+  __slots__ = ('_cache', '_scope')
+
+  def __init__(self, cache, scope):
+    self._cache = cache
+    self._scope = scope
+
+  def cache_key(self, kind, namespace, repository_name, node, path):
+    """ Returns the key under which the given content is stored for the scope. """
+    key = self._cache.cache_key(kind, namespace, repository_name, node, path)
+    return hashlib.sha256(('%s\n%s' % (self._scope, key)).encode('utf-8')).hexdigest()
+
+  def get(self, key):
+    """ Returns a tuple of whether the key was found and the content stored under it. """
+    return self._cache.get(key)
+
+  def set(self, key, content, size=None):
+    """ Stores the content under the key. """
+    self._cache.set(key, content, size=size)
+
+
+class _TenantDispatcher(object):
+  """ The dispatcher of the clients of a tenant, which applies the tenant's quota and fair
+      scheduling before handing requests to the shared dispatcher.
+  """
+  __slots__ = ('_manager', '_cached', '_content_cache')
+
+  def __init__(self, manager, cached, access_token):
+    self._manager = manager
+    self._cached = cached
+    self._content_cache = None
+    if manager.dispatcher.content_cache is not None:
+      self._content_cache = _ScopedContentCache(manager.dispatcher.content_cache, access_token)
+
+  @property
+  def content_cache(self):
+    """ Returns the view of the shared dispatcher's content cache, if any, holding the contents
+        read with this client's access token.
+    """
+    return self._content_cache
+
+  def dispatch(self, api_url, access_token, access_token_secret, **kwargs):
+    """ Dispatches a request through the shared dispatcher on behalf of the tenant. """
+    self._cached.last_used = time.time()
+    return self._manager._dispatch(self._cached.tenant, api_url, access_token,
+                                   access_token_secret, kwargs)
+
+
+class TenantManager(object):
+  """ Hands out the clients of many tenants, all sharing the given `BitBucket` dispatcher and so
+      its connection pool (whose `pool_maxsize` should be at least `max_concurrency`).
+
+      Clients are cached per access token and secret; at most `max_clients` are kept, the least
+      recently used being evicted first, and clients unused for `idle_timeout` seconds are
+      evicted too. Evicted clients keep working, but are no longer shared. The quota of a tenant
+      outlives its clients until it has fully refilled, so that evicting and recreating them
+      does not reset it. Entries of the
+      shared dispatcher's content cache are kept per access token, so that contents are never
+      served to credentials which did not read them.
+
+      A tenant is identified by the `tenant` given when asking for a client, or else by the
+      access token. When `quota_rate` is given, each tenant may make `quota_rate` requests per
+      second, with bursts of up to `quota_burst`; requests over the quota wait for up to
+      `max_quota_wait` seconds and are refused beyond that. At most `max_concurrency` requests
+      are in flight across all tenants and `max_per_tenant` for any one tenant, with waiting
+      tenants being served in round-robin order.
+  """
+  def __init__(self, dispatcher, max_clients=1000, idle_timeout=600, quota_rate=None,
+               quota_burst=None, max_quota_wait=5, max_concurrency=10, max_per_tenant=None):
+    if getattr(dispatcher, 'is_async', False):
+      raise BitBucketError('TenantManager is not supported with an asynchronous dispatcher')
+
+    self.dispatcher = dispatcher
+    self._max_clients = max_clients
+    self._idle_timeout = idle_timeout
+    self._quota_rate = quota_rate
+    self._quota_burst = quota_burst if quota_burst is not None else quota_rate
+    self._max_quota_wait = max_quota_wait
+    self._scheduler = FairScheduler(max_concurrency, max_per_tenant=max_per_tenant)
+
+    self._clients = OrderedDict()
+    self._tenants = {}
+    # The tenants left without clients, whose state is kept until their quota has refilled.
+    self._idle_tenants = OrderedDict()
+    self._lock = threading.Lock()
+
+  def client(self, access_token, access_token_secret, tenant=None):
+    """ Returns the (cached) client for the given credentials, on behalf of the tenant. """
+    tenant = tenant if tenant is not None else access_token
+    key = (access_token, access_token_secret, tenant)
+    with self._lock:
+      cached = self._clients.pop(key, None)
+      if cached is None:
+        cached = _CachedClient(tenant)
+        cached.client = BitBucketClient(_TenantDispatcher(self, cached, access_token),
+                                        access_token, access_token_secret)
+        self._tenant_state(tenant).clients += 1
+        self._idle_tenants.pop(tenant, None)
+
+      cached.last_used = time.time()
+      self._clients[key] = cached
+      self._evict()
+      return cached.client
+
+  def get_authorization_url(self):
+    """ Starts the OAuth flow of a new tenant; see `BitBucket.get_authorization_url`. """
+    return self.dispatcher.get_authorization_url()
+
+  def authorize(self, access_token, access_token_secret, verifier, tenant=None):
+    """ Completes the OAuth flow of a tenant, returning a tuple of whether it succeeded and the
+        client for the new credentials (or the error encountered).
+    """
+    (result, token, error) = self.dispatcher.verify_token(access_token, access_token_secret,
+                                                          verifier)
+    if not result:
+      return (False, None, error)
+
+    return (True, self.client(token[0], token[1], tenant=tenant), None)
+
+  def _tenant_state(self, tenant):
+    """ Returns the state of the tenant, creating it if needed. Must be called with the lock. """
+    state = self._tenants.get(tenant)
+    if state is None:
+      bucket = None
+      if self._quota_rate is not None:
+        bucket = TokenBucket(self._quota_rate, self._quota_burst)
+      state = self._tenants[tenant] = _TenantState(bucket)
+    return state
+
+  def _evict(self):
+    """ Evicts the clients over the size limit and those idle for too long, then forgets the
+        tenants left without clients whose quota has refilled. Must be called with the lock held.
+    """
+    idle_before = time.time() - self._idle_timeout
+    while self._clients:
+      (key, cached) = next(iter(self._clients.items()))
+      if len(self._clients) <= self._max_clients and cached.last_used > idle_before:
+        break
+
+      del self._clients[key]
+      state = self._tenants.get(cached.tenant)
+      state.clients -= 1
+      if not state.clients:
+        self._idle_tenants[cached.tenant] = True
+
+    for tenant in list(self._idle_tenants):
+      bucket = self._tenants[tenant].bucket
+      if self._scheduler.busy(tenant) or (bucket is not None and not bucket.is_full()):
+        continue
+
+      del self._idle_tenants[tenant]
+      del self._tenants[tenant]
+
+  def _dispatch(self, tenant, api_url, access_token, access_token_secret, kwargs):
+    """ Dispatches a request on behalf of the tenant, once its quota and the scheduler allow. """
+    with self._lock:
+      state = self._tenant_state(tenant)
+      state.requests += 1
+
+    if state.bucket is not None:
+      wait = state.bucket.reserve(max_wait=self._max_quota_wait)
+      if wait is None:
+        with self._lock:
+          state.rejected += 1
+        return (False, None, 'Request quota exceeded')
+
+      if wait > 0:
+        with self._lock:
+          state.throttled += 1
+          state.wait_time += wait
+        time.sleep(wait)
+
+    self._scheduler.acquire(tenant)
+    try:
+      return self.dispatcher.dispatch(api_url, access_token, access_token_secret, **kwargs)
+    finally:
+      self._scheduler.release(tenant)
+
+  def stats(self):
+    """ Returns a dictionary of the number of cached clients and, per tenant, of its cached
+        clients, requests made, requests delayed and refused by its quota, and the time spent
+        waiting for its quota (in seconds).
+    """
+    with self._lock:
+      tenants = {}
+      for (tenant, state) in self._tenants.items():
+        tenants[tenant] = {
+          'clients': state.clients,
+          'requests': state.requests,
+          'throttled': state.throttled,
+          'rejected': state.rejected,
+          'wait_time': state.wait_time,
+        }
+      return {'clients': len(self._clients), 'tenants': tenants}
@@ -1,27 +1,236 @@
 # -*- coding: utf-8 -*-
 from requests import Request, Session
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth1
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 import requests
 import requests.exceptions
 import json
+import threading
+
+from collections import OrderedDict
+from timeit import default_timer
 
 try:
     from urlparse import parse_qs
 except ImportError:
     from urllib.parse import parse_qs
 
-from bitbucket.urls import request_token_url, authenticate_url, access_token_url
+try:
+    from cookielib import DefaultCookiePolicy
+except ImportError:
+    from http.cookiejar import DefaultCookiePolicy
+
+from bitbucket.coalesce import coalescing_key
+from bitbucket.errors import BitBucketError, ResponseError
+from bitbucket.instrumentation import RequestInfo
+from bitbucket.models import decode_body
+from bitbucket.urls import request_token_url, authenticate_url, access_token_url, url_template
 from bitbucket.client import BitBucketClient
 
+# Size of the chunks yielded for streamed response bodies.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_response_chunks(response):
+  """ Yields the body of a streamed response in chunks, closing the response once done. """
+  try:
+    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+      yield chunk
+  except requests.exceptions.RequestException as rex:
+    raise BitBucketError('Exception when reading from BitBucket: %s' % rex)
+  finally:
+    response.close()
+
+
+# Seconds spent establishing connections on the current thread, reset before each request.
+_connect_timer = threading.local()
+
+
+def _timed_connect(connection, connection_class):
+  """ Establishes the connection, adding the time it took to the current thread's timer. """
+  started = default_timer()
+  try:
+    return connection_class.connect(connection)
+  finally:
+    _connect_timer.seconds = (getattr(_connect_timer, 'seconds', 0.0) + default_timer() -
+                              started)
+
+
+class _TimedHTTPConnection(HTTPConnection):
+  def connect(self):
+    return _timed_connect(self, HTTPConnection)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+  def connect(self):
+    return _timed_connect(self, HTTPSConnection)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+  ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+  ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+  """ An HTTP adapter whose pooled connections record the time spent establishing them, so
+      that it can be told apart from the time spent waiting on the server.
+  """
+  def init_poolmanager(self, *args, **kwargs):
+    HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {
+      'http': _TimedHTTPConnectionPool,
+      'https': _TimedHTTPSConnectionPool,
+    }
+
 
 class BitBucket(object):
-  """ This is the main class for interacting with the BitBucket API (V1). """
-  def __init__(self, consumer_key, consumer_secret, callback_url, timeout=None):
+  """ This is the main class for interacting with the BitBucket API (V1).
+
+      The instance owns a long-lived, keep-alive HTTP session whose connection pool is shared by
+      every client created from it. `pool_connections` is the number of hosts for which pools are
+      kept and `pool_maxsize` the number of connections kept open per host. Call `close()` (or use
+      the instance as a context manager) to release the pooled connections.
+
+      Unsuccessful responses are reported with a `bitbucket.errors.ResponseError`, the reason
+      of the response, which also carries its status code.
+
+      If a `cache` (see `bitbucket.cache.ConditionalRequestCache`) is given, GET responses are
+      revalidated with their ETag / Last-Modified validators and the previously parsed body is
+      returned when BitBucket reports that it has not been modified. Cached bodies are shared
+      between callers and must not be modified.
+
+      If a `content_cache` (see `bitbucket.cache.ContentCache`) is given, file, directory and
+      manifest reads pinned to a full commit hash are served from it after the first download.
+
+      If a `rate_limiter` (see `bitbucket.ratelimit.RateLimiter`) is given, requests are throttled
+      per access token across all clients, and idempotent requests answered with 429 or 503 are
+      retried with backoff.
+
+      If an `instrumentation` (see `bitbucket.instrumentation.Instrumentation`) is given, its
+      hooks are called before and after every dispatched request with the endpoint template,
+      per-phase timings, status and size of the request.
+
+      OAuth signers are built once per access token and secret pair and reused; at most
+      `max_signers` of them are kept, the least recently used being evicted first.
+
+      If a `single_flight` (see `bitbucket.coalesce.SingleFlight`) is given, identical GET
+      requests made with the same credentials while one is already in flight wait for its
+      result instead of being sent again. The result is shared and must not be modified.
+      Streamed requests are never coalesced.
+  """
+  def __init__(self, consumer_key, consumer_secret, callback_url, timeout=None,
+               pool_connections=10, pool_maxsize=10, cache=None, content_cache=None,
+               rate_limiter=None, instrumentation=None, max_signers=1024, single_flight=None):
     self._consumer_key = consumer_key
     self._consumer_secret = consumer_secret
     self._callback_url = callback_url
     self._timeout = timeout
+    self._pool_connections = pool_connections
+    self._pool_maxsize = pool_maxsize
+    self._cache = cache
+    self._content_cache = content_cache
+    self._rate_limiter = rate_limiter
+    self._instrumentation = instrumentation
+    self._max_signers = max_signers
+    self._single_flight = single_flight
+
+    self._signers = OrderedDict()
+    self._signers_lock = threading.Lock()
+
+    self._session = None
+    self._session_lock = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    """ Closes the pooled HTTP session, if any. A new session will be created if the instance
+        is used again afterwards.
+    """
+    with self._session_lock:
+      session = self._session
+      self._session = None
+
+    if session is not None:
+      session.close()
+
+  def _create_session(self):
+    """ Creates a new HTTP session with a connection pool mounted for both schemes. """
+    session = Session()
+
+    # The session is shared between all credentials, so never keep cookies around.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    adapter = _TimedHTTPAdapter(pool_connections=self._pool_connections,
+                          pool_maxsize=self._pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+  def _get_session(self):
+    """ Returns the shared HTTP session, creating it on first use. The session (and its
+        underlying connection pool) is safe to use from multiple threads.
+    """
+    session = self._session
+    if session is None:
+      with self._session_lock:
+        if self._session is None:
+          self._session = self._create_session()
+        session = self._session
+
+    return session
+
+  def _get_signer(self, access_token, access_token_secret):
+    """ Returns the OAuth signer for the given access token and secret, creating it if needed.
+        Signers generate a fresh nonce and timestamp for every request they sign, so they can be
+        shared between requests and threads.
+    """
+    key = (access_token, access_token_secret)
+    with self._signers_lock:
+      signer = self._signers.pop(key, None)
+      if signer is None:
+        signer = OAuth1(self._consumer_key, client_secret=self._consumer_secret,
+                        resource_owner_key=access_token, resource_owner_secret=access_token_secret)
+
+      self._signers[key] = signer
+      if len(self._signers) > self._max_signers:
+        self._signers.popitem(last=False)
+
+      return signer
+
+  @property
+  def cache(self):
+    """ Returns the conditional request cache, if any. """
+    return self._cache
+
+  @property
+  def content_cache(self):
+    """ Returns the cache of contents read at immutable revisions, if any. """
+    return self._content_cache
+
+  @property
+  def rate_limiter(self):
+    """ Returns the rate limiter, if any. """
+    return self._rate_limiter
+
+  @property
+  def instrumentation(self):
+    """ Returns the instrumentation, if any. """
+    return self._instrumentation
+
+  @property
+  def single_flight(self):
+    """ Returns the single-flight coalescer of duplicate in-flight GETs, if any. """
+    return self._single_flight
 
   def get_authorized_client(self, access_token, access_token_secret):
     """ Returns a client for talking to an authorized endpoint. """
@@ -29,46 +238,148 @@ class BitBucket(object):
 
 
   def dispatch(self, api_url, access_token, access_token_secret, method='GET', params=None,
-               json_body=False, **kwargs):
-    """ Dispatches a signed request to the given URL, with the given access token and secret. """
-    oauth = OAuth1(self._consumer_key, client_secret=self._consumer_secret,
-                   resource_owner_key=access_token, resource_owner_secret=access_token_secret)
+               json_body=False, stream=False, raw=False, **kwargs):
+    """ Dispatches a signed request to the given URL, with the given access token and secret.
+        If `stream` is True, the body of a successful response is neither buffered nor decoded;
+        instead an iterator over its raw byte chunks is returned, which raises a BitBucketError
+        if the connection fails while reading. If `raw` is True, the body of a successful
+        response is returned as undecoded bytes. Neither kind of response is cached.
+    """
+    single_flight = self._single_flight
+    if single_flight is not None and method == 'GET' and not stream:
+      key = coalescing_key(api_url, access_token, access_token_secret, params, raw)
+      return single_flight.do(key, self._instrumented_dispatch, api_url, access_token,
+                              access_token_secret, method, params, json_body, stream, raw,
+                              kwargs)
+
+    return self._instrumented_dispatch(api_url, access_token, access_token_secret, method,
+                                       params, json_body, stream, raw, kwargs)
+
+  def _instrumented_dispatch(self, api_url, access_token, access_token_secret, method, params,
+                             json_body, stream, raw, data):
+    """ Performs the work of `dispatch`, calling the instrumentation hooks, if any. """
+    instrumentation = self._instrumentation
+    if instrumentation is None:
+      return self._dispatch(RequestInfo(method, api_url, None), api_url, access_token,
+                            access_token_secret, method, params, json_body, stream, raw, data)
+
+    info = RequestInfo(method, api_url, url_template(api_url))
+    instrumentation.before_request(info)
+
+    started = default_timer()
+    result = self._dispatch(info, api_url, access_token, access_token_secret, method, params,
+                            json_body, stream, raw, data)
+    info.total = default_timer() - started
+    if not result[0]:
+      info.error = result[2]
+
+    instrumentation.after_request(info)
+    return result
+
+  def _dispatch(self, info, api_url, access_token, access_token_secret, method, params,
+                json_body, stream, raw, data):
+    """ Sends the request and handles its response, recording the status, size and phase
+        timings of the request into `info`.
+    """
+    oauth = self._get_signer(access_token, access_token_secret)
 
-    data = kwargs
     headers = {}
 
     if json_body:
       headers['Content-Type'] = 'application/json'
       data = json.dumps(data)
 
-    session = Session()
+    cache_key = None
+    cached = None
+    if self._cache is not None and method == 'GET' and not stream and not raw:
+      cache_key = self._cache.cache_key(api_url, params, access_token)
+      cached = self._cache.lookup(cache_key)
+      if cached is not None:
+        headers.update(cached.conditional_headers())
+
     request = Request(method=method, url=api_url, auth=oauth, params=params, data=data,
                       headers=headers)
 
     try:
-      response = session.send(request.prepare(), timeout=self._timeout)
+      response = self._send(request, access_token, info, stream=stream)
+      status_code = response.status_code
+      info.status = status_code
+
+      if stream:
+        if status_code // 100 == 2:
+          return (True, _iter_response_chunks(response), None)
+
+        response.close()
+        return (False, None, ResponseError(response.reason, status_code))
+
+      started = default_timer()
+      info.bytes = len(response.content)
+      info.timings['download'] = default_timer() - started
     except requests.exceptions.ReadTimeout:
       return (False, None, 'Timeout when contacting BitBucket')
     except requests.exceptions.RequestException as rex:
-      return (False, None, 'Exception when contacting BitBucket: %s' % rex.message)
+      return (False, None, 'Exception when contacting BitBucket: %s' % rex)
+
+    if cached is not None and status_code == 304:
+      self._cache.record_hit()
+      return (True, cached.data, None)
 
-    status_code = response.status_code
-    text = response.text
+    if raw and status_code // 100 == 2:
+      return (True, response.content, None)
+
+    started = default_timer()
     error = response.reason
 
     # 200-299: OK.
-    if status_code / 100 == 2:
-      try:
-        return (True, json.loads(text or ''), None)
-      except TypeError:
-        pass
-      except ValueError:
-        pass
+    if status_code // 100 == 2:
+      result_data = decode_body(response.content)
+      info.timings['decode'] = default_timer() - started
+      if cache_key is not None:
+        self._cache.record_miss()
+        self._cache.store(cache_key, response.headers, result_data)
+
+      return (True, result_data, None)
 
-      return (True, text, None)
+    return (False, None, ResponseError(error, status_code))
 
-    return (False, None, error or 'Error: %s' % status_code)
+  def _send(self, request, access_token, info, stream=False):
+    """ Sends the request over the shared session, applying the rate limiter and its retry
+        policy, if any, and recording the time spent waiting, signing, connecting and sending
+        into `info`.
+    """
+    session = self._get_session()
+    timings = info.timings
+    attempt = 0
+    while True:
+      if self._rate_limiter is not None:
+        started = default_timer()
+        self._rate_limiter.acquire(access_token)
+        timings['wait'] += default_timer() - started
+
+      # The request is prepared (and so signed) again for every attempt, since OAuth nonces
+      # cannot be reused.
+      started = default_timer()
+      prepared = request.prepare()
+      sent = default_timer()
+      timings['sign'] += sent - started
+
+      # The body is always read by the caller, so that its download can be timed separately.
+      _connect_timer.seconds = 0.0
+      response = session.send(prepared, timeout=self._timeout, stream=True)
+      connecting = _connect_timer.seconds
+      timings['connect'] += connecting
+      timings['send'] += default_timer() - sent - connecting
+
+      if (self._rate_limiter is None or
+          not self._rate_limiter.should_retry(request.method, response.status_code, attempt)):
+        return response
+
+      response.close()
 
+      started = default_timer()
+      self._rate_limiter.wait_for_retry(attempt, response.headers)
+      timings['wait'] += default_timer() - started
+      attempt += 1
 
   def _get_request_token(self):
     """ Retrieves a request token from the BitBucket API endpoint. Returns a tuple containing
@@ -77,9 +388,15 @@ class BitBucket(object):
     oauth = OAuth1(self._consumer_key, client_secret=self._consumer_secret,
                    callback_uri=self._callback_url)
 
-    request = requests.post(request_token_url(), auth=oauth, timeout=self._timeout)
+    try:
+      request = self._get_session().post(request_token_url(), auth=oauth, timeout=self._timeout)
+    except requests.exceptions.ReadTimeout:
+      return (False, None, 'Timeout when contacting BitBucket')
+    except requests.exceptions.RequestException as rex:
+      return (False, None, 'Exception when contacting BitBucket: %s' % rex)
+
     if request.status_code == 200:
-      credentials = parse_qs(request.content)
+      credentials = parse_qs(request.text)
       token = (credentials.get('oauth_token')[0], credentials.get('oauth_token_secret')[0])
       return (True, token, None)
 
@@ -113,14 +430,14 @@ class BitBucket(object):
                    verifier=verifier)
 
     try:
-      request = requests.post(access_token_url(), auth=oauth, timeout=self._timeout)
+      request = self._get_session().post(access_token_url(), auth=oauth, timeout=self._timeout)
     except requests.exceptions.ReadTimeout:
       return (False, None, 'Timeout when contacting BitBucket')
     except requests.exceptions.RequestException as rex:
-      return (False, None, 'Exception when contacting BitBucket: %s' % rex.message)
+      return (False, None, 'Exception when contacting BitBucket: %s' % rex)
 
     if request.status_code == 200:
-      credentials = parse_qs(request.content)
+      credentials = parse_qs(request.text)
       token = (credentials.get('oauth_token')[0], credentials.get('oauth_token_secret')[0])
       return (True, token, None)
 
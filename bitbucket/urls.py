@@ -1,103 +1,323 @@
-_BASE_URL_V1 = 'https://bitbucket.org/!api/1.0/%s'
-_BASE_URL_V2 = 'https://api.bitbucket.org/2.0/%s'
+""" Defines the URLs of the BitBucket API endpoints, built from a table of precompiled routes. """
+
+import re
+
+try:
+  from urllib import quote, unquote
+except ImportError:
+  from urllib.parse import quote, unquote
+
+try:
+  _STRING_TYPES = (str, unicode)
+except NameError:
+  _STRING_TYPES = (str,)
+
+_BASE_URLS = {
+  1: 'https://bitbucket.org/!api/1.0/',
+  2: 'https://api.bitbucket.org/2.0/',
+}
+
+# Routes of the endpoints, by name: the API version and the template of the path under the base
+# URL. `{path}`, `{branch}` and `{tag}` placeholders may span several segments. `{revision}`
+# placeholders keep their slashes as well, since branch names such as `feature/x` are revisions
+# too, but when recognizing URLs they only span several segments if nothing follows them, as
+# a revision cannot otherwise be told apart from the path after it. All other placeholders are
+# quoted as (and match) a single segment.
+_ROUTE_TABLE = [
+  ('request_token', 1, 'oauth/request_token/'),
+  ('authenticate', 1, 'oauth/authenticate'),
+  ('access_token', 1, 'oauth/access_token/'),
+  ('current_user', 1, 'user'),
+  ('current_user_repos', 1, 'user/repositories'),
+  ('account_profile', 1, 'users/{account}'),
+  ('repository_branches', 1, 'repositories/{ns}/{repo}/branches'),
+  ('repository_tags', 1, 'repositories/{ns}/{repo}/tags'),
+  ('repository_branches_tags', 1, 'repositories/{ns}/{repo}/branches-tags'),
+  ('repository_main_branch', 1, 'repositories/{ns}/{repo}/main-branch'),
+  ('repository_manifest', 1, 'repositories/{ns}/{repo}/manifest/{revision}'),
+  ('repository_path_contents', 1, 'repositories/{ns}/{repo}/src/{revision}/{path}'),
+  ('repository_path_raw_contents', 1, 'repositories/{ns}/{repo}/raw/{revision}/{path}'),
+  ('repository_deploy_keys', 1, 'repositories/{ns}/{repo}/deploy-keys'),
+  ('repository_deploy_key', 1, 'repositories/{ns}/{repo}/deploy-keys/{key_id}'),
+  ('repository_links', 1, 'repositories/{ns}/{repo}/links'),
+  ('repository_link', 1, 'repositories/{ns}/{repo}/links/{link_id}'),
+  ('repository_services', 1, 'repositories/{ns}/{repo}/services'),
+  ('repository_service', 1, 'repositories/{ns}/{repo}/services/{service_id}'),
+  ('repository_changesets', 1, 'repositories/{ns}/{repo}/changesets'),
+  ('repository_changeset', 1, 'repositories/{ns}/{repo}/changesets/{node}'),
+  ('repository_webhooks', 2, 'repositories/{ns}/{repo}/hooks'),
+  ('repository_webhook', 2, 'repositories/{ns}/{repo}/hooks/{uuid}'),
+  ('repository_branch', 2, 'repositories/{ns}/{repo}/refs/branches/{branch}'),
+  ('repository_tag', 2, 'repositories/{ns}/{repo}/refs/tags/{tag}'),
+]
+
+_MULTI_SEGMENT_PLACEHOLDERS = frozenset(['path', 'branch', 'tag'])
+_SLASHED_PLACEHOLDERS = _MULTI_SEGMENT_PLACEHOLDERS | frozenset(['revision'])
+
+# Routes under this prefix are built from a cached, already quoted prefix per repository.
+_REPOSITORY_TEMPLATE_PREFIX = 'repositories/{ns}/{repo}/'
+
+# At most this many repository prefixes are cached before the cache is reset.
+_MAX_REPOSITORY_PREFIXES = 4096
+
+_PLACEHOLDER_REGEX = re.compile(r'\{(\w+)\}')
+
+
+# Characters never quoted in URL paths.
+_ALWAYS_SAFE = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-~'
+
+# At most this many quoted path segments are memoized before the memo is reset.
+_MAX_QUOTED_SEGMENTS = 4096
+
+def _quote(value, safe):
+  """ Quotes the value for use in a URL path, leaving the `safe` characters (along with letters,
+      digits and `_.-~`) as they are. Values which need no quoting, the common case, are
+      returned without being encoded. Byte strings are quoted as they are.
+  """
+  if isinstance(value, bytes):
+    return quote(value, safe=safe)
+  if not isinstance(value, _STRING_TYPES):
+    value = str(value)
+  # Stripping the safe characters leaves nothing when there is nothing to quote.
+  if not value.strip(_ALWAYS_SAFE + safe):
+    return value
+  return quote(value.encode('utf-8'), safe=safe)
+
+def _quote_path(value):
+  """ Quotes a path spanning several segments, leaving its slashes as they are. """
+  return _quote(value, '/')
+
+_quoted_segments = {}
+
+def _quote_segment(value):
+  """ Quotes a single path segment. Segments (names, revisions, ids) repeat across requests, so
+      their quoted form is memoized.
+  """
+  quoted = _quoted_segments.get(value)
+  if quoted is None:
+    if len(_quoted_segments) >= _MAX_QUOTED_SEGMENTS:
+      _quoted_segments.clear()
+    quoted = _quoted_segments[value] = _quote(value, '')
+  return quoted
+
+_repository_prefixes = {}
+
+def _repository_prefix(version, namespace, repository):
+  """ Returns the (cached) base URL of the endpoints under a repository. """
+  key = (version, namespace, repository)
+  prefix = _repository_prefixes.get(key)
+  if prefix is None:
+    if len(_repository_prefixes) >= _MAX_REPOSITORY_PREFIXES:
+      _repository_prefixes.clear()
+
+    prefix = '%srepositories/%s/%s/' % (_BASE_URLS[version], _quote_segment(namespace),
+                                        _quote_segment(repository))
+    _repository_prefixes[key] = prefix
+  return prefix
+
+def _compile_template(template):
+  """ Returns a regular expression matching the (quoted) paths built from the given template. """
+  parts = _PLACEHOLDER_REGEX.split(template)
+  pattern = ''
+  for (index, part) in enumerate(parts):
+    if index % 2 == 0:
+      pattern += re.escape(part)
+    elif part in _MULTI_SEGMENT_PLACEHOLDERS:
+      pattern += '(?P<%s>.*)' % part
+    elif part in _SLASHED_PLACEHOLDERS:
+      pattern += '(?P<%s>.+?)' % part
+    else:
+      pattern += '(?P<%s>[^/]+)' % part
+
+  return re.compile('^%s$' % pattern)
+
+def _index_key(path):
+  """ Returns the key under which routes matching the path are indexed: the first segment, or
+      for repository endpoints the segment following the repository name.
+  """
+  segments = path.split('/', 4)
+  if segments[0] == 'repositories' and len(segments) > 3:
+    return ('repositories', segments[3])
+  return (segments[0],)
+
+
+class _Route(object):
+  """ A precompiled route, which builds the URLs of an endpoint and recognizes them. """
+  __slots__ = ('name', 'version', 'template', 'regex', 'repository_scoped', '_format',
+               '_quoters')
+
+  def __init__(self, name, version, template):
+    self.name = name
+    self.version = version
+    self.template = template
+    self.regex = _compile_template(template)
+
+    self.repository_scoped = template.startswith(_REPOSITORY_TEMPLATE_PREFIX)
+    if self.repository_scoped:
+      template = template[len(_REPOSITORY_TEMPLATE_PREFIX):]
+
+    parts = _PLACEHOLDER_REGEX.split(template)
+    self._format = ''.join(part.replace('%', '%%') if index % 2 == 0 else '%s'
+                           for (index, part) in enumerate(parts))
+    self._quoters = tuple(_quote_path if part in _SLASHED_PLACEHOLDERS else _quote_segment
+                          for part in parts[1::2])
+
+  def build(self, *values):
+    """ Returns the URL of the endpoint for the given placeholder values, in template order. """
+    if self.repository_scoped:
+      prefix = _repository_prefix(self.version, values[0], values[1])
+      offset = 2
+    else:
+      prefix = _BASE_URLS[self.version]
+      offset = 0
+
+    # Routes have at most two placeholders besides the repository ones.
+    quoters = self._quoters
+    if not quoters:
+      return prefix + self._format
+    if len(quoters) == 1:
+      return prefix + self._format % quoters[0](values[offset])
+    return prefix + self._format % (quoters[0](values[offset]), quoters[1](values[offset + 1]))
+
+
+_ROUTES = dict((name, _Route(name, version, template))
+               for (name, version, template) in _ROUTE_TABLE)
+
+_ROUTE_INDEX = {1: {}, 2: {}}
+for (_name, _version, _template) in _ROUTE_TABLE:
+  _ROUTE_INDEX[_version].setdefault(_index_key(_template), []).append(_ROUTES[_name])
+
+def url_route(api_url):
+  """ Returns the name of the endpoint the given URL was built for (for example
+      `repository_changesets`, the name of its URL function without the `_url` suffix) along
+      with a dictionary of its unquoted placeholder values, or None if the URL is not a known
+      endpoint.
+  """
+  for version in (1, 2):
+    base_url = _BASE_URLS[version]
+    if api_url.startswith(base_url):
+      path = api_url[len(base_url):].split('?', 1)[0]
+      for route in _ROUTE_INDEX[version].get(_index_key(path), ()):
+        match = route.regex.match(path)
+        if match:
+          args = dict((key, unquote(value)) for (key, value) in match.groupdict().items())
+          return (route.name, args)
+
+  return None
+
+def url_template(api_url):
+  """ Returns the template of the endpoint the given URL was built for (for example
+      `repositories/{ns}/{repo}/changesets`), or None if the URL is not a known endpoint.
+  """
+  found = url_route(api_url)
+  return _ROUTES[found[0]].template if found is not None else None
+
+def set_base_urls(v1_base_url, v2_base_url):
+  """ Overrides the base URLs of the V1 and V2 APIs (for example to point all clients at a local
+      stub server). The base URLs must end in a slash. Returns the previous base URLs as a tuple.
+  """
+  previous = (_BASE_URLS[1], _BASE_URLS[2])
+  _BASE_URLS[1] = v1_base_url
+  _BASE_URLS[2] = v2_base_url
+  _repository_prefixes.clear()
+  return previous
 
 def request_token_url():
   """ URL for getting a request token. """
-  return _BASE_URL_V1 % 'oauth/request_token/'
+  return _ROUTES['request_token'].build()
 
 def authenticate_url(token):
   """ URL for performing authentication on behalf of a user. """
-  return _BASE_URL_V1 % ('oauth/authenticate?oauth_token=%s' % token)
+  return '%s?oauth_token=%s' % (_ROUTES['authenticate'].build(), _quote_segment(token))
 
 def access_token_url():
   """ URL for exchanging a verifier for an access token. """
-  return _BASE_URL_V1 % 'oauth/access_token/'
+  return _ROUTES['access_token'].build()
 
 def current_user_url():
   """ URL for retrieving the current authorized user. """
-  return _BASE_URL_V1 % 'user'
+  return _ROUTES['current_user'].build()
 
 def current_user_repos_url():
   """ URL for retrieving the repositories viewable by the current user. """
-  return _BASE_URL_V1 % 'user/repositories'
+  return _ROUTES['current_user_repos'].build()
 
 def repository_branches_url(namespace, repository):
   """ URL for retrieiving the branches under a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/branches' % (namespace, repository))
+  return _ROUTES['repository_branches'].build(namespace, repository)
 
 def repository_tags_url(namespace, repository):
   """ URL for retrieiving the tags under a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/tags' % (namespace, repository))
+  return _ROUTES['repository_tags'].build(namespace, repository)
 
 def repository_branches_tags_url(namespace, repository):
   """ URL for retrieiving the branches and tags under a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/branches-tags' % (namespace, repository))
+  return _ROUTES['repository_branches_tags'].build(namespace, repository)
 
 def repository_manifest_url(namespace, repository, revision):
   """ URL for retrieving a manifest of a revision of a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/manifest/%s' % (namespace, repository, revision))
+  return _ROUTES['repository_manifest'].build(namespace, repository, revision)
 
 def repository_path_contents_url(namespace, repository, revision, path):
   """ Returns the contents of the path (file or directory) under a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/src/%s/%s' % (namespace, repository, revision, path))
+  return _ROUTES['repository_path_contents'].build(namespace, repository, revision, path)
 
 def repository_path_raw_contents_url(namespace, repository, revision, path):
   """ Returns the contents of the path (file or directory) under a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/raw/%s/%s' % (namespace, repository, revision, path))
+  return _ROUTES['repository_path_raw_contents'].build(namespace, repository, revision, path)
 
 def repository_deploy_keys_url(namespace, repository):
   """ Returns the list of deploy keys in a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/deploy-keys' % (namespace, repository))
+  return _ROUTES['repository_deploy_keys'].build(namespace, repository)
 
 def repository_deploy_key_url(namespace, repository, key_id):
   """ Returns the contents of a deploy key under a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/deploy-keys/%s' % (namespace, repository, key_id))
+  return _ROUTES['repository_deploy_key'].build(namespace, repository, key_id)
 
 def repository_links_url(namespace, repository):
   """ Returns the list of links in a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/links' % (namespace, repository))
+  return _ROUTES['repository_links'].build(namespace, repository)
 
 def repository_link_url(namespace, repository, link_id):
   """ Returns the contents of a link under a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/links/%s' % (namespace, repository, link_id))
+  return _ROUTES['repository_link'].build(namespace, repository, link_id)
 
 def repository_services_url(namespace, repository):
   """ Returns the list of services in a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/services' % (namespace, repository))
+  return _ROUTES['repository_services'].build(namespace, repository)
 
 def repository_service_url(namespace, repository, service_id):
   """ Returns the contents of a service under a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/services/%s' % (namespace, repository, service_id))
+  return _ROUTES['repository_service'].build(namespace, repository, service_id)
 
 def repository_main_branch_url(namespace, repository):
   """ Returns the name of the main branch for the repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/main-branch' % (namespace, repository))
+  return _ROUTES['repository_main_branch'].build(namespace, repository)
 
 def repository_changesets_url(namespace, repository):
   """ Returns the list of changesets in a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/changesets' % (namespace, repository))
+  return _ROUTES['repository_changesets'].build(namespace, repository)
 
 def repository_changeset_url(namespace, repository, node_id):
   """ Returns the contents of a changeset under a repository. """
-  return _BASE_URL_V1 % ('repositories/%s/%s/changesets/%s' % (namespace, repository, node_id))
+  return _ROUTES['repository_changeset'].build(namespace, repository, node_id)
 
 def account_profile_url(accountname):
   """ Returns the account profile information for the given account. """
-  return _BASE_URL_V1 % ('users/%s' % accountname)
+  return _ROUTES['account_profile'].build(accountname)
 
 def repository_webhooks_url(namespace, repository):
   """ Returns the list of webhooks in a repository. """
-  return _BASE_URL_V2 % ('repositories/%s/%s/hooks' % (namespace, repository))
+  return _ROUTES['repository_webhooks'].build(namespace, repository)
 
 def repository_webhook_url(namespace, repository, service_id):
   """ Returns the contents of a webhook under a repository. """
-  return _BASE_URL_V2 % ('repositories/%s/%s/hooks/%s' % (namespace, repository, service_id))
+  return _ROUTES['repository_webhook'].build(namespace, repository, service_id)
 
 def repository_branch_url(namespace, repository, branch_name):
   """ URL for retrieiving a specific branch under a repository. """
-  return _BASE_URL_V2 % ('repositories/%s/%s/refs/branches/%s' % (namespace, repository,
-                                                                  branch_name))
+  return _ROUTES['repository_branch'].build(namespace, repository, branch_name)
+
 def repository_tag_url(namespace, repository, tag_name):
   """ URL for retrieiving a specific tag under a repository. """
-  return _BASE_URL_V2 % ('repositories/%s/%s/refs/tags/%s' % (namespace, repository, tag_name))
-
+  return _ROUTES['repository_tag'].build(namespace, repository, tag_name)
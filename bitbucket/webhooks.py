@@ -1,62 +1,91 @@
 """ Defines a client class for working with a specific BitBucket repository's webhooks
     as defined in API v2: https://confluence.atlassian.com/display/BITBUCKET/webhooks+Resource. """
 
+from bitbucket.models import Webhook, model_result, model_list_result
 from bitbucket.urls import repository_webhooks_url, repository_webhook_url
+from bitbucket.context import BitBucketContext, ContextClient
 
-class BitBucketRepositoryWebhooksClient(object):
+class BitBucketRepositoryWebhooksClient(ContextClient):
   """ Client class representing the webhooks under a repository in bitbucket. """
+  __slots__ = ()
+
   def __init__(self, dispatcher, access_token, access_token_secret, namespace, repository_name):
-    self._dispatcher = dispatcher
-    self._access_token = access_token
-    self._access_token_secret = access_token_secret
-    self._namespace = namespace
-    self._repository_name = repository_name
+    self._attach(BitBucketContext(dispatcher, access_token, access_token_secret, namespace,
+                                  repository_name))
 
   @property
   def namespace(self):
     """ Returns the namespace. """
-    return self._namespace
+    return self._context.namespace
 
   @property
   def repository_name(self):
     """ Returns the repository name. """
-    return self._repository_name
+    return self._context.repository_name
+
+  def all(self, typed=False):
+    """ Returns a list of the webhooks found under the repository. If `typed` is True, the
+        webhooks of the returned page are given as a lazily decoded sequence of `Webhook` models.
+    """
+    url = repository_webhooks_url(self._context.namespace, self._context.repository_name)
+    if typed:
+      return self._context.dispatch_then(
+          url, lambda result: model_list_result(result, Webhook, items_key='values'), raw=True)
+
+    return self._context.dispatch(url)
+
+  def all_pages(self):
+    """ Returns the webhooks found under the repository like `all`, but following the `next`
+        links of the paged results, so that `values` holds every webhook. Only usable with the
+        blocking `BitBucket` dispatcher.
+    """
+    self._context.require_blocking('all_pages')
+    url = repository_webhooks_url(self._context.namespace, self._context.repository_name)
+    values = []
+    while url:
+      (result, data, error) = self._context.dispatch(url)
+      if not result:
+        return (result, data, error)
+
+      values.extend(data.get('values') or [])
+      url = data.get('next')
+
+    return (True, {'values': values, 'pagelen': len(values)}, None)
 
-  def all(self):
-    """ Returns a list of the webhooks found under the repository. """
-    url = repository_webhooks_url(self._namespace, self._repository_name)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+  def get(self, uuid, typed=False):
+    """ Returns the contents of the specified webhook, as a `Webhook` model if `typed` is True.
+    """
+    url = repository_webhook_url(self._context.namespace, self._context.repository_name, uuid)
+    if typed:
+      return self._context.dispatch_then(url, lambda result: model_result(result, Webhook),
+                                         raw=True)
 
-  def get(self, uuid):
-    """ Returns the contents of the specified webhook. """
-    url = repository_webhook_url(self._namespace, self._repository_name, uuid)
-    return self._dispatcher.dispatch(url, access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    return self._context.dispatch(url)
 
   def delete(self, uuid):
     """ Deletes the specified webhook. """
-    url = repository_webhook_url(self._namespace, self._repository_name, uuid)
-    return self._dispatcher.dispatch(url, method='DELETE', access_token=self._access_token,
-                                          access_token_secret=self._access_token_secret)
+    url = repository_webhook_url(self._context.namespace, self._context.repository_name, uuid)
+    return self._context.dispatch(url, method='DELETE')
 
-  def update(self, uuid, description, hook_url, events, active=True):
-    """ Updates an existing webhook. """
-    url = repository_webhook_url(self._namespace, self._repository_name, uuid)
+  def update(self, uuid, description, hook_url, events, active=True, skip_cert_verification=None):
+    """ Updates an existing webhook. Its certificate verification setting is left unchanged
+        unless `skip_cert_verification` is given.
+    """
+    url = repository_webhook_url(self._context.namespace, self._context.repository_name, uuid)
     data = {
       'description': description,
       'url': hook_url,
       'active': active,
       'events': events
     }
+    if skip_cert_verification is not None:
+      data['skip_cert_verification'] = skip_cert_verification
 
-    return self._dispatcher.dispatch(url, method='PUT', access_token=self._access_token,
-                                     access_token_secret=self._access_token_secret, json_body=True,
-                                     **data)
+    return self._context.dispatch(url, method='PUT', json_body=True, **data)
 
   def create(self, description, hook_url, events, active=True, skip_cert_verification=False):
     """ Creates a new webhook. """
-    url = repository_webhooks_url(self._namespace, self._repository_name)
+    url = repository_webhooks_url(self._context.namespace, self._context.repository_name)
     data = {
       'description': description,
       'url': hook_url,
@@ -65,6 +94,4 @@ class BitBucketRepositoryWebhooksClient(object):
       'skip_cert_verification': skip_cert_verification,
     }
 
-    return self._dispatcher.dispatch(url, method='POST', access_token=self._access_token,
-                                     access_token_secret=self._access_token_secret, json_body=True,
-                                     **data)
+    return self._context.dispatch(url, method='POST', json_body=True, **data)
@@ -1,7 +1,7 @@
 from setuptools import setup
 
 version = "0.2"
-install_requires = ['requests', 'requests-oauthlib']
+install_requires = ['requests', 'requests-oauthlib', 'futures; python_version < "3.0"']
 
 setup(name='py-bitbucket',
     version=version,
@@ -19,4 +19,5 @@ setup(name='py-bitbucket',
     license=open('LICENSE').read(),
     packages=['bitbucket'],
     install_requires=install_requires,
+    extras_require={'async': ['aiohttp'], 'analytics': ['numpy']},
 )
\ No newline at end of file
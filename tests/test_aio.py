@@ -0,0 +1,94 @@
+""" Tests of the asyncio dispatcher against the local stub server. """
+
+import asyncio
+import unittest
+
+from bitbucket.aio import AsyncBitBucket
+from bitbucket.errors import BitBucketError
+from bitbucket.models import Branch
+from bitbucket.tenancy import TenantManager
+
+from benchmarks.stub_server import StubBitBucketServer
+
+
+class AsyncBitBucketTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubBitBucketServer(changeset_count=20)
+    self.server.start()
+    self.bitbucket = AsyncBitBucket('key', 'secret', 'http://localhost/', max_concurrency=2)
+    client = self.bitbucket.get_authorized_client('token', 'token-secret')
+    self.repository = client.for_namespace('stub').repositories().get('repository')
+
+  def tearDown(self):
+    asyncio.run(self.bitbucket.close())
+    self.server.stop()
+
+  def run_async(self, coroutine):
+    async def run():
+      try:
+        return await coroutine
+      finally:
+        # Sessions are bound to the loop they were created in.
+        await self.bitbucket.close()
+    return asyncio.run(run())
+
+  def test_plain_result(self):
+    (result, data, error) = self.run_async(self.repository.get_main_branch())
+    self.assertTrue(result, error)
+    self.assertEqual('master', data['name'])
+
+  def test_typed_results(self):
+    (result, branches, error) = self.run_async(self.repository.get_branches(typed=True))
+    self.assertTrue(result, error)
+    self.assertEqual(['master'], [branch.name for branch in branches])
+
+    (result, branch, error) = self.run_async(self.repository.get_branch('master', typed=True))
+    self.assertTrue(result, error)
+    self.assertIsInstance(branch, Branch)
+
+    (result, changesets, error) = self.run_async(self.repository.changesets().list(None,
+                                                                                  typed=True))
+    self.assertTrue(result, error)
+    self.assertEqual(20, len(changesets))
+
+  def test_blocking_helpers_refused(self):
+    changesets = self.repository.changesets()
+    self.assertRaises(BitBucketError, changesets.iter_all)
+    self.assertRaises(BitBucketError, changesets.analyze)
+    self.assertRaises(BitBucketError, self.repository.batch)
+    self.assertRaises(BitBucketError, self.repository.snapshot)
+    self.assertRaises(BitBucketError, self.repository.download_raw_path_contents, 'file',
+                      '/dev/null')
+
+    client = self.bitbucket.get_authorized_client('token', 'token-secret')
+    self.assertRaises(BitBucketError, client.bulk, [])
+    self.assertRaises(BitBucketError, client.batch)
+    self.assertRaises(BitBucketError, client.mirror)
+    self.assertRaises(BitBucketError, client.accounts().resolver)
+    self.assertRaises(BitBucketError, TenantManager, self.bitbucket)
+
+  def test_signers_reused(self):
+    bitbucket = AsyncBitBucket('key', 'secret', 'http://localhost/', max_signers=2)
+    signer = bitbucket._get_signer('token', 'secret')
+    self.assertIs(signer, bitbucket._get_signer('token', 'secret'))
+
+    bitbucket._get_signer('other', 'secret')
+    bitbucket._get_signer('third', 'secret')
+    self.assertIsNot(signer, bitbucket._get_signer('token', 'secret'))
+
+    # Signed requests still succeed with a shared signer.
+    for _ in range(2):
+      (result, _, error) = self.run_async(self.repository.get_main_branch())
+      self.assertTrue(result, error)
+
+  def test_token_semaphores_released(self):
+    async def fetch_many():
+      return await asyncio.gather(*[self.repository.get_main_branch() for _ in range(10)])
+
+    results = self.run_async(fetch_many())
+    self.assertTrue(all(result for (result, _, _) in results))
+    self.assertEqual({}, self.bitbucket._semaphores)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,57 @@
+""" Tests of batches against the local stub server. """
+
+import unittest
+
+from bitbucket import BitBucket
+from bitbucket.cache import ContentCache
+
+from benchmarks.stub_server import StubBitBucketServer
+
+_SRC = ('GET', 'repositories/{ns}/{repo}/src/{revision}/{path}')
+
+
+class BatchTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubBitBucketServer()
+    self.server.start()
+    self.dispatcher = BitBucket('key', 'secret', 'http://localhost/',
+                                content_cache=ContentCache())
+    self.repository = self.dispatcher.get_authorized_client('token', 'secret') \
+        .for_namespace('stub').repositories().get('repository')
+
+  def tearDown(self):
+    self.dispatcher.close()
+    self.server.stop()
+
+  def test_batched_reads_go_through_content_cache(self):
+    revision = self.server.node(0)
+    (result, cached, error) = self.repository.get_path_contents('cached.py', revision)
+    self.assertTrue(result, error)
+    self.assertEqual(1, self.server.requests[_SRC])
+
+    with self.repository.batch() as batch:
+      first = batch.get_path_contents('cached.py', revision)
+      second = batch.get_path_contents('other.py', revision)
+      self.assertEqual(1, self.server.requests[_SRC])
+
+    self.assertEqual((True, cached, None), first.result())
+    self.assertTrue(second.result()[0])
+    self.assertEqual(2, self.server.requests[_SRC])
+
+    # Contents read by the batch are cached too.
+    self.assertEqual(second.result(), self.repository.get_path_contents('other.py', revision))
+    self.assertEqual(2, self.server.requests[_SRC])
+
+  def test_batched_requests(self):
+    with self.repository.batch() as batch:
+      branch = batch.get_main_branch()
+      hooks = batch.webhooks().all()
+      dependent = batch.then(branch, lambda data: self.repository.get_branch(data['name']))
+
+    self.assertEqual('master', branch.result()[1]['name'])
+    self.assertTrue(hooks.result()[0])
+    self.assertTrue(dependent.result()[0], dependent.result()[2])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,85 @@
+""" Tests of the content cache and its disk storage. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from bitbucket import BitBucket
+from bitbucket.cache import CachedResponse, ContentCache, DiskCacheStorage
+
+from benchmarks.stub_server import StubBitBucketServer
+
+_COMMIT = '0123456789abcdef0123456789abcdef01234567'
+
+
+class DiskCacheStorageTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_round_trip(self):
+    storage = DiskCacheStorage(self.directory)
+    storage.set('key', CachedResponse('etag', None, {'a': 1}))
+    entry = storage.get('key')
+    self.assertEqual(('etag', {'a': 1}), (entry.etag, entry.data))
+    self.assertIsNone(storage.get('missing'))
+    self.assertEqual(['key.json'], os.listdir(self.directory))
+
+  def test_size_limit_evicts_least_recently_used(self):
+    storage = DiskCacheStorage(self.directory, max_bytes=2500)
+    for index in range(3):
+      storage.set('key%d' % index, CachedResponse(None, None, 'x' * 1000))
+      # Make the order of last use unambiguous.
+      os.utime(storage._path('key%d' % index), (index, index))
+
+    self.assertIsNone(storage.get('key0'))
+    self.assertIsNotNone(storage.get('key2'))
+    total = sum(os.path.getsize(os.path.join(self.directory, name))
+                for name in os.listdir(self.directory))
+    self.assertLessEqual(total, 2500)
+
+
+class ContentCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubBitBucketServer(payload_size=4096)
+    self.server.start()
+    self.content_cache = ContentCache(max_bytes=10000)
+    bitbucket = BitBucket('key', 'secret', 'http://localhost/', content_cache=self.content_cache)
+    self.repository = bitbucket.get_authorized_client('token', 'secret').for_namespace(
+        'stub').repositories().get('repository')
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_entries_sized_by_response_body(self):
+    (result, content, error) = self.repository.get_raw_path_contents('file.bin', _COMMIT)
+    self.assertTrue(result, error)
+    self.assertEqual(4096, len(content))
+    self.assertEqual(4096, self.content_cache.stats()['bytes'])
+
+    self.assertEqual((True, content, None),
+                     self.repository.get_raw_path_contents('file.bin', _COMMIT))
+    self.assertEqual(1, self.server.requests[('GET',
+                                              'repositories/{ns}/{repo}/raw/{revision}/{path}')])
+
+  def test_cached_and_uncached_reads_decoded_alike(self):
+    (result, cached, error) = self.repository.get_path_contents('README.txt', _COMMIT)
+    self.assertTrue(result, error)
+    (result, uncached, error) = self.repository.get_path_contents('README.txt', 'default')
+    self.assertTrue(result, error)
+    self.assertEqual(u'h\u00e9llo\n', cached)
+    self.assertEqual(cached, uncached)
+
+  def test_memory_limit(self):
+    for index in range(5):
+      self.repository.get_raw_path_contents('file%d.bin' % index, _COMMIT)
+    stats = self.content_cache.stats()
+    self.assertLessEqual(stats['bytes'], 10000)
+    self.assertEqual(2, stats['entries'])
+
+
+if __name__ == '__main__':
+  unittest.main()
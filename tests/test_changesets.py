@@ -0,0 +1,64 @@
+""" Tests of the changesets client against the local stub server. """
+
+import subprocess
+import sys
+import unittest
+
+from bitbucket import BitBucket
+
+from benchmarks.stub_server import StubBitBucketServer
+
+
+class IterAllTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubBitBucketServer(changeset_count=120, max_page_size=50)
+    self.server.start()
+    client = BitBucket('key', 'secret', 'http://localhost/').get_authorized_client('token',
+                                                                                   'secret')
+    self.changesets = client.for_namespace('stub').repositories().get('repository').changesets()
+
+  def tearDown(self):
+    self.server.stop()
+
+  def expected_nodes(self, count):
+    return [self.server.node(index)[:12] for index in reversed(range(count))]
+
+  def test_full_history_for_any_page_size(self):
+    for page_size in (1, 7, 49, 50, 51, 60, 200):
+      for prefetch in (True, False):
+        nodes = [changeset['node'] for changeset
+                 in self.changesets.iter_all(page_size=page_size, prefetch=prefetch)]
+        self.assertEqual(self.expected_nodes(120), nodes, (page_size, prefetch))
+
+  def test_since(self):
+    since = self.server.node(100)[:12]
+    nodes = [changeset['node'] for changeset
+             in self.changesets.iter_all(since=since, page_size=7)]
+    self.assertEqual(self.expected_nodes(120)[:19], nodes)
+
+  def test_unchanged_history_without_prefetch_costs_one_request(self):
+    since = self.server.node(119)[:12]
+    self.assertEqual([], list(self.changesets.iter_all(since=since, prefetch=False)))
+    self.assertEqual(1, self.server.requests[('GET', 'repositories/{ns}/{repo}/changesets')])
+
+
+
+class AnalyzeTest(unittest.TestCase):
+  def test_analyze(self):
+    with StubBitBucketServer(changeset_count=120, max_page_size=50):
+      client = BitBucket('key', 'secret', 'http://localhost/').get_authorized_client('token',
+                                                                                     'secret')
+      changesets = client.for_namespace('stub').repositories().get('repository').changesets()
+      (result, stats, error) = changesets.analyze(batch_size=50, processes=0)
+
+    self.assertTrue(result, error)
+    self.assertEqual(120, stats.changesets)
+    self.assertEqual(120, sum(stats.authors.values()))
+
+  def test_pipeline_imported_on_first_use(self):
+    code = ('import sys, bitbucket, bitbucket.changesets; '
+            'sys.exit("bitbucket.analytics" in sys.modules)')
+    self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,35 @@
+""" Tests of the construction of the resource clients. """
+
+import unittest
+
+from bitbucket import BitBucket
+from bitbucket.changesets import BitBucketRepositoryChangeSetsClient
+from bitbucket.namespace import BitBucketNamespaceClient
+from bitbucket.repository import BitBucketRepositoryClient
+
+
+class ClientConstructionTest(unittest.TestCase):
+  def setUp(self):
+    self.dispatcher = BitBucket('key', 'secret', 'http://localhost/')
+
+  def test_positional_constructors(self):
+    repository = BitBucketRepositoryClient(self.dispatcher, 'token', 'secret', 'ns', 'repo')
+    self.assertEqual(('ns', 'repo'), (repository.namespace, repository.repository_name))
+
+    changesets = BitBucketRepositoryChangeSetsClient(self.dispatcher, 'token', 'secret', 'ns',
+                                                     'repo')
+    self.assertEqual(('ns', 'repo'), (changesets.namespace, changesets.repository_name))
+
+    namespace = BitBucketNamespaceClient(self.dispatcher, 'token', 'secret', 'ns')
+    self.assertEqual('ns', namespace.repositories().get('repo').namespace)
+
+  def test_sub_clients_share_context_and_are_memoized(self):
+    repository = self.dispatcher.get_authorized_client('token', 'secret').for_namespace(
+        'ns').repositories().get('repo')
+    self.assertIs(repository.changesets(), repository.changesets())
+    self.assertIs(repository._context, repository.webhooks()._context)
+    self.assertFalse(hasattr(repository, '__dict__'))
+
+
+if __name__ == '__main__':
+  unittest.main()
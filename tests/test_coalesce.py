@@ -0,0 +1,66 @@
+""" Tests of the single-flight coalescing of duplicate calls. """
+
+import threading
+import time
+import unittest
+
+from bitbucket.coalesce import SingleFlight
+from bitbucket.errors import BitBucketError
+
+
+class SingleFlightTest(unittest.TestCase):
+  def run_coalesced(self, leader_function):
+    """ Runs a leader call of `leader_function` and a follower call coalesced with it, returning
+        what each of them raised.
+    """
+    flight = SingleFlight()
+    release = threading.Event()
+    raised = {}
+
+    def leader():
+      release.wait()
+      return leader_function()
+
+    def call(name, function):
+      try:
+        flight.do('key', function)
+      except BaseException as ex:
+        raised[name] = ex
+
+    threads = [threading.Thread(target=call, args=('leader', leader))]
+    threads[0].start()
+    while not flight.stats()['in_flight']:
+      time.sleep(0.001)
+
+    threads.append(threading.Thread(target=call, args=('follower', lambda: None)))
+    threads[1].start()
+    while not flight.coalesced:
+      time.sleep(0.001)
+
+    release.set()
+    for thread in threads:
+      thread.join(10)
+    self.assertEqual({'calls': 2, 'executed': 1, 'coalesced': 1, 'in_flight': 0}, flight.stats())
+    return raised
+
+  def test_exception_shared(self):
+    error = ValueError('failed')
+
+    def fail():
+      raise error
+
+    raised = self.run_coalesced(fail)
+    self.assertIs(error, raised['leader'])
+    self.assertIs(error, raised['follower'])
+
+  def test_interrupted_leader_fails_followers(self):
+    def interrupt():
+      raise KeyboardInterrupt()
+
+    raised = self.run_coalesced(interrupt)
+    self.assertIsInstance(raised['leader'], KeyboardInterrupt)
+    self.assertIsInstance(raised['follower'], BitBucketError)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,40 @@
+""" Tests of the dispatcher instrumentation against the local stub server. """
+
+import unittest
+
+from bitbucket import BitBucket
+from bitbucket.instrumentation import Instrumentation, PHASES
+
+from benchmarks.stub_server import StubBitBucketServer
+
+
+class _Recorder(Instrumentation):
+  def __init__(self):
+    self.infos = []
+
+  def after_request(self, info):
+    self.infos.append(info)
+
+
+class PhasesTest(unittest.TestCase):
+  def test_connection_setup_timed_apart_from_send(self):
+    recorder = _Recorder()
+    with StubBitBucketServer(changeset_count=10, latency=0.05):
+      with BitBucket('key', 'secret', 'http://localhost/', instrumentation=recorder) as bb:
+        changesets = bb.get_authorized_client('token', 'secret').for_namespace('stub') \
+            .repositories().get('repository').changesets()
+        for _ in range(2):
+          (result, _, error) = changesets.list(None, limit=5)
+          self.assertTrue(result, error)
+
+    (first, second) = recorder.infos
+    self.assertEqual(set(PHASES), set(first.timings))
+    self.assertGreater(first.timings['connect'], 0)
+    self.assertEqual(0, second.timings['connect'])
+    for info in (first, second):
+      self.assertGreaterEqual(info.timings['send'], 0.05)
+      self.assertLess(info.timings['connect'], 0.05)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,40 @@
+""" Tests of the metadata mirror against the local stub server. """
+
+import unittest
+
+from bitbucket import BitBucket
+
+from benchmarks.stub_server import StubBitBucketServer
+
+
+class MirrorTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubBitBucketServer(webhook_page_size=10)
+    self.server.start()
+    self.client = BitBucket('key', 'secret', 'http://localhost/').get_authorized_client('token',
+                                                                                        'secret')
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_webhooks_mirrored_across_pages(self):
+    webhooks = self.client.for_namespace('stub').repositories().get('repo3').webhooks()
+    for index in range(25):
+      webhooks.create('hook %d' % index, 'http://example.com/%d' % index, ['repo:push'])
+
+    mirror = self.client.mirror()
+    try:
+      refresh = mirror.refresh(tables=['webhooks'])
+      self.assertEqual([], refresh.failed)
+      self.assertEqual(10, len(refresh.refreshed))
+
+      self.assertEqual(25, len(mirror.resources('webhooks', 'stub', 'repo3')))
+      self.assertEqual([('stub', 'repo3')],
+                       mirror.repositories_with_webhook('http://example.com/24'))
+      self.assertEqual(9, len(mirror.repositories_without_webhook('http://example.com/24')))
+    finally:
+      mirror.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
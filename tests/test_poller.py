@@ -0,0 +1,80 @@
+""" Tests of the ref poller's scheduling and error reporting. """
+
+import threading
+import time
+import unittest
+
+from bitbucket.poller import RefPoller
+
+
+class _ScriptedPoller(RefPoller):
+  """ A poller whose polls return (or raise) the scripted results in turn, then the last one. """
+  def __init__(self, script, **kwargs):
+    RefPoller.__init__(self, None, min_interval=0.01, max_interval=0.01, **kwargs)
+    self._script = list(script)
+    self.polls = 0
+
+  def _poll_refs(self, namespace, repository_name):
+    self.polls += 1
+    outcome = self._script.pop(0) if len(self._script) > 1 else self._script[0]
+    if isinstance(outcome, Exception):
+      raise outcome
+    return outcome
+
+
+def _wait_for(condition, timeout=5):
+  deadline = time.time() + timeout
+  while not condition():
+    if time.time() > deadline:
+      raise AssertionError('Timed out')
+    time.sleep(0.01)
+
+
+class PollerTest(unittest.TestCase):
+  def test_raising_poll_reported_and_rescheduled(self):
+    errors = []
+    poller = _ScriptedPoller([ValueError('boom'), (True, {('branch', 'master'): 'a'}, None)],
+                             on_events=lambda events: None,
+                             on_error=lambda ns, repo, error: errors.append(error))
+    with poller:
+      poller.watch('ns', 'repo')
+      _wait_for(lambda: poller.polls >= 3)
+
+    self.assertEqual(1, len(errors))
+    self.assertIsInstance(errors[0], ValueError)
+    self.assertEqual({('branch', 'master'): 'a'}, poller.refs('ns', 'repo'))
+
+  def test_raising_callbacks_counted_and_rescheduled(self):
+    events_seen = threading.Event()
+
+    def on_events(events):
+      events_seen.set()
+      raise ValueError('on_events')
+
+    def on_error(ns, repo, error):
+      raise ValueError('on_error')
+
+    poller = _ScriptedPoller([(True, {('branch', 'master'): 'a'}, None),
+                              (True, {('branch', 'master'): 'b'}, None)],
+                             on_events=on_events, on_error=on_error)
+    with poller:
+      poller.watch('ns', 'repo')
+      _wait_for(lambda: poller.polls >= 3)
+
+    self.assertTrue(events_seen.is_set())
+    self.assertEqual(2, poller.errors)
+
+  def test_failed_poll_reported(self):
+    errors = []
+    poller = _ScriptedPoller([(False, None, 'Not Found')], on_events=lambda events: None,
+                             on_error=lambda ns, repo, error: errors.append(error))
+    with poller:
+      poller.watch('ns', 'repo')
+      _wait_for(lambda: poller.polls >= 2)
+
+    self.assertEqual('Not Found', errors[0])
+    self.assertIsNone(poller.refs('ns', 'repo'))
+
+
+if __name__ == '__main__':
+  unittest.main()
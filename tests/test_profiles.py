@@ -0,0 +1,119 @@
+""" Tests of the profile resolver against the local stub server. """
+
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from bitbucket import BitBucket
+from bitbucket.errors import ResponseError
+from bitbucket.profiles import SQLiteProfileStore, is_unknown_account
+
+from benchmarks.stub_server import StubBitBucketServer
+
+_PROFILE = ('GET', 'users/{account}')
+
+
+class ProfileResolverTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubBitBucketServer()
+    self.server.start()
+    self.accounts = BitBucket('key', 'secret', 'http://localhost/').get_authorized_client(
+        'token', 'secret').accounts()
+    self.resolver = self.accounts.resolver()
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_unknown_accounts_cached_by_status(self):
+    (result, _, error) = self.resolver.get_profile('unknown-someone')
+    self.assertFalse(result)
+    self.assertEqual(404, error.status_code)
+    self.resolver.get_profile('unknown-someone')
+    self.assertEqual(1, self.server.requests[_PROFILE])
+
+  def test_other_failures_not_cached(self):
+    (result, _, error) = self.resolver.get_profile('failing-someone')
+    self.assertFalse(result)
+    self.assertEqual(500, error.status_code)
+    self.resolver.get_profile('failing-someone')
+    self.assertEqual(2, self.server.requests[_PROFILE])
+
+  def test_profiles_cached(self):
+    (result, data, error) = self.resolver.get_profile('someone')
+    self.assertTrue(result, error)
+    self.assertEqual('someone', data['user']['username'])
+    self.assertEqual(data, self.resolver.get_profile('someone')[1])
+    self.assertEqual(1, self.server.requests[_PROFILE])
+
+
+class SQLiteProfileStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'profiles.db')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_unknown_account_survives_round_trip(self):
+    store = SQLiteProfileStore(self.path)
+    store.set('unknown', (False, None, ResponseError('Not Found', 404)), 100)
+    store.set('known', (True, {'user': {'username': 'known'}}, None), 200)
+    store.close()
+
+    store = SQLiteProfileStore(self.path)
+    try:
+      (result, expires) = store.get('unknown')
+      self.assertEqual(100, expires)
+      self.assertTrue(is_unknown_account(result))
+      self.assertEqual(404, result[2].status_code)
+      self.assertEqual(((True, {'user': {'username': 'known'}}, None), 200), store.get('known'))
+      self.assertIsNone(store.get('other'))
+    finally:
+      store.close()
+
+  def test_resolver_reads_unknown_account_from_store(self):
+    with StubBitBucketServer() as server:
+      accounts = BitBucket('key', 'secret', 'http://localhost/').get_authorized_client(
+          'token', 'secret').accounts()
+      accounts.resolver(store=SQLiteProfileStore(self.path)).get_profile('unknown-someone')
+
+      # A restarted process reads the result back from the store.
+      resolver = accounts.resolver(store=SQLiteProfileStore(self.path))
+      result = resolver.get_profile('unknown-someone')
+      self.assertTrue(is_unknown_account(result))
+      self.assertEqual(1, server.requests[_PROFILE])
+      self.assertEqual(1, resolver.stats()['store_hits'])
+
+  def test_table_without_status_code_upgraded(self):
+    connection = sqlite3.connect(self.path)
+    connection.execute('CREATE TABLE account_profiles (account TEXT PRIMARY KEY, '
+                       'result TEXT NOT NULL, expires REAL NOT NULL)')
+    connection.execute('INSERT INTO account_profiles VALUES (?, ?, ?)',
+                       ('old', '[false, null, "Not Found"]', 100))
+    connection.commit()
+    connection.close()
+
+    store = SQLiteProfileStore(self.path)
+    try:
+      self.assertEqual(((False, None, 'Not Found'), 100), store.get('old'))
+      store.set('unknown', (False, None, ResponseError('Not Found', 404)), 100)
+      self.assertTrue(is_unknown_account(store.get('unknown')[0]))
+    finally:
+      store.close()
+
+
+class ResponseErrorTest(unittest.TestCase):
+  def test_string_with_status(self):
+    error = ResponseError('Not Found', 404)
+    self.assertEqual('Not Found', error)
+    self.assertEqual('Error: 502', ResponseError('', 502))
+
+    copied = pickle.loads(pickle.dumps(error))
+    self.assertEqual(('Not Found', 404), (copied, copied.status_code))
+
+
+if __name__ == '__main__':
+  unittest.main()
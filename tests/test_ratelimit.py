@@ -0,0 +1,55 @@
+""" Tests of the client-side rate limiter. """
+
+import unittest
+
+from bitbucket import ratelimit
+from bitbucket.ratelimit import RateLimiter, TokenBucket
+
+
+class _Clock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class RateLimiterTest(unittest.TestCase):
+  def setUp(self):
+    self.clock = _Clock()
+    self.original_monotonic = ratelimit._monotonic
+    ratelimit._monotonic = self.clock
+
+  def tearDown(self):
+    ratelimit._monotonic = self.original_monotonic
+
+  def test_bucket_refill(self):
+    bucket = TokenBucket(rate=2, capacity=2)
+    self.assertEqual(0, bucket.reserve())
+    self.assertEqual(0, bucket.reserve())
+    self.assertEqual(0.5, bucket.reserve())
+    self.assertIsNone(bucket.reserve(max_wait=0.5))
+
+    self.clock.now += 10
+    self.assertEqual(0, bucket.reserve())
+
+  def test_idle_buckets_dropped(self):
+    limiter = RateLimiter(rate=10, burst=10)
+    for index in range(100):
+      limiter.acquire('token%d' % index)
+    self.assertEqual(100, len(limiter._buckets))
+
+    # One second later, all the buckets have refilled.
+    self.clock.now += 1
+    limiter.acquire('another')
+    self.assertEqual(['another'], list(limiter._buckets))
+
+  def test_bucket_count_bounded(self):
+    limiter = RateLimiter(rate=1, burst=10, max_buckets=5)
+    for index in range(20):
+      limiter.acquire('token%d' % index)
+    self.assertEqual(['token%d' % index for index in range(15, 20)], list(limiter._buckets))
+
+
+if __name__ == '__main__':
+  unittest.main()
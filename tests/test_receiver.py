@@ -0,0 +1,106 @@
+""" Tests of the webhook receiver's deduplication, batching and shutdown. """
+
+import json
+import threading
+import time
+import unittest
+
+from bitbucket.receiver import (WebhookReceiver, STATUS_ACCEPTED, STATUS_DUPLICATE,
+                                STATUS_OVERLOADED)
+
+
+def _headers(delivery_id):
+  return {'x-event-key': 'repo:push', 'x-request-uuid': delivery_id}
+
+
+_BODY = json.dumps({'repository': {'full_name': 'ns/repo'}}).encode('utf-8')
+
+
+class ReceiverTest(unittest.TestCase):
+  def test_duplicates_dropped(self):
+    batches = []
+    with WebhookReceiver(batches.append, workers=1, batch_delay=0) as receiver:
+      self.assertEqual(STATUS_ACCEPTED, receiver.receive(_headers('a'), _BODY))
+      self.assertEqual(STATUS_DUPLICATE, receiver.receive(_headers('a'), _BODY))
+      self.assertEqual(STATUS_ACCEPTED, receiver.receive(_headers('b'), _BODY))
+
+    self.assertEqual(['a', 'b'], [event.delivery_id for batch in batches for event in batch])
+    self.assertEqual(1, receiver.stats()['duplicates'])
+
+  def test_refused_delivery_accepted_when_retried(self):
+    receiver = WebhookReceiver(lambda batch: None, queue_size=1)
+    self.assertEqual(STATUS_ACCEPTED, receiver.receive(_headers('a'), _BODY))
+    self.assertEqual(STATUS_OVERLOADED, receiver.receive(_headers('b'), _BODY))
+
+    with receiver:
+      while receiver.stats()['queued']:
+        time.sleep(0.01)
+      self.assertEqual(STATUS_ACCEPTED, receiver.receive(_headers('b'), _BODY))
+
+  def test_deliveries_without_id_counted(self):
+    receiver = WebhookReceiver(lambda batch: None, queue_size=2)
+    for _ in range(3):
+      receiver.receive({'x-event-key': 'repo:push'}, _BODY)
+
+    stats = receiver.stats()
+    self.assertEqual(2, stats['received'])
+    self.assertEqual(1, stats['rejected'])
+
+  def test_events_batched(self):
+    batches = []
+    receiver = WebhookReceiver(batches.append, workers=1, batch_size=4, batch_delay=1)
+    for index in range(10):
+      receiver.receive(_headers(str(index)), _BODY)
+
+    receiver.start()
+    receiver.stop()
+    self.assertEqual([4, 4, 2], [len(batch) for batch in batches])
+    self.assertEqual('ns', batches[0][0].namespace)
+    self.assertEqual('repo', batches[0][0].repository_name)
+
+  def test_stop_handles_queued_events(self):
+    # The workers find their stop markers in the middle of their batches.
+    release = threading.Event()
+    handled = []
+
+    def handler(batch):
+      release.wait()
+      handled.extend(batch)
+
+    receiver = WebhookReceiver(handler, workers=2, batch_size=100, batch_delay=5, queue_size=4)
+    receiver.start()
+    for index in range(4):
+      receiver.receive(_headers(str(index)), _BODY)
+
+    stopper = threading.Thread(target=receiver.stop)
+    stopper.start()
+    while not receiver._stopped:
+      pass
+    self.assertEqual(STATUS_OVERLOADED, receiver.receive(_headers('late'), _BODY))
+    release.set()
+    stopper.join(10)
+
+    self.assertFalse(stopper.is_alive())
+    self.assertEqual(['0', '1', '2', '3'], sorted(event.delivery_id for event in handled))
+    self.assertEqual(1, receiver.stats()['rejected'])
+
+  def test_failing_on_error_keeps_worker(self):
+    def handler(batch):
+      raise ValueError('handler')
+
+    def on_error(batch, error):
+      raise ValueError('on_error')
+
+    receiver = WebhookReceiver(handler, on_error=on_error, workers=1, batch_size=1,
+                               batch_delay=0)
+    with receiver:
+      for index in range(3):
+        receiver.receive(_headers(str(index)), _BODY)
+
+    stats = receiver.stats()
+    self.assertEqual(3, stats['processed'])
+    self.assertEqual(6, stats['errors'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,91 @@
+""" Tests of the reconciliation of webhooks against the local stub server. """
+
+import unittest
+
+from bitbucket import BitBucket
+from bitbucket.reconcile import DesiredState, _ResourceKind
+
+from benchmarks.stub_server import StubBitBucketServer
+
+
+def _spec(index, **kwargs):
+  spec = {'url': 'http://example.com/%d' % index, 'description': 'hook %d' % index,
+          'events': ['repo:push']}
+  spec.update(kwargs)
+  return spec
+
+
+class ReconcileTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubBitBucketServer(webhook_page_size=10)
+    self.server.start()
+    self.client = BitBucket('key', 'secret', 'http://localhost/').get_authorized_client('token',
+                                                                                        'secret')
+    self.webhooks = self.client.for_namespace('ns').repositories().get('repo').webhooks()
+
+  def tearDown(self):
+    self.server.stop()
+
+  def reconcile(self, specs, prune=False, dry_run=False):
+    (report,) = self.client.reconcile({('ns', 'repo'): DesiredState(webhooks=specs, prune=prune)},
+                                      dry_run=dry_run)
+    self.assertIsNone(report.error)
+    return report
+
+  def test_all_pages(self):
+    for index in range(25):
+      self.webhooks.create('hook %d' % index, 'http://example.com/%d' % index, ['repo:push'])
+
+    (result, data, error) = self.webhooks.all()
+    self.assertTrue(result, error)
+    self.assertEqual(10, len(data['values']))
+
+    (result, data, error) = self.webhooks.all_pages()
+    self.assertTrue(result, error)
+    self.assertEqual(['http://example.com/%d' % index for index in range(25)],
+                     [hook['url'] for hook in data['values']])
+
+  def test_existing_hooks_beyond_first_page_not_recreated(self):
+    specs = [_spec(index) for index in range(25)]
+    self.assertEqual(25, len(self.reconcile(specs).changes))
+    self.assertEqual([], self.reconcile(specs, prune=True).changes)
+
+    (_, data, _) = self.webhooks.all_pages()
+    self.assertEqual(25, len(data['values']))
+
+  def test_skip_cert_verification_compared(self):
+    self.reconcile([_spec(0)])
+    report = self.reconcile([_spec(0, skip_cert_verification=True)])
+    self.assertEqual(['update'], [change.action for change in report.changes])
+
+    (_, data, _) = self.webhooks.all_pages()
+    self.assertTrue(data['values'][0]['skip_cert_verification'])
+    self.assertEqual([], self.reconcile([_spec(0, skip_cert_verification=True)]).changes)
+
+  def test_failed_replacement_restores_resource(self):
+    deploy_keys = self.client.for_namespace('ns').repositories().get('repo').deploykeys()
+    deploy_keys.create('old', 'ssh-rsa AAAA old@host')
+
+    (report,) = self.client.reconcile({('ns', 'repo'): DesiredState(
+        deploy_keys=[{'label': 'invalid label', 'key': 'ssh-rsa AAAA new@host'}])})
+    self.assertEqual(['replace'], [change.action for change in report.changes])
+    ((_, result, error),) = report.results
+    self.assertFalse(result)
+    self.assertIn('restored', error)
+
+    (_, keys, _) = deploy_keys.all()
+    self.assertEqual([('old', 'ssh-rsa AAAA old@host')], [(key['label'], key['key'])
+                                                         for key in keys])
+
+  def test_resource_kinds_are_abstract(self):
+    class IncompleteKind(_ResourceKind):
+      name = accessor = 'incomplete'
+
+      def key(self, resource):
+        return resource
+
+    self.assertRaises(TypeError, IncompleteKind)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,94 @@
+""" Tests of repository snapshots against the local stub server. """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from bitbucket import BitBucket, snapshot
+from bitbucket.snapshot import MemorySnapshotIndex, SQLiteSnapshotIndex, SnapshotEntry
+
+from benchmarks.stub_server import StubBitBucketServer
+
+_SRC = ('GET', 'repositories/{ns}/{repo}/src/{revision}/{path}')
+
+
+class SnapshotTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.index_path = os.path.join(self.directory, 'index.db')
+    self.server = StubBitBucketServer(tree_depth=1, tree_fanout=2)
+    self.server.start()
+    client = BitBucket('key', 'secret', 'http://localhost/').get_authorized_client('token',
+                                                                                   'secret')
+    self.repositories = client.for_namespace('stub').repositories()
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.directory)
+
+  def test_index_reused_only_for_same_repository(self):
+    revision = self.server.node(0)
+    (result, first, error) = self.repositories.get('one').snapshot(revision, self.index_path)
+    self.assertTrue(result, error)
+    self.assertEqual(3, self.server.requests[_SRC])
+
+    (result, again, error) = self.repositories.get('one').snapshot(revision, self.index_path)
+    self.assertTrue(result, error)
+    self.assertEqual(3, self.server.requests[_SRC])
+
+    (result, other, error) = self.repositories.get('two').snapshot(revision, self.index_path)
+    self.assertTrue(result, error)
+    self.assertEqual(6, self.server.requests[_SRC])
+    self.assertEqual(len(first), len(other))
+
+  def test_failed_crawl_closes_index(self):
+    closed = []
+
+    class _RecordingIndex(SQLiteSnapshotIndex):
+      def close(self):
+        closed.append(self)
+        SQLiteSnapshotIndex.close(self)
+
+    class _FailingRepository(object):
+      namespace = 'stub'
+      repository_name = 'repo'
+
+      def get_path_contents(self, path, revision):
+        return (False, None, 'Not Found')
+
+    original = snapshot.SQLiteSnapshotIndex
+    snapshot.SQLiteSnapshotIndex = _RecordingIndex
+    try:
+      (result, _, error) = snapshot.take_snapshot(_FailingRepository(), 'default', False,
+                                                  index_path=self.index_path)
+    finally:
+      snapshot.SQLiteSnapshotIndex = original
+
+    self.assertFalse(result)
+    self.assertEqual('Not Found', error)
+    self.assertEqual(1, len(closed))
+
+
+class GlobTest(unittest.TestCase):
+  def test_indexes_agree(self):
+    entries = [SnapshotEntry(path, 'file', 1, None) for path in
+               ('a.py', 'b.py', 'c.txt', 'dir/a.py', 'dir/b.py', '!.py', '^.py')]
+    memory = MemorySnapshotIndex()
+    memory.add(entries)
+    sqlite = SQLiteSnapshotIndex(':memory:')
+    sqlite.add(entries)
+    try:
+      for (pattern, expected) in (('[!a]*.py', ['!.py', '^.py', 'b.py', 'dir/a.py', 'dir/b.py']),
+                                  ('[^a]*.py', ['^.py', 'a.py']),
+                                  ('dir/*', ['dir/a.py', 'dir/b.py']),
+                                  ('?.py', ['!.py', '^.py', 'a.py', 'b.py'])):
+        for index in (memory, sqlite):
+          self.assertEqual(expected, [entry.path for entry in index.glob(pattern)],
+                           (pattern, index))
+    finally:
+      sqlite.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,97 @@
+""" Tests of the changeset sync engine against the local stub server. """
+
+import shutil
+import tempfile
+import unittest
+
+from bitbucket import BitBucket
+from bitbucket.sync import ChangesetSyncEngine, FileCursorStore, SyncCursor
+
+from benchmarks.stub_server import StubBitBucketServer
+
+_CHANGESETS = ('GET', 'repositories/{ns}/{repo}/changesets')
+
+
+class SyncTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubBitBucketServer(changeset_count=120, max_page_size=50)
+    self.server.start()
+    client = BitBucket('key', 'secret', 'http://localhost/').get_authorized_client('token',
+                                                                                   'secret')
+    self.engine = ChangesetSyncEngine(client, page_size=50)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_first_sync_reports_whole_history(self):
+    (result, delta, error) = self.engine.sync('stub', 'repository')
+    self.assertTrue(result, error)
+    self.assertEqual(120, len(delta.added))
+    self.assertEqual([], delta.removed)
+
+  def test_unchanged_sync_costs_one_request(self):
+    (result, _, error) = self.engine.sync('stub', 'repository')
+    self.assertTrue(result, error)
+    requests = self.server.requests[_CHANGESETS]
+
+    (result, delta, error) = self.engine.sync('stub', 'repository')
+    self.assertTrue(result, error)
+    self.assertEqual([], delta.added)
+    self.assertEqual([], delta.removed)
+    self.assertEqual(requests + 1, self.server.requests[_CHANGESETS])
+
+  def test_rewritten_history_reported(self):
+    (result, _, error) = self.engine.sync('stub', 'repository')
+    self.assertTrue(result, error)
+    old_nodes = [self.server.node(index) for index in reversed(range(110, 120))]
+
+    self.server.rewrite_history(110)
+    (result, delta, error) = self.engine.sync('stub', 'repository')
+    self.assertTrue(result, error)
+    new_nodes = [self.server.node(index) for index in reversed(range(110, 120))]
+    self.assertEqual(new_nodes, [changeset['raw_node'] for changeset in delta.added])
+    self.assertEqual(old_nodes, delta.removed)
+    self.assertFalse(delta.resynced)
+
+    # The cursor now follows the rewritten history.
+    cursor = self.engine.store.get('stub', 'repository')
+    self.assertEqual(new_nodes, cursor.nodes[:10])
+    self.assertNotIn(old_nodes[0], cursor.nodes)
+    (result, delta, error) = self.engine.sync('stub', 'repository')
+    self.assertTrue(result, error)
+    self.assertEqual(([], []), (delta.added, delta.removed))
+
+  def test_history_rewritten_beyond_window_resynced(self):
+    engine = ChangesetSyncEngine(self.engine._client, page_size=50, window=5)
+    (result, _, error) = engine.sync('stub', 'repository')
+    self.assertTrue(result, error)
+
+    self.server.rewrite_history(100)
+    (result, delta, error) = engine.sync('stub', 'repository')
+    self.assertTrue(result, error)
+    self.assertTrue(delta.resynced)
+    self.assertEqual(120, len(delta.added))
+    self.assertEqual([self.server.node(index) for index in reversed(range(115, 120))],
+                     engine.store.get('stub', 'repository').nodes)
+
+
+class FileCursorStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_names_with_underscores_kept_apart(self):
+    store = FileCursorStore(self.directory)
+    store.set('a_', '_b', SyncCursor(['first'], 1))
+    store.set('a', '__b', SyncCursor(['second'], 2))
+    store.set('a__', 'b', SyncCursor(['third'], 3))
+
+    self.assertEqual(['first'], store.get('a_', '_b').nodes)
+    self.assertEqual(['second'], store.get('a', '__b').nodes)
+    self.assertEqual(['third'], store.get('a__', 'b').nodes)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,56 @@
+""" Tests of the tenant manager against the local stub server. """
+
+import unittest
+
+from bitbucket import BitBucket
+from bitbucket.cache import ContentCache
+from bitbucket.tenancy import TenantManager
+
+from benchmarks.stub_server import StubBitBucketServer
+
+_SRC = ('GET', 'repositories/{ns}/{repo}/src/{revision}/{path}')
+
+
+class TenantManagerTest(unittest.TestCase):
+  def test_content_cache_not_shared_between_credentials(self):
+    with StubBitBucketServer() as server:
+      dispatcher = BitBucket('key', 'secret', 'http://localhost/', content_cache=ContentCache())
+      manager = TenantManager(dispatcher)
+      revision = server.node(0)
+
+      def read(access_token):
+        repository = manager.client(access_token, 'secret').for_namespace('stub') \
+            .repositories().get('repository')
+        (result, data, error) = repository.get_path_contents('file.py', revision)
+        self.assertTrue(result, error)
+        return data
+
+      first = read('first')
+      self.assertEqual(1, server.requests[_SRC])
+      self.assertEqual(first, read('first'))
+      self.assertEqual(1, server.requests[_SRC])
+
+      self.assertEqual(first, read('second'))
+      self.assertEqual(2, server.requests[_SRC])
+      dispatcher.close()
+
+  def test_quota_kept_across_client_eviction(self):
+    with StubBitBucketServer():
+      dispatcher = BitBucket('key', 'secret', 'http://localhost/')
+      manager = TenantManager(dispatcher, max_clients=1, quota_rate=0.01, quota_burst=2,
+                              max_quota_wait=0)
+
+      def get_user(tenant):
+        return manager.client('token', 'secret', tenant=tenant).get_current_user()[0]
+
+      self.assertEqual([True, True], [get_user('first'), get_user('first')])
+      # The client of the other tenant evicts the first tenant's only client, which must not
+      # hand the first tenant a fresh quota.
+      self.assertTrue(get_user('second'))
+      self.assertFalse(get_user('first'))
+      self.assertEqual(1, manager.stats()['tenants']['first']['rejected'])
+      dispatcher.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
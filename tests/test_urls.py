@@ -0,0 +1,39 @@
+""" Tests of the URL building and recognition. """
+
+import unittest
+
+from bitbucket.urls import (repository_manifest_url, repository_path_contents_url,
+                            repository_changeset_url, account_profile_url, url_route)
+
+
+class UrlsTest(unittest.TestCase):
+  def test_revision_keeps_slashes(self):
+    url = repository_path_contents_url('ns', 'repo', 'feature/x y', 'dir/file.py')
+    self.assertTrue(url.endswith('/repositories/ns/repo/src/feature/x%20y/dir/file.py'), url)
+
+    url = repository_manifest_url('ns', 'repo', 'feature/x')
+    self.assertTrue(url.endswith('/repositories/ns/repo/manifest/feature/x'), url)
+    self.assertEqual(('repository_manifest', {'ns': 'ns', 'repo': 'repo', 'revision': 'feature/x'}),
+                     url_route(url))
+
+  def test_revision_followed_by_path_recognized(self):
+    url = repository_path_contents_url('ns', 'repo', 'default', 'dir/sub/file.py')
+    self.assertEqual(('repository_path_contents',
+                      {'ns': 'ns', 'repo': 'repo', 'revision': 'default',
+                       'path': 'dir/sub/file.py'}),
+                     url_route(url))
+
+  def test_segments_quoted(self):
+    url = repository_changeset_url('n s', 'r/epo', u'nöde')
+    self.assertTrue(url.endswith('/repositories/n%20s/r%2Fepo/changesets/n%C3%B6de'), url)
+
+  def test_bytes_and_other_values(self):
+    self.assertTrue(account_profile_url(b'some one').endswith('/users/some%20one'))
+    self.assertTrue(account_profile_url(b'someone').endswith('/users/someone'))
+    self.assertTrue(repository_changeset_url('ns', 'repo', 42).endswith('/changesets/42'))
+    url = repository_path_contents_url('ns', 'repo', b'feature/x', b'dir/\xc3\xb6.py')
+    self.assertTrue(url.endswith('/src/feature/x/dir/%C3%B6.py'), url)
+
+
+if __name__ == '__main__':
+  unittest.main()